@@ -0,0 +1,88 @@
+# (c) 2011 Martin Wendt; see http://wplsync.googlecode.com/
+# Licensed under the MIT license: http://www.opensource.org/licenses/mit-license.php
+"""
+Measure the memory used for file bookkeeping (FileInfo records vs. the
+per-file dicts of wplsync <= 1.0.0alpha).
+
+Every variant is run in a fresh process and reports its peak RSS.
+
+Usage:
+    python -m wplsync.test.bench_memory [FILE_COUNT]
+"""
+import os
+import resource
+import subprocess
+import sys
+import time
+
+from wplsync import wplsync
+
+ROOT = os.path.abspath("/music/library")
+
+
+def _iter_paths(file_count):
+    for i in range(file_count):
+        yield os.path.join(ROOT, "Artist %04d" % (i // 200), "Album %05d" % (i // 12),
+                           "%02d - Track title %07d.mp3" % (i % 12 + 1, i))
+
+
+def _peak_rss():
+    """Return the peak resident set size of this process in bytes."""
+    res = resource.getrusage(resource.RUSAGE_SELF).ru_maxrss
+    if sys.platform == "darwin":
+        return res
+    return res * 1024
+
+
+def build_legacy(file_count):
+    info_dict = wplsync.create_info_dict()
+    info_dict["root_folder"] = ROOT
+    for fspec in _iter_paths(file_count):
+        rel_path = os.path.relpath(fspec, ROOT)
+        info_dict["file_list"].append(rel_path)
+        info_dict["file_map"][rel_path] = {"fspec": fspec,
+                                           "rel_path": rel_path,
+                                           "size": 4000000 + len(fspec),
+                                           "mtime": 1300000000.5,
+                                           }
+    return info_dict
+
+
+def build_current(file_count):
+    opts = wplsync.init_options(wplsync.create_option_parser().get_default_values())
+    opts.verbose = 0
+    info_dict = wplsync.create_info_dict()
+    info_dict["root_folder"] = ROOT
+    for fspec in _iter_paths(file_count):
+        wplsync.add_file_info(opts, info_dict, fspec, size=4000000 + len(fspec),
+                              mtime=1300000000.5)
+    return info_dict
+
+
+def run_variant(variant, file_count):
+    start_rss = _peak_rss()
+    start = time.time()
+    info_dict = globals()["build_" + variant](file_count)
+    elapsed = time.time() - start
+    assert len(info_dict["file_map"]) == file_count
+    print "%s %s %s" % (start_rss, _peak_rss(), elapsed)
+
+
+def main():
+    if len(sys.argv) > 2 and sys.argv[1] == "--variant":
+        run_variant(sys.argv[2], int(sys.argv[3]))
+        return
+    file_count = int(sys.argv[1]) if len(sys.argv) > 1 else 1000000
+    print "Building records for %s files" % file_count
+    for variant in ("legacy", "current"):
+        out = subprocess.check_output([sys.executable, "-m", "wplsync.test.bench_memory",
+                                       "--variant", variant, str(file_count)])
+        start_rss, peak_rss, elapsed = out.split()
+        used = int(peak_rss) - int(start_rss)
+        print "%-8s %8.1f MB peak RSS, %7.1f MB for bookkeeping (%.0f bytes per file), %.1f seconds" % (
+            variant, int(peak_rss) / 1048576.0, used / 1048576.0,
+            float(used) / file_count, float(elapsed))
+
+
+if __name__ == "__main__":
+    main()
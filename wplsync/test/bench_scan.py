@@ -0,0 +1,124 @@
+# (c) 2011 Martin Wendt; see http://wplsync.googlecode.com/
+# Licensed under the MIT license: http://www.opensource.org/licenses/mit-license.php
+"""
+Compare the legacy os.walk based scanner with the current scanner.
+
+Creates a source and an identical target tree in a temp folder, then scans
+both and compares all files, counting stat calls and measuring time.
+Stat calls per file are given relative to the total number of scanned files
+(source + target).
+
+Usage:
+    python -m wplsync.test.bench_scan [FILE_COUNT]
+"""
+import filecmp
+import os
+import shutil
+import sys
+import tempfile
+import time
+
+from wplsync import wplsync
+from wplsync.test.benchmark import generate_library
+
+
+class StatCounter(object):
+    """Count calls to os.stat, os.lstat and DirEntry.stat while active."""
+    def __init__(self):
+        self.count = 0
+
+    def __enter__(self):
+        self._stat, self._lstat = os.stat, os.lstat
+        self._scandir = wplsync.scandir
+        self.count = 0
+
+        def _counted(func):
+            def wrapper(*args, **kwargs):
+                self.count += 1
+                return func(*args, **kwargs)
+            return wrapper
+
+        os.stat = _counted(self._stat)
+        os.lstat = _counted(self._lstat)
+        if self._scandir is not None:
+            counter = self
+
+            class EntryProxy(object):
+                def __init__(self, entry):
+                    self._entry = entry
+                    self.name, self.path = entry.name, entry.path
+
+                def is_dir(self, follow_symlinks=True):
+                    return self._entry.is_dir(follow_symlinks=follow_symlinks)
+
+                def is_file(self, follow_symlinks=True):
+                    return self._entry.is_file(follow_symlinks=follow_symlinks)
+
+                def stat(self, follow_symlinks=True):
+                    counter.count += 1
+                    return self._entry.stat(follow_symlinks=follow_symlinks)
+
+            wplsync.scandir = lambda path: [EntryProxy(e) for e in self._scandir(path)]
+        return self
+
+    def __exit__(self, *args):
+        os.stat, os.lstat = self._stat, self._lstat
+        wplsync.scandir = self._scandir
+        return False
+
+
+def legacy_scan_and_compare(opts, source, target):
+    """The scan and compare code path of wplsync <= 1.0.0alpha."""
+    def _scan(folder):
+        res = {}
+        for dirname, _dirnames, filenames in os.walk(folder):
+            for filename in filenames:
+                fspec = os.path.join(dirname, filename)
+                # Every file was stat'ed, then non-synced files were skipped
+                if not os.path.isfile(fspec) or not opts.sync_matcher.match(filename):
+                    continue
+                res[os.path.relpath(fspec, folder)] = (fspec, os.path.getsize(fspec))
+        return res
+    src_map = _scan(source)
+    target_map = _scan(target)
+    for rel_path, (fspec, _size) in src_map.iteritems():
+        filecmp.cmp(fspec, target_map[rel_path][0], shallow=True)
+    return len(src_map)
+
+
+def scan_and_compare(opts, source, target):
+    src_map = wplsync.read_folder_files(opts, source)
+    target_map = wplsync.read_folder_files(opts, target)
+    for rel_path, src_info in src_map["file_map"].iteritems():
+        wplsync.compare_file_info(src_info, target_map["file_map"][rel_path])
+    return len(src_map["file_map"])
+
+
+def main():
+    file_count = int(sys.argv[1]) if len(sys.argv) > 1 else 5000
+    opts = wplsync.init_options(wplsync.create_option_parser().get_default_values())
+    opts.verbose = 0
+    tmp = tempfile.mkdtemp(prefix="wplsync-bench-")
+    # Keep digests and indexes in the temp folder, not in ~/.wplsync
+    opts.state_dir = os.path.join(tmp, "state")
+    try:
+        source = os.path.join(tmp, "source")
+        target = os.path.join(tmp, "target")
+        generate_library(source, file_count, max_size=100)
+        shutil.copytree(source, target)
+        print "Scanning %s files (scandir available: %s)" % (file_count,
+                                                            wplsync.scandir is not None)
+        for name, func in (("legacy", legacy_scan_and_compare),
+                           ("current", scan_and_compare)):
+            with StatCounter() as counter:
+                start = time.time()
+                count = func(opts, source, target)
+                elapsed = time.time() - start
+            print "%-8s %6s files, %8s stat calls (%.2f per file), %.3f seconds" % (
+                name, count, counter.count, float(counter.count) / max(2 * count, 1), elapsed)
+    finally:
+        shutil.rmtree(tmp)
+
+
+if __name__ == "__main__":
+    main()
@@ -0,0 +1,235 @@
+# (c) 2011 Martin Wendt; see http://wplsync.googlecode.com/
+# Licensed under the MIT license: http://www.opensource.org/licenses/mit-license.php
+"""
+Benchmark wplsync on a synthetic media library.
+
+A library with a configurable number of files, folder depth and file size
+distribution is generated in a temp folder, together with WPL playlists
+that use relative and absolute 'src' entries. Then scanning, playlist
+parsing, synchronization and folder purging are timed end to end.
+
+Results are written as JSON, so runs of different releases can be compared.
+
+Usage:
+    python -m wplsync.test.benchmark [options]
+"""
+from optparse import OptionParser
+import json
+import os
+import platform
+import random
+import shutil
+import tempfile
+import time
+
+from wplsync import wplsync
+
+
+def generate_library(root, file_count, depth=2, files_per_folder=12,
+                     min_size=0, max_size=4096, seed=0):
+    """Create `file_count` media files below root and return their paths.
+
+    Files are distributed over `depth` levels of folders (e.g. artist/album)
+    with `files_per_folder` files per leaf folder. Every leaf folder also gets
+    a 'Folder.jpg' and some a 'Thumbs.db'.
+    File sizes are skewed towards min_size, but range up to max_size.
+    """
+    rnd = random.Random(seed)
+    paths = []
+    folder_count = 0
+    for i in range(file_count):
+        leaf = i // files_per_folder
+        parts = []
+        for level in range(depth - 1, -1, -1):
+            parts.append("folder_%d_%05d" % (level, leaf // (files_per_folder ** level)))
+        folder = os.path.join(root, *parts)
+        if not os.path.isdir(folder):
+            os.makedirs(folder)
+            folder_count += 1
+            open(os.path.join(folder, "Folder.jpg"), "wb").write(b"j" * 100)
+            if folder_count % 3 == 0:
+                open(os.path.join(folder, "Thumbs.db"), "wb").write(b"t" * 10)
+        size = min_size + int((max_size - min_size) * rnd.random() ** 3)
+        fspec = os.path.join(folder, "%02d - track %07d.mp3" % (i % files_per_folder + 1, i))
+        with open(fspec, "wb") as f:
+            f.write(b"x" * size)
+        paths.append(fspec)
+    return paths
+
+
+def write_wpl(playlist_path, paths, absolute_ratio=0.5, seed=0):
+    """Write a WPL playlist, using absolute 'src' for some entries and
+    relative paths (with backslashes, like Windows Media Player) for the rest."""
+    rnd = random.Random(seed)
+    playlist_folder = os.path.dirname(playlist_path)
+    with open(playlist_path, "w") as f:
+        f.write('<?wpl version="1.0"?>\n<smil>\n<head>\n'
+                '<meta name="Generator" content="wplsync benchmark"/>\n'
+                '<title>%s</title>\n</head>\n<body>\n<seq>\n'
+                % os.path.basename(playlist_path))
+        for fspec in paths:
+            if rnd.random() >= absolute_ratio:
+                fspec = os.path.relpath(fspec, playlist_folder).replace(os.sep, "\\")
+            f.write('<media src="%s"/>\n' % fspec.replace("&", "&amp;"))
+        f.write("</seq>\n</body>\n</smil>\n")
+    return
+
+
+def _make_opts(source, target, **kwargs):
+    opts = wplsync.init_options(wplsync.create_option_parser().get_default_values())
+    opts.verbose = 0
+    opts.dry_run = False
+    opts.source_folder = source
+    opts.target_folder = target
+    opts.playlist_paths = []
+    # Keep digests and indexes in the temp folder, not in ~/.wplsync
+    opts.state_dir = os.path.join(os.path.dirname(target), "state")
+    for key, value in kwargs.items():
+        setattr(opts, key, value)
+    return opts
+
+
+class Timer(object):
+    """Collect the wall and CPU time of named benchmark steps."""
+    def __init__(self):
+        self.results = {}
+
+    def run(self, name, func, *args, **kwargs):
+        start = time.time()
+        start_cpu = sum(os.times()[:2])
+        res = func(*args, **kwargs)
+        self.results[name] = {"seconds": round(time.time() - start, 4),
+                              "cpu_seconds": round(sum(os.times()[:2]) - start_cpu, 4),
+                              }
+        return res
+
+
+def run_benchmark(params, tmp):
+    source = os.path.join(tmp, "source")
+    target = os.path.join(tmp, "target")
+    os.makedirs(target)
+    timer = Timer()
+    paths = timer.run("generate", generate_library, source, params["files"],
+                      params["depth"], params["files_per_folder"],
+                      params["min_size"], params["max_size"], params["seed"])
+    playlists = []
+    rnd = random.Random(params["seed"])
+    for i in range(params["playlists"]):
+        pl = os.path.join(source, "playlist_%02d.wpl" % i)
+        entries = rnd.sample(paths, min(len(paths), params["playlist_entries"]))
+        write_wpl(pl, entries, seed=i)
+        playlists.append(pl)
+    results = timer.results
+
+    opts = _make_opts(source, target)
+    source_map = timer.run("scan_source", wplsync.read_folder_files, opts, source)
+    target_map = timer.run("scan_target_empty", wplsync.read_folder_files, opts, target)
+    results["scan_source"]["files"] = len(source_map["file_map"])
+
+    for i, pl in enumerate(playlists):
+        info = wplsync.create_info_dict()
+        info["root_folder"] = source
+        timer.run("read_playlist_%d" % i, wplsync.read_playlist, opts, pl, info)
+        results["read_playlist_%d" % i]["files"] = info["process_count"]
+
+    timer.run("sync_initial", wplsync.sync_file_lists, opts, source_map, target_map)
+    results["sync_initial"]["bytes"] = source_map["byte_count"]
+
+    source_map = wplsync.read_folder_files(opts, source)
+    target_map = timer.run("scan_target", wplsync.read_folder_files, opts, target)
+    timer.run("sync_noop", wplsync.sync_file_lists, opts, source_map, target_map)
+
+    # Remove and modify some source files, then sync again
+    rnd = random.Random(params["seed"] + 1)
+    for fspec in rnd.sample(paths, len(paths) // 10):
+        os.remove(fspec)
+        paths.remove(fspec)
+    for fspec in rnd.sample(paths, len(paths) // 20):
+        with open(fspec, "ab") as f:
+            f.write(b"modified")
+    opts.delete_orphans = True
+    source_map = wplsync.read_folder_files(opts, source)
+    target_map = wplsync.read_folder_files(opts, target)
+    timer.run("sync_update", wplsync.sync_file_lists, opts, source_map, target_map)
+
+    # Purge a target that has some folders with only transient files left
+    folder_count = 0
+    for dirname, _subfolders, filenames in os.walk(target):
+        if "Folder.jpg" in filenames and folder_count % 4 == 0:
+            for filename in filenames:
+                if not opts.purge_matcher.match(filename):
+                    os.remove(os.path.join(dirname, filename))
+            open(os.path.join(dirname, "desktop.ini"), "wb").write(b"d")
+        folder_count += 1
+    target_map = wplsync.read_folder_files(opts, target)
+    timer.run("purge_folders", wplsync.purge_folders, opts, target_map)
+    results["purge_folders"]["folders"] = folder_count
+
+    # Full run from playlists
+    opts = _make_opts(source, target, playlist_paths=playlists)
+    shutil.rmtree(target)
+    os.makedirs(target)
+
+    def _playlist_sync():
+        source_map = wplsync.read_source_files(opts)
+        target_map = wplsync.read_folder_files(opts, target)
+        wplsync.sync_file_lists(opts, source_map, target_map)
+        return source_map
+    source_map = timer.run("playlist_sync_end_to_end", _playlist_sync)
+    results["playlist_sync_end_to_end"]["files"] = len(source_map["file_map"])
+    results["playlist_sync_end_to_end"]["errors"] = source_map["error_count"]
+    return results
+
+
+def main():
+    parser = OptionParser(usage="usage: %prog [options]",
+                          description="Benchmark wplsync on a synthetic media library.")
+    parser.add_option("-n", "--files", type="int", default=5000,
+                      help="number of media files (default: %default)")
+    parser.add_option("", "--depth", type="int", default=2,
+                      help="folder depth (default: %default)")
+    parser.add_option("", "--files-per-folder", type="int", default=12,
+                      help="media files per folder (default: %default)")
+    parser.add_option("", "--min-size", type="int", default=0,
+                      help="minimum file size in bytes (default: %default)")
+    parser.add_option("", "--max-size", type="int", default=64 * 1024,
+                      help="maximum file size in bytes (default: %default)")
+    parser.add_option("", "--playlists", type="int", default=2,
+                      help="number of WPL playlists (default: %default)")
+    parser.add_option("", "--playlist-entries", type="int", default=1000,
+                      help="entries per playlist (default: %default)")
+    parser.add_option("", "--seed", type="int", default=0,
+                      help="random seed (default: %default)")
+    parser.add_option("-o", "--output", default=None,
+                      help="write JSON results to this file (default: stdout)")
+    parser.add_option("", "--tmp", default=None,
+                      help="folder for the generated library (default: system temp folder)")
+    (options, args) = parser.parse_args()
+
+    params = dict((key, getattr(options, key))
+                  for key in ("files", "depth", "files_per_folder", "min_size",
+                              "max_size", "playlists", "playlist_entries", "seed"))
+    tmp = tempfile.mkdtemp(prefix="wplsync-bench-", dir=options.tmp)
+    try:
+        results = run_benchmark(params, tmp)
+    finally:
+        shutil.rmtree(tmp)
+
+    report = {"wplsync_version": wplsync.__version__,
+              "python_version": platform.python_version(),
+              "platform": platform.platform(),
+              "scandir": wplsync.scandir is not None,
+              "timestamp": time.strftime("%Y-%m-%dT%H:%M:%S"),
+              "params": params,
+              "results": results,
+              }
+    out = json.dumps(report, indent=2, sort_keys=True)
+    if options.output:
+        with open(options.output, "w") as f:
+            f.write(out + "\n")
+    else:
+        print out
+
+
+if __name__ == "__main__":
+    main()
@@ -0,0 +1,27 @@
+# (c) 2011 Martin Wendt; see http://wplsync.googlecode.com/
+# Licensed under the MIT license: http://www.opensource.org/licenses/mit-license.php
+"""
+Stand-in converter for testing `--transform` without a real encoder.
+
+Writes a short header and every 4th byte of SRC to DEST, so the output is
+smaller than the input (like a lossy encoding of a lossless file).
+
+Usage:
+    wplsync --transform "flac:mp3:python -m wplsync.test.fake_transcode {src} {dest}" ...
+"""
+import sys
+
+
+def main():
+    if len(sys.argv) != 3:
+        sys.exit("usage: fake_transcode SRC DEST")
+    src, dest = sys.argv[1:]
+    with open(src, "rb") as f:
+        data = f.read()
+    with open(dest, "wb") as f:
+        f.write(b"FAKE-TRANSCODE\n")
+        f.write(data[::4])
+
+
+if __name__ == "__main__":
+    main()
@@ -0,0 +1,180 @@
+# (c) 2011 Martin Wendt; see http://wplsync.googlecode.com/
+# Licensed under the MIT license: http://www.opensource.org/licenses/mit-license.php
+"""
+Tests for the playlist readers and the resolution of playlist entries.
+
+Usage:
+    python -m unittest wplsync.test.test_playlists
+"""
+import os
+import shutil
+import tempfile
+import unittest
+
+from wplsync import wplsync
+from wplsync.test.test_wplsync import SyncTestCase, _list_files, _write
+
+
+def _native(path):
+    """Return a unicode path as native str (like a folder scan returns it)."""
+    return wplsync._native_path(path)
+
+
+class PlaylistReaderTest(unittest.TestCase):
+    def setUp(self):
+        self.tmp = tempfile.mkdtemp(prefix="wplsync-test-")
+        self.opts = wplsync.init_options(wplsync.create_option_parser().get_default_values())
+        self.opts.verbose = 0
+
+    def tearDown(self):
+        shutil.rmtree(self.tmp)
+
+    def read(self, name, data):
+        """Write a playlist and return its entries as native paths."""
+        playlist_path = os.path.join(self.tmp, name)
+        _write(playlist_path, data)
+        reader = wplsync.get_playlist_reader(playlist_path)
+        return [_native(entry) for entry in reader(self.opts, playlist_path)]
+
+    def test_m3u(self):
+        # Not valid UTF-8, so decoded as Latin-1
+        data = (b"#EXTM3U\r\n#EXTINF:123,Artist - Title\r\nA/1.mp3\r\n"
+                b"\r\nBj\xf6rk/2.mp3\nhttp://example.com/stream\nfile:///music/3.mp3")
+        self.assertEqual(self.read("list.m3u", data),
+                         ["A/1.mp3", _native(u"Bj\xf6rk/2.mp3"), "/music/3.mp3"])
+
+    def test_m3u8(self):
+        data = b"\xef\xbb\xbf#EXTM3U\nA/1.mp3\nBj\xc3\xb6rk/2.mp3\n"
+        self.assertEqual(self.read("list.m3u8", data),
+                         ["A/1.mp3", _native(u"Bj\xf6rk/2.mp3")])
+
+    def test_pls(self):
+        data = (b"[playlist]\nFile1=A/1.mp3\nTitle1=Title\nLength1=123\n"
+                b"file2 = Bj\xc3\xb6rk/2.mp3\nFile3=http://example.com/stream\n"
+                b"File4=file:///music/Bj%C3%B6rk/3.mp3\nFileX=x.mp3\n"
+                b"NumberOfEntries=4\nVersion=2\n")
+        self.assertEqual(self.read("list.pls", data),
+                         ["A/1.mp3", _native(u"Bj\xf6rk/2.mp3"),
+                          _native(u"/music/Bj\xf6rk/3.mp3")])
+
+    def test_xspf(self):
+        data = (b'<?xml version="1.0" encoding="UTF-8"?>\n'
+                b'<playlist version="1" xmlns="http://xspf.org/ns/0/">\n'
+                b'<title>Test</title>\n<trackList>\n'
+                b'<track><location>A/1.mp3</location><title>1</title></track>\n'
+                b'<track><location>Bj\xc3\xb6rk/2.mp3</location></track>\n'
+                b'<track><title>No location</title></track>\n'
+                b'<track><location>http://example.com/stream</location></track>\n'
+                b'<track><location>file:///music/Bj%C3%B6rk/3.mp3</location>'
+                b'<location>file:///music/other.mp3</location></track>\n'
+                b'</trackList>\n</playlist>\n')
+        self.assertEqual(self.read("list.xspf", data),
+                         ["A/1.mp3", _native(u"Bj\xf6rk/2.mp3"),
+                          _native(u"/music/Bj\xf6rk/3.mp3")])
+
+    def test_wpl(self):
+        data = (b'<?wpl version="1.0"?>\n<smil><head><title>Test</title></head>\n'
+                b'<body><seq><media src="A\\1.mp3"/>'
+                b'<media src="Bj&#246;rk\\2.mp3"/></seq></body></smil>\n')
+        self.assertEqual(self.read("list.wpl", data),
+                         ["A\\1.mp3", _native(u"Bj\xf6rk\\2.mp3")])
+
+
+class PathResolverTest(unittest.TestCase):
+    def setUp(self):
+        self.tmp = tempfile.mkdtemp(prefix="wplsync-test-")
+        self.source = os.path.join(self.tmp, "source")
+        _write(os.path.join(self.source, "A", "a.mp3"), b"a" * 100)
+        _write(os.path.join(self.source, "A", "b.mp3"), b"b" * 200)
+        os.makedirs(os.path.join(self.source, "P"))
+
+    def tearDown(self):
+        shutil.rmtree(self.tmp)
+
+    def test_memoized(self):
+        resolver = wplsync.PathResolver(self.source)
+        fspec = os.path.join(self.source, "A", "a.mp3")
+        rel_path = os.path.join("A", "a.mp3")
+        res = resolver.resolve(os.path.join(self.source, "P"), "../A/a.mp3")
+        self.assertEqual(res, (fspec, rel_path, 100, os.stat(fspec).st_mtime))
+        # The folder and the file were stat'ed
+        self.assertEqual(resolver.stat_count, 2)
+        self.assertTrue(resolver.resolve(os.path.join(self.source, "P"), "../A/a.mp3") is res)
+        # Other entries for the same file (e.g. of other playlists)
+        self.assertTrue(resolver.resolve(self.source, "A\\a.mp3") is res)
+        self.assertTrue(resolver.resolve(self.source, fspec) is res)
+        self.assertEqual(resolver.stat_count, 2)
+        # Only the file is stat'ed for other files of a known folder
+        self.assertEqual(resolver.resolve(self.source, "A/b.mp3")[1:3],
+                         (os.path.join("A", "b.mp3"), 200))
+        self.assertEqual(resolver.stat_count, 3)
+
+    def test_missing(self):
+        resolver = wplsync.PathResolver(self.source)
+        self.assertEqual(resolver.resolve(self.source, "A/c.mp3")[1:],
+                         (os.path.join("A", "c.mp3"), None, None))
+        # (The root folder is stat'ed for the folder entry)
+        self.assertEqual(resolver.resolve(self.source, "A")[2:], (None, None))
+        self.assertEqual(resolver.stat_count, 4)
+        # Files of missing folders are not stat'ed
+        self.assertEqual(resolver.resolve(self.source, "X/c.mp3")[1:],
+                         (os.path.join("X", "c.mp3"), None, None))
+        self.assertEqual(resolver.resolve(self.source, "X/d.mp3")[2:], (None, None))
+        self.assertEqual(resolver.stat_count, 5)
+
+
+class PlaylistSyncTest(SyncTestCase):
+    def setUp(self):
+        SyncTestCase.setUp(self)
+        _write(os.path.join(self.source, "A", "1.mp3"), b"1" * 1000)
+        _write(os.path.join(self.source, _native(u"Bj\xf6rk"), "2.mp3"), b"2" * 1000)
+        playlists = {"list.m3u": b"A/1.mp3\nBj\xf6rk/2.mp3\n",
+                     "list.m3u8": b"A/1.mp3\nBj\xc3\xb6rk/2.mp3\n",
+                     "list.pls": b"[playlist]\nFile1=A/1.mp3\nFile2=Bj\xc3\xb6rk/2.mp3\n",
+                     "list.wpl": (b'<smil><body><seq><media src="A\\1.mp3"/>'
+                                  b'<media src="Bj&#246;rk\\2.mp3"/></seq></body></smil>'),
+                     "list.xspf": (b'<playlist version="1" xmlns="http://xspf.org/ns/0/">'
+                                   b'<trackList><track><location>A/1.mp3</location></track>'
+                                   b'<track><location>Bj%C3%B6rk/2.mp3</location></track>'
+                                   b'</trackList></playlist>'),
+                     }
+        for name, data in playlists.items():
+            playlist_path = os.path.join(self.source, name)
+            _write(playlist_path, data)
+            self.extra_args.append(playlist_path)
+
+    def test_non_ascii_entries(self):
+        self.run_wplsync()
+        self.assertTrue(os.path.isfile(os.path.join(self.target, _native(u"Bj\xf6rk"), "2.mp3")))
+        # The non-ASCII entry matches its target copy, so nothing is copied again
+        out = self.run_wplsync("-d", "-vv")
+        self.assertTrue("Created: 0, updated: 0, moved: 0, deleted: 0, unchanged: 2"
+                        in out, out)
+
+
+class MultiPlaylistTest(SyncTestCase):
+    def test_duplicate_references(self):
+        for rel_path in ("A/a.mp3", "A/b.mp3", "B/c.mp3"):
+            _write(os.path.join(self.source, rel_path), b"x" * 100)
+        first = os.path.join(self.source, "first.m3u")
+        second = os.path.join(self.source, "B", "second.m3u")
+        _write(first, b"A/a.mp3\nA/b.mp3\nA/missing.mp3\nA/a.mp3\n")
+        _write(second, b"../A/b.mp3\nc.mp3\n../A/missing.mp3\n../A/a.mp3\n")
+        opts = self.make_opts()
+        opts.playlist_paths = [first, second]
+        res = wplsync.read_source_files(opts)
+        a, b, c = [os.path.join(*p.split("/")) for p in ("A/a.mp3", "A/b.mp3", "B/c.mp3")]
+        # Files are listed once, in the order they were first referenced
+        self.assertEqual(res["file_list"], [a, b, c])
+        self.assertEqual(res["playlist_map"], {first: [a, b], second: [b, c, a]})
+        self.assertEqual((res["process_count"], res["reference_count"], res["skip_count"],
+                          res["error_count"], res["byte_count"]), (4, 8, 1, 1, 300))
+
+        self.extra_args = [first, second]
+        out = self.run_wplsync("-v")
+        self.assertTrue("Source: 4 files (8 references)" in out, out)
+        self.assertEqual(_list_files(self.target), [a, b, c])
+
+
+if __name__ == "__main__":
+    unittest.main()
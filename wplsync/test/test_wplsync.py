@@ -0,0 +1,648 @@
+# (c) 2011 Martin Wendt; see http://wplsync.googlecode.com/
+# Licensed under the MIT license: http://www.opensource.org/licenses/mit-license.php
+"""
+Tests for wplsync runs that change the target folder.
+
+Every test creates a source and a target folder in a temp folder and calls
+`wplsync.run()` with a command line, like a user would.
+
+Usage:
+    python -m unittest wplsync.test.test_wplsync
+"""
+from StringIO import StringIO
+import errno
+import fnmatch
+import json
+import os
+import shutil
+import sys
+import tempfile
+import time
+import unittest
+
+from wplsync import wplsync
+
+
+def _write(fspec, data):
+    folder = os.path.dirname(fspec)
+    if not os.path.isdir(folder):
+        os.makedirs(folder)
+    with open(fspec, "wb") as f:
+        f.write(data)
+    return
+
+
+def _read(fspec):
+    with open(fspec, "rb") as f:
+        return f.read()
+
+
+def _list_files(root):
+    """Return the sorted rel_paths of all files below root."""
+    res = []
+    for dirname, _subfolders, filenames in os.walk(root):
+        for filename in filenames:
+            res.append(os.path.relpath(os.path.join(dirname, filename), root))
+    return sorted(res)
+
+
+def _set_mtime(fspec, mtime):
+    os.utime(fspec, (mtime, mtime))
+    return
+
+
+class SyncTestCase(unittest.TestCase):
+    def setUp(self):
+        self.tmp = tempfile.mkdtemp(prefix="wplsync-test-")
+        self.source = os.path.join(self.tmp, "source")
+        self.target = os.path.join(self.tmp, "target")
+        self.state_dir = os.path.join(self.tmp, "state")
+        self.extra_args = [] # Passed after the target folder (targets or playlists)
+        os.makedirs(self.source)
+        os.makedirs(self.target)
+
+    def tearDown(self):
+        shutil.rmtree(self.tmp)
+
+    def run_wplsync(self, *args):
+        """Run wplsync with `args` and return its output.
+
+        The output is also kept in self.output (e.g. if run() exits).
+        """
+        argv = (["wplsync", "-x", "-j", "1", "--state-dir", self.state_dir]
+                + list(args) + [self.source, self.target] + self.extra_args)
+        out = StringIO()
+        saved = sys.argv, sys.stdout, sys.stderr
+        sys.argv, sys.stdout, sys.stderr = argv, out, out
+        try:
+            wplsync.run()
+        finally:
+            sys.argv, sys.stdout, sys.stderr = saved
+            self.output = out.getvalue()
+        return self.output
+
+    def make_opts(self):
+        """Return options for calling sync functions directly (like `-x -d`)."""
+        opts = wplsync.init_options(wplsync.create_option_parser().get_default_values())
+        opts.verbose = 0
+        opts.source_folder = self.source
+        opts.target_folder = self.target
+        opts.delete_orphans = True
+        opts.dry_run = False
+        return opts
+
+    def assertTargetEqualsSource(self):
+        self.assertEqual(_list_files(self.target), _list_files(self.source))
+        for rel_path in _list_files(self.source):
+            self.assertEqual(_read(os.path.join(self.target, rel_path)),
+                             _read(os.path.join(self.source, rel_path)), rel_path)
+        return
+
+
+class RunParallelTest(unittest.TestCase):
+    def test_output_order(self):
+        def _print(name, delay):
+            for i in range(3):
+                print "%s%s" % (name, i)
+                time.sleep(delay)
+            return name
+        out = StringIO()
+        saved = sys.stdout
+        sys.stdout = out
+        try:
+            res = wplsync.run_parallel([(_print, ("a", 0.01)), (_print, ("b", 0))])
+        finally:
+            sys.stdout = saved
+        self.assertEqual(res, ["a", "b"])
+        self.assertEqual(out.getvalue().split(), ["a0", "a1", "a2", "b0", "b1", "b2"])
+
+
+class PatternTest(SyncTestCase):
+    def test_matches_like_fnmatch(self):
+        patterns = ["*.mp3", "*.tar.gz", "Folder.jpg", "track?.ogg", "[ab]*.wav"]
+        matcher = wplsync.PatternMatcher(patterns)
+        for name in ("a.mp3", ".mp3", "a.mp3.bak", "a.MP3", "x.tar.gz", "x.gz",
+                     "Folder.jpg", "folder.jpg", "My Folder.jpg", "track1.ogg",
+                     "track10.ogg", "a1.wav", "c1.wav", "noext", ""):
+            self.assertEqual(matcher.match(name),
+                             any(fnmatch.fnmatch(name, pat) for pat in patterns), name)
+
+    def test_exclude_patterns(self):
+        matcher = wplsync.PatternMatcher(["*.mp3", "Folder.jpg"], ["*(live)*", "Folder.jpg"])
+        self.assertTrue(matcher.match("song.mp3"))
+        self.assertFalse(matcher.match("song (live).mp3"))
+        self.assertFalse(matcher.match("Folder.jpg"))
+        self.assertFalse(matcher.match("(live).txt"))
+
+    def test_include_exclude_options(self):
+        for rel_path in ("A/a.mp3", "A/b.flac", "A/Folder.jpg", "A/notes.txt",
+                         "B/c (live).mp3", "B/d (live).flac"):
+            _write(os.path.join(self.source, rel_path), b"x" * 100)
+        self.run_wplsync("--include", "*.flac", "--exclude", "*(live)*")
+        self.assertEqual(_list_files(self.target),
+                         [os.path.join("A", name) for name in ("Folder.jpg", "a.mp3", "b.flac")])
+
+
+class JournalTest(SyncTestCase):
+    def setUp(self):
+        SyncTestCase.setUp(self)
+        for i, name in enumerate(("a.mp3", "b.mp3", "c.mp3")):
+            _write(os.path.join(self.source, "A", name), name.encode("ascii") * (1000 + i))
+        self.journal_path = os.path.join(self.target, wplsync.TransferJournal.FILE_NAME)
+
+    def interrupt_copy(self, copy_count):
+        """Sync and simulate Ctrl+C while copying file number `copy_count`+1."""
+        copy_file_data = wplsync.copy_file_data
+        calls = []
+        def _copy_file_data(opts, src, dest):
+            if len(calls) == copy_count:
+                # Half written, when the user hits Ctrl+C
+                _write(dest, _read(src)[:100])
+                raise KeyboardInterrupt
+            calls.append(src)
+            return copy_file_data(opts, src, dest)
+        wplsync.copy_file_data = _copy_file_data
+        try:
+            out = self.run_wplsync()
+        finally:
+            wplsync.copy_file_data = copy_file_data
+        self.assertTrue("Interrupted!" in out, out)
+        return
+
+    def test_resume_interrupted_copy(self):
+        self.interrupt_copy(1)
+        self.assertTrue(os.path.isfile(self.journal_path))
+        files = _list_files(self.target)
+        self.assertEqual(len([f for f in files if f.endswith(".mp3")]), 1)
+        self.assertEqual(len([f for f in files if f.endswith(wplsync.TEMP_FILE_SUFFIX)]), 1)
+
+        out = self.run_wplsync("--resume")
+        self.assertTrue("2 of 3 operations pending" in out, out)
+        self.assertTargetEqualsSource()
+
+        out = self.run_wplsync("-v")
+        self.assertTrue("Created: 0, updated: 0" in out, out)
+
+    def test_full_sync_removes_interrupted_journal(self):
+        self.interrupt_copy(1)
+        out = self.run_wplsync()
+        self.assertTrue("Found journal of an interrupted run" in out, out)
+        self.assertTargetEqualsSource()
+
+    def test_stale_journal_of_other_source(self):
+        header = {"version": 1,
+                  "source_folder": os.path.join(self.tmp, "other"),
+                  "target_folder": self.target,
+                  "delete_orphans": False,
+                  "started": time.time(),
+                  }
+        _write(self.journal_path, (json.dumps(header) + "\n").encode("ascii"))
+        self.assertRaises(SystemExit, self.run_wplsync, "--resume")
+        self.assertTrue("cannot resume" in self.output, self.output)
+        self.assertTrue(os.path.isfile(self.journal_path))
+
+        out = self.run_wplsync()
+        self.assertTrue("another SOURCE_FOLDER" in out, out)
+        self.assertTargetEqualsSource()
+
+    def test_resume_non_utf8_name(self):
+        # Python 2 paths are bytes; Python 3 decodes undecodable bytes
+        # with 'surrogateescape'
+        name = b"caf\xe9.mp3"
+        if not isinstance(name, str):
+            name = name.decode(sys.getfilesystemencoding(), "surrogateescape")
+        _write(os.path.join(self.source, "A", name), b"x" * 1000)
+        self.interrupt_copy(2)
+        self.assertTrue(os.path.isfile(self.journal_path))
+        out = self.run_wplsync("--resume")
+        self.assertTrue("2 of 4 operations pending" in out, out)
+        self.assertTargetEqualsSource()
+        self.assertFalse(os.path.exists(self.journal_path))
+
+    def test_empty_journal(self):
+        _write(self.journal_path, b"")
+        out = self.run_wplsync("--resume")
+        self.assertTrue("No interrupted run found" in out, out)
+        self.assertFalse(os.path.exists(self.journal_path))
+
+
+class IndexTest(SyncTestCase):
+    def test_refresh_index(self):
+        src = os.path.join(self.source, "A", "a.mp3")
+        _write(src, b"a" * 100)
+        # The index only trusts folders that were not modified just now
+        for folder in (os.path.dirname(src), self.source):
+            _set_mtime(folder, int(time.time()) - 100)
+        self.run_wplsync("--index")
+
+        # Modified in place: the folder's mtime doesn't change
+        _write(src, b"b" * 200)
+        _set_mtime(src, int(time.time()) + 10)
+        self.run_wplsync("--index")
+        self.assertEqual(_read(os.path.join(self.target, "A", "a.mp3")), b"a" * 100)
+
+        self.run_wplsync("--refresh-index")
+        self.assertTargetEqualsSource()
+
+    def test_non_ascii_root_folder(self):
+        self.source = os.path.join(self.tmp, wplsync._native_path(u"M\xfcsik"))
+        _write(os.path.join(self.source, "A", "a.mp3"), b"a" * 100)
+        self.run_wplsync("--index")
+        self.assertTargetEqualsSource()
+        self.assertEqual(len([name for name in os.listdir(self.state_dir)
+                              if name.startswith("scan-index-")]), 2)
+
+
+class CopyMethodTest(SyncTestCase):
+    def setUp(self):
+        SyncTestCase.setUp(self)
+        self.unsupported = set(wplsync._unsupported_copy_methods)
+        wplsync._unsupported_copy_methods.clear()
+        self.fcntl = wplsync.fcntl
+        self.ioctl_calls = []
+        self.ioctl_errno = errno.EOPNOTSUPP
+        test = self
+
+        class FakeFcntl(object):
+            @staticmethod
+            def ioctl(fd, request, arg):
+                test.ioctl_calls.append(request)
+                raise IOError(test.ioctl_errno, os.strerror(test.ioctl_errno))
+
+        wplsync.fcntl = FakeFcntl
+        self.src = os.path.join(self.source, "a.mp3")
+        _write(self.src, b"a" * 10000)
+
+    def tearDown(self):
+        wplsync.fcntl = self.fcntl
+        wplsync._unsupported_copy_methods.clear()
+        wplsync._unsupported_copy_methods.update(self.unsupported)
+        SyncTestCase.tearDown(self)
+
+    def test_get_copy_methods(self):
+        opts = self.make_opts()
+        opts.copy_method = "buffered"
+        self.assertEqual(wplsync.get_copy_methods(opts), ["buffered"])
+        opts.copy_method = "sendfile"
+        self.assertEqual(wplsync.get_copy_methods(opts),
+                         ["sendfile", "buffered"] if hasattr(os, "sendfile") else ["buffered"])
+        opts.copy_method = "auto"
+        self.assertEqual(wplsync.get_copy_methods(opts)[-1], "buffered")
+
+    @unittest.skipUnless(sys.platform.startswith("linux"), "reflinks are only tried on Linux")
+    def test_fallback(self):
+        opts = self.make_opts()
+        opts.copy_method = "reflink"
+        dev = os.stat(self.target).st_dev
+        for i in range(2):
+            dest = os.path.join(self.target, "a%s.mp3" % i)
+            self.assertEqual(wplsync.copy_file_data(opts, self.src, dest), "buffered")
+            self.assertEqual(_read(dest), _read(self.src))
+        # A method that failed is not tried again for these devices
+        self.assertEqual(len(self.ioctl_calls), 1)
+        self.assertTrue(("reflink", dev, dev) in wplsync._unsupported_copy_methods)
+
+    @unittest.skipUnless(sys.platform.startswith("linux"), "reflinks are only tried on Linux")
+    def test_other_errors_are_raised(self):
+        opts = self.make_opts()
+        opts.copy_method = "reflink"
+        self.ioctl_errno = errno.EIO
+        self.assertRaises(IOError, wplsync.copy_file_data, opts, self.src,
+                          os.path.join(self.target, "a.mp3"))
+        self.assertEqual(wplsync._unsupported_copy_methods, set())
+
+    def test_copy_method_option(self):
+        out = self.run_wplsync("-v", "--copy-method", "buffered")
+        self.assertTrue("using buffered: 1" in out, out)
+        self.assertTargetEqualsSource()
+
+
+class DeltaTest(SyncTestCase):
+    def test_delta_update(self):
+        src = os.path.join(self.source, "A", "a.mp3")
+        block_size = wplsync.DELTA_BLOCK_SIZE
+        data = b"".join(chr(65 + i).encode("ascii") * block_size for i in range(4))
+        _write(src, data)
+        self.run_wplsync("--delta")
+        dest = os.path.join(self.target, "A", "a.mp3")
+        inode = os.stat(dest).st_ino
+
+        # Retag in place: change a few bytes of the second block
+        pos = block_size + 10
+        _write(src, data[:pos] + b"changed" + data[pos + 7:])
+        _set_mtime(src, int(time.time()) + 10)
+        out = self.run_wplsync("-v", "--delta")
+        self.assertTrue("Delta updates: 1 files" in out, out)
+        self.assertEqual(os.stat(dest).st_ino, inode)
+        self.assertTargetEqualsSource()
+        self.assertEqual(os.stat(dest).st_mtime, os.stat(src).st_mtime)
+
+        # Truncated files are updated, too
+        _write(src, data[:block_size + 100])
+        _set_mtime(src, int(time.time()) + 20)
+        self.run_wplsync("--delta")
+        self.assertTargetEqualsSource()
+
+
+class MoveTest(SyncTestCase):
+    def test_move_and_purge(self):
+        _write(os.path.join(self.source, "A", "a.mp3"), b"a" * 1000)
+        _write(os.path.join(self.source, "B", "b.mp3"), b"b" * 1000)
+        self.run_wplsync("-d")
+        inode = os.stat(os.path.join(self.target, "A", "a.mp3")).st_ino
+        # Transient files don't keep a folder from being purged
+        _write(os.path.join(self.target, "A", "Thumbs.db"), b"t")
+
+        os.makedirs(os.path.join(self.source, "C"))
+        os.rename(os.path.join(self.source, "A", "a.mp3"),
+                  os.path.join(self.source, "C", "a2.mp3"))
+        os.rmdir(os.path.join(self.source, "A"))
+        out = self.run_wplsync("-v", "-d")
+        self.assertTrue("moved: 1" in out, out)
+        self.assertEqual(os.stat(os.path.join(self.target, "C", "a2.mp3")).st_ino, inode)
+        self.assertFalse(os.path.exists(os.path.join(self.target, "A")))
+        self.assertTargetEqualsSource()
+
+
+class LinkTest(SyncTestCase):
+    def setUp(self):
+        SyncTestCase.setUp(self)
+        self.unsupported = set(wplsync._unsupported_copy_methods)
+        dev = os.stat(self.target).st_dev
+        # Like on FAT
+        wplsync._unsupported_copy_methods.add(("hardlink", dev, dev))
+
+    def tearDown(self):
+        wplsync._unsupported_copy_methods.clear()
+        wplsync._unsupported_copy_methods.update(self.unsupported)
+        SyncTestCase.tearDown(self)
+
+    def test_link_fallback_copies_source(self):
+        _write(os.path.join(self.source, "A", "Folder.jpg"), b"j" * 1000)
+        _write(os.path.join(self.source, "B", "Folder.jpg"), b"j" * 1000)
+        self.run_wplsync("--link-duplicates")
+        self.assertTargetEqualsSource()
+        self.assertEqual(os.stat(os.path.join(self.target, "B", "Folder.jpg")).st_nlink, 1)
+
+        # The data is read from the source file, not from the target file
+        # that would have been linked
+        opts = wplsync.init_options(wplsync.create_option_parser().get_default_values())
+        opts.dry_run = False
+        opts.source_folder = self.source
+        link_src = os.path.join(self.target, "A", "Folder.jpg")
+        _write(link_src, b"x" * 1000)
+        reflink_file = wplsync._reflink_file
+        wplsync._reflink_file = lambda src, dest: False
+        try:
+            wplsync.link_file(opts, link_src, os.path.join(self.source, "B", "Folder.jpg"),
+                              os.path.join(self.target, "B", "Folder.jpg"))
+        finally:
+            wplsync._reflink_file = reflink_file
+        self.assertEqual(_read(os.path.join(self.target, "B", "Folder.jpg")), b"j" * 1000)
+
+    def test_link_capacity_without_hardlinks(self):
+        _write(os.path.join(self.source, "A", "Folder.jpg"), b"j" * 1000)
+        _write(os.path.join(self.source, "B", "Folder.jpg"), b"j" * 1000)
+        out = self.run_wplsync("--link-duplicates", "--max-size", "1500")
+        self.assertTrue("skipping 1 files" in out, out)
+        self.assertEqual(_list_files(self.target), [os.path.join("A", "Folder.jpg")])
+
+
+class CapacityTest(SyncTestCase):
+    def plan(self, sizes, target_sizes=None, orphan_sizes=(), free_bytes=0, max_size=None):
+        """Call plan_capacity() for files 'a', 'b', ... of `sizes` with 100 byte
+        blocks and return the rel_paths of the accepted ops and the totals."""
+        opts = self.make_opts()
+        opts.max_size = max_size
+        target_sizes = target_sizes or {}
+        source_map = {"file_map": {}}
+        target_map = {"file_map": {}, "byte_count": sum(target_sizes.values())}
+        copy_ops = []
+        for i, size in enumerate(sizes):
+            rel_path = chr(ord("a") + i)
+            source_map["file_map"][rel_path] = wplsync.FileInfo(self.source, rel_path, size, 0)
+            action = "CREATE"
+            if rel_path in target_sizes:
+                target_map["file_map"][rel_path] = wplsync.FileInfo(
+                    self.target, rel_path, target_sizes[rel_path], 0)
+                action = "UPDATE"
+            copy_ops.append((action, rel_path, None, None))
+        orphans = [wplsync.FileInfo(self.target, "orphan", size, 0) for size in orphan_sizes]
+        target_map["byte_count"] += sum(orphan_sizes)
+        accepted, skipped, required, available = wplsync.plan_capacity(
+            opts, copy_ops, source_map, target_map, orphans, free_bytes, 100)
+        self.assertEqual(len(accepted) + len(skipped), len(copy_ops))
+        return [op[1] for op in accepted], required, available
+
+    def test_blocks(self):
+        # Files occupy whole blocks
+        self.assertEqual(self.plan([250, 300, 50], free_bytes=700), (["a", "b", "c"], 700, 700))
+        # Files are accepted in order: 'c' would fit, but follows a skipped file
+        self.assertEqual(self.plan([250, 300, 50], free_bytes=500), (["a"], 700, 500))
+        # Updates that don't need more space are always accepted
+        self.assertEqual(self.plan([250, 300, 150], {"c": 180}, free_bytes=500),
+                         (["a", "c"], 600, 500))
+        # Deleted orphans free their blocks
+        self.assertEqual(self.plan([250], orphan_sizes=[201]), (["a"], 300, 300))
+
+    def test_max_size(self):
+        # --max-size counts logical bytes, the free space blocks
+        self.assertEqual(self.plan([250, 300], free_bytes=1000, max_size=560),
+                         (["a", "b"], 550, 560))
+        self.assertEqual(self.plan([250, 300], free_bytes=550, max_size=560),
+                         (["a"], 600, 550))
+        # Files in the target and deleted orphans count, too
+        self.assertEqual(self.plan([250, 300, 60], {"b": 100}, orphan_sizes=[50],
+                                   free_bytes=1000, max_size=560),
+                         (["a", "b"], 510, 460))
+
+    def test_playlist_order(self):
+        for name in ("a.mp3", "b.mp3", "c.mp3"):
+            _write(os.path.join(self.source, name), name.encode("ascii") * 200)
+        playlist_path = os.path.join(self.source, "list.m3u")
+        _write(playlist_path, b"c.mp3\na.mp3\nb.mp3\n")
+        self.extra_args.append(playlist_path)
+        out = self.run_wplsync("--max-size", "2K")
+        self.assertTrue("skipping 1 files (1000 bytes)" in out, out)
+        self.assertEqual(_list_files(self.target), ["a.mp3", "c.mp3"])
+
+
+class TransformTest(SyncTestCase):
+    def test_existing_output_is_not_transformed(self):
+        _write(os.path.join(self.source, "A", "a.flac"), b"a" * 1000)
+        _write(os.path.join(self.source, "A", "a.mp3"), b"m" * 100)
+        _write(os.path.join(self.source, "B", "b.flac"), b"b" * 1000)
+        transcode = os.path.join(os.path.dirname(os.path.abspath(__file__)),
+                                 "fake_transcode.py")
+        self.run_wplsync("--transform", "flac:mp3:%s %s {src} {dest}"
+                         % (sys.executable, transcode))
+        self.assertEqual(_list_files(self.target),
+                         [os.path.join("A", "a.mp3"), os.path.join("B", "b.mp3")])
+        self.assertEqual(_read(os.path.join(self.target, "A", "a.mp3")), b"m" * 100)
+
+
+class ManifestTest(SyncTestCase):
+    def test_manifest_rejected_after_folder_change(self):
+        _write(os.path.join(self.source, "A", "a.mp3"), b"a" * 1000)
+        _write(os.path.join(self.source, "B", "b.mp3"), b"b" * 1000)
+        self.run_wplsync("-d", "--manifest")
+        manifest_path = os.path.join(self.target, wplsync.MANIFEST_FILE_NAME)
+        self.assertTrue(os.path.isfile(manifest_path))
+
+        out = self.run_wplsync("-v", "-d", "--manifest")
+        self.assertFalse("Manifest is outdated" in out, out)
+
+        # Modify a target sub folder behind wplsync's back: the manifest
+        # doesn't know the new file, so it must not be used
+        extra = os.path.join(self.target, "A", "extra.mp3")
+        _write(extra, b"x" * 10)
+        folder = os.path.dirname(extra)
+        _set_mtime(folder, os.stat(folder).st_mtime + 10)
+        out = self.run_wplsync("-v", "-d", "--manifest")
+        self.assertTrue("Manifest is outdated" in out, out)
+        self.assertFalse(os.path.exists(extra))
+        self.assertTrue(os.path.isfile(manifest_path))
+
+
+class FanoutTest(SyncTestCase):
+    def test_two_targets(self):
+        for name in ("a.mp3", "b.mp3"):
+            _write(os.path.join(self.source, "A", name), name.encode("ascii") * 1000)
+        target2 = os.path.join(self.tmp, "target2")
+        _write(os.path.join(target2, "A", "b.mp3"), b"b.mp3" * 1000)
+        shutil.copystat(os.path.join(self.source, "A", "b.mp3"),
+                        os.path.join(target2, "A", "b.mp3"))
+        _write(os.path.join(target2, "B", "orphan.mp3"), b"o")
+        self.extra_args.append(target2)
+        copy_file_multi = wplsync.copy_file_multi
+        calls = []
+        def _copy_file_multi(opts, src, dests):
+            calls.append((os.path.relpath(src, self.source), len(dests)))
+            return copy_file_multi(opts, src, dests)
+        wplsync.copy_file_multi = _copy_file_multi
+        try:
+            out = self.run_wplsync("-v", "-d")
+        finally:
+            wplsync.copy_file_multi = copy_file_multi
+        # a.mp3 is read once for both targets
+        self.assertEqual(sorted(calls), [(os.path.join("A", "a.mp3"), 2),
+                                         (os.path.join("A", "b.mp3"), 1)])
+        self.assertTargetEqualsSource()
+        self.assertEqual(_list_files(target2), _list_files(self.source))
+        # Every target gets its own summary
+        summaries = [line for line in out.splitlines() if line.startswith("Synchronized")]
+        self.assertEqual(len(summaries), 2, out)
+        self.assertTrue("Created: 2, updated: 0, moved: 0, deleted: 0, unchanged: 0"
+                        in summaries[0], out)
+        self.assertTrue("Created: 1, updated: 0, moved: 0, deleted: 1, unchanged: 1"
+                        in summaries[1], out)
+        self.assertTrue('Target "%s":' % target2 in out, out)
+        self.assertTrue("fanout: 1" in out, out)
+
+    def test_overlapping_targets(self):
+        self.extra_args.append(os.path.join(self.target, "sub"))
+        os.makedirs(self.extra_args[0])
+        self.assertRaises(SystemExit, self.run_wplsync)
+        self.assertTrue("TARGET_FOLDERs must not overlap" in self.output, self.output)
+
+
+class PurgeTest(SyncTestCase):
+    def test_purge_after_deletes(self):
+        _write(os.path.join(self.source, "A", "a.mp3"), b"a")
+        _write(os.path.join(self.source, "A", "Folder.jpg"), b"j")
+        for rel_path, data in (("A/a.mp3", b"a"), ("A/Folder.jpg", b"j"),
+                               # Only orphans and transient files
+                               ("X/Y/Z/old.mp3", b"o"), ("X/Y/Thumbs.db", b"t"),
+                               # Only copy-only and transient files
+                               ("Q/Folder.jpg", b"j"), ("Q/desktop.ini", b"d"),
+                               # Other files are kept
+                               ("R/notes.txt", b"n"), ("R/S/old.mp3", b"o"),
+                               # Changed after the scan (see below)
+                               ("M/Folder.jpg", b"j")):
+            _write(os.path.join(self.target, *rel_path.split("/")), data)
+
+        # Purging uses the scanned folder contents, without reading the target
+        purge_folders = wplsync.purge_folders
+        saved = os.walk, os.listdir, wplsync.scandir
+        def _fail(*args):
+            self.fail("Target was read again: %r" % (args, ))
+        def _purge_folders(opts, target_map):
+            _write(os.path.join(self.target, "M", "new.txt"), b"n")
+            os.walk = os.listdir = _fail
+            if wplsync.scandir is not None:
+                wplsync.scandir = _fail
+            try:
+                return purge_folders(opts, target_map)
+            finally:
+                os.walk, os.listdir, wplsync.scandir = saved
+        wplsync.purge_folders = _purge_folders
+        try:
+            out = self.run_wplsync("-d", "-v")
+        finally:
+            wplsync.purge_folders = purge_folders
+        self.assertTrue("Could not remove folder %s" % os.path.join(self.target, "M") in out,
+                        out)
+        self.assertEqual(_list_files(self.target),
+                         [os.path.join(*p.split("/")) for p in (
+                             "A/Folder.jpg", "A/a.mp3", "M/new.txt", "R/notes.txt")])
+        self.assertEqual(sorted(os.listdir(self.target)), ["A", "M", "R"])
+        self.assertEqual(os.listdir(os.path.join(self.target, "R")), ["notes.txt"])
+
+    def test_non_ascii_folder_keys(self):
+        opts = self.make_opts()
+        old_folder = wplsync._native_path(u"Bj\xf6rk (old)")
+        os.makedirs(os.path.join(self.target, old_folder))
+        folder_map = {"": wplsync.FolderInfo(folder_count=1),
+                      old_folder: wplsync.FolderInfo()}
+        rel_path = u"Bj\xf6rk/2.mp3"
+        ops = [("COPY", rel_path, os.path.join(self.source, rel_path),
+                os.path.join(self.target, rel_path))]
+        self.assertEqual(wplsync.make_target_folders(opts, ops, folder_map), 1)
+        wplsync.update_folder_map(opts, folder_map, ops)
+        # Folders of unicode rel_paths are recorded like scanned folders
+        new_folder = wplsync._native_path(u"Bj\xf6rk")
+        self.assertEqual(sorted(folder_map), ["", new_folder, old_folder])
+        self.assertTrue(all(isinstance(key, str) for key in folder_map))
+        self.assertEqual(folder_map[new_folder].media_count, 1)
+        # Purge the empty folder and keep the new one
+        target_map = {"root_folder": self.target, "file_list": [rel_path],
+                      "folder_map": folder_map}
+        wplsync.purge_folders(opts, target_map)
+        self.assertEqual(sorted(folder_map), ["", new_folder])
+        self.assertEqual(os.listdir(self.target), [new_folder])
+
+
+class WatchTest(SyncTestCase):
+    def test_rejected_options(self):
+        for args in (["--max-size", "1M"], ["--link-duplicates"]):
+            self.assertRaises(SystemExit, self.run_wplsync, "--watch", *args)
+            self.assertTrue("--watch cannot be combined with %s" % args[0] in self.output,
+                            self.output)
+
+    def test_changes_exceeding_free_space(self):
+        opts = self.make_opts()
+        opts.playlist_paths = []
+        changes = set()
+        for name in ("a.mp3", "b.mp3", "c.mp3"):
+            _write(os.path.join(self.source, name), b"x" * 1000)
+            changes.add(os.path.join(self.source, name))
+        _write(os.path.join(self.target, "c.mp3"), b"y" * 1000)
+        _set_mtime(os.path.join(self.target, "c.mp3"), int(time.time()) - 100)
+        # a.mp3 fits, b.mp3 doesn't, the update of c.mp3 needs no space
+        get_disk_usage = wplsync.get_disk_usage
+        wplsync.get_disk_usage = lambda folder: (1600, 100)
+        err = StringIO()
+        saved = sys.stderr
+        sys.stderr = err
+        try:
+            wplsync.sync_changed_paths(opts, {}, changes, None)
+        finally:
+            wplsync.get_disk_usage = get_disk_usage
+            sys.stderr = saved
+        self.assertEqual(_list_files(self.target), ["a.mp3", "c.mp3"])
+        self.assertEqual(_read(os.path.join(self.target, "c.mp3")), b"x" * 1000)
+        self.assertTrue("skipping 1 files" in err.getvalue(), err.getvalue())
+
+
+if __name__ == "__main__":
+    unittest.main()
@@ -9,7 +9,6 @@ http://lifehacker.com/231476/alpha-geek-whip-your-mp3-library-into-shape-part-ii
 
 TODO:
 - check max path length 256
-- print and check max size (16GB)
 - sync Album Art "Folder.jpg" or "AlbumArtSmall.jpg". 
   ??? Also display album "AlbumArt_WMID_Large.jpg" or "AlbumArt_WMID_Small.jpg"
 - '-i' ignore errors
@@ -18,14 +17,55 @@ TODO:
 Project home: http://wplsync.googlecode.com/  
 """
 from optparse import OptionParser
+from contextlib import contextmanager
+import copy
 import os
-from fnmatch import fnmatch
+from fnmatch import translate
+import re
 from xml.etree import ElementTree as ET
 from _version import __version__
 import filecmp
+import cProfile
+import gzip
+import ctypes
+import ctypes.util
+import hashlib
+import json
+import multiprocessing
+import pstats
+import random
+import select
+import shlex
 import shutil
+import sqlite3
+import stat
+import struct
+import subprocess
 import time
 import sys
+import threading
+import zlib
+from Queue import Queue, Empty
+from urllib import url2pathname
+import errno
+import codecs
+try:
+    import fcntl
+except ImportError:
+    fcntl = None # Windows
+try:
+    from os import scandir
+except ImportError:
+    try:
+        from scandir import scandir # https://pypi.python.org/pypi/scandir
+    except ImportError:
+        scandir = None
+
+# Encoding of native file names on Python 2 (like Python 3.7+, UTF-8 is
+# assumed if the locale only defines ASCII)
+FS_ENCODING = sys.getfilesystemencoding() or "utf-8"
+if codecs.lookup(FS_ENCODING).name == "ascii":
+    FS_ENCODING = "utf-8"
 
 
 DEFAULT_OPTS = {
@@ -53,23 +93,285 @@ DEFAULT_OPTS = {
     "transient_file_patterns": [".DS_Store",
                                 "desktop.ini",
                                 "Thumbs.db",
+                                "*.wplsync-tmp",
                                 ],
+    # Number of parallel copy workers by device class. If source and target
+    # are of different classes, the smaller number is used.
+    "copy_jobs": {"hdd": 2,
+                  "ssd": 8,
+                  "flash": 2,
+                  "network": 4,
+                  },
 }
 
+# Suffix of files that are being copied
+TEMP_FILE_SUFFIX = ".wplsync-tmp"
+
+# Copy mechanisms in order of preference. 'buffered' is always available.
+COPY_METHODS = ("reflink", "copy_file_range", "sendfile", "buffered")
+# Buffer size for 'buffered' copies
+COPY_BUFFER_SIZE = 1024 * 1024
+# ioctl request to clone a file on Linux (btrfs, XFS, ...)
+FICLONE = 0x40049409
+
+# Files are hashed in chunks of this size
+DIGEST_READ_CHUNK = 1024 * 1024
+
+# Block size and maximum ratio of changed bytes for delta updates (`--delta`)
+DELTA_BLOCK_SIZE = 64 * 1024
+DELTA_MAX_RATIO = 0.5
+
+# Text playlists (M3U, PLS) are read in chunks of this size
+PLAYLIST_READ_CHUNK = 1024 * 1024
+
+# Modification times that differ less than this are considered equal.
+# (shutil.copy2 does not preserve sub-microsecond precision and FAT file systems
+# only have a 2 sec. resolution.)
+MTIME_TOLERANCE = 2.0
+
+# Subfolder of STATE_DIR that stores transformed files (`--transform`)
+TRANSFORM_CACHE_FOLDER = "transform-cache"
+# Maximum time to wait for a single transform (seconds)
+TRANSFORM_TIMEOUT = 24 * 60 * 60
+
+# Number of functions listed by `--profile`
+PROFILE_TOP_COUNT = 30
+
+# Target manifest (`--manifest`), stored in the target root folder
+MANIFEST_FILE_NAME = ".wplsync-manifest"
+# Number of random folders and files that are stat'ed before a manifest is trusted
+MANIFEST_SAMPLE_SIZE = 32
+# The manifest file gets the root folder's mtime (which is set with a precision
+# of microseconds only)
+MANIFEST_MTIME_TOLERANCE = 0.001
+
+# `--watch`: changes are synced after the source was quiet for this many
+# seconds. Without inotify, the source is polled in this interval.
+WATCH_DEBOUNCE = 2.0
+WATCH_POLL_INTERVAL = 5.0
+
+# inotify event masks (see <sys/inotify.h>)
+IN_ATTRIB = 0x00000004
+IN_CLOSE_WRITE = 0x00000008
+IN_MOVED_FROM = 0x00000040
+IN_MOVED_TO = 0x00000080
+IN_CREATE = 0x00000100
+IN_DELETE = 0x00000200
+IN_DELETE_SELF = 0x00000400
+IN_MOVE_SELF = 0x00000800
+IN_Q_OVERFLOW = 0x00004000
+IN_IGNORED = 0x00008000
+IN_ONLYDIR = 0x01000000
+IN_DONT_FOLLOW = 0x02000000
+IN_ISDIR = 0x40000000
+INOTIFY_MASK = (IN_ATTRIB | IN_CLOSE_WRITE | IN_MOVED_FROM | IN_MOVED_TO | IN_CREATE
+                | IN_DELETE | IN_DELETE_SELF | IN_MOVE_SELF)
+INOTIFY_BUFFER_SIZE = 64 * 1024
+
 SYNC_FILE_PATTERNS = DEFAULT_OPTS["media_file_patterns"] + DEFAULT_OPTS["copy_file_patterns"]
 PURGE_FILE_PATTERNS = DEFAULT_OPTS["transient_file_patterns"] + DEFAULT_OPTS["copy_file_patterns"]
 
+def create_copy_stats():
+    res = {"copy_count": 0, # files copied completely
+           "copy_bytes": 0,
+           "copy_methods": {}, # key: copy method, value: number of files
+           "delta_count": 0, # files updated using `--delta`
+           "delta_bytes": 0, # bytes written by delta updates
+           "delta_saved_bytes": 0, # bytes not written by delta updates
+           "link_count": 0, # duplicate files linked using `--link-duplicates`
+           "link_bytes": 0, # bytes not written because of links
+           "link_methods": {}, # key: link method, value: number of files
+          }
+    return res
+
+
+class RunMetrics(object):
+    """Wall and CPU time of the processing phases and counters of a run.
+
+    Phases are timed using `with metrics.phase("copy") as ph:`; the yielded
+    dict may be used to record the number of 'files' and 'bytes' that were
+    processed, so the throughput can be reported.
+    CPU time is measured for the whole process, so the CPU times of phases
+    that run concurrently (source and target scan) overlap.
+    Counters are incremented using `metrics.count(name, n)`.
+    All methods are thread-safe.
+    """
+    def __init__(self):
+        self.lock = threading.Lock()
+        self.start_time = time.time()
+        self.start_cpu = self._cpu_time()
+        self.phase_order = []
+        self.phases = {}
+        self.counters = {}
+
+    @staticmethod
+    def _cpu_time():
+        t = os.times()
+        return t[0] + t[1]
+
+    @contextmanager
+    def phase(self, name):
+        with self.lock:
+            if name not in self.phases:
+                self.phase_order.append(name)
+                self.phases[name] = {"wall": 0.0, "cpu": 0.0, "files": 0, "bytes": 0}
+        data = {"files": 0, "bytes": 0}
+        start, start_cpu = time.time(), self._cpu_time()
+        try:
+            yield data
+        finally:
+            with self.lock:
+                ph = self.phases[name]
+                ph["wall"] += time.time() - start
+                ph["cpu"] += self._cpu_time() - start_cpu
+                ph["files"] += data["files"]
+                ph["bytes"] += data["bytes"]
+
+    def count(self, name, n=1):
+        with self.lock:
+            self.counters[name] = self.counters.get(name, 0) + n
+
+    def to_dict(self):
+        """Return all metrics as a JSON serializable dictionary."""
+        with self.lock:
+            phases = []
+            for name in self.phase_order:
+                ph = dict(self.phases[name], name=name)
+                if ph["wall"] > 0 and ph["files"]:
+                    ph["files_per_sec"] = ph["files"] / ph["wall"]
+                if ph["wall"] > 0 and ph["bytes"]:
+                    ph["bytes_per_sec"] = ph["bytes"] / ph["wall"]
+                phases.append(ph)
+            return {"version": __version__,
+                    "wall": time.time() - self.start_time,
+                    "cpu": self._cpu_time() - self.start_cpu,
+                    "phases": phases,
+                    "counters": dict(self.counters),
+                    }
+
+    def write_json(self, path, **extra):
+        res = self.to_dict()
+        res.update(extra)
+        with open(path, "w") as f:
+            json.dump(res, f, indent=2, sort_keys=True)
+        return
+
+    def print_summary(self):
+        res = self.to_dict()
+        for ph in res["phases"]:
+            line = "    %-16s %8.2f sec. wall, %8.2f sec. CPU" % (ph["name"], ph["wall"], ph["cpu"])
+            if "bytes_per_sec" in ph:
+                line += ", %s/sec." % format_size(ph["bytes_per_sec"])
+            elif "files_per_sec" in ph:
+                line += ", %.0f files/sec." % ph["files_per_sec"]
+            print line
+        return
+
+
+class FileInfo(object):
+    """Compact record of a synchronized file.
+
+    Uses __slots__ instead of a per-instance dict. Only the path relative to
+    the (shared) root folder is stored; the absolute path is derived on access.
+    """
+    __slots__ = ("root_folder", "rel_path", "size", "mtime")
+
+    def __init__(self, root_folder, rel_path, size, mtime):
+        self.root_folder = root_folder
+        self.rel_path = rel_path
+        self.size = size
+        self.mtime = mtime
+
+    def __repr__(self):
+        return "FileInfo(%r, %r, %r, %r)" % (self.root_folder, self.rel_path,
+                                             self.size, self.mtime)
+
+    @property
+    def fspec(self):
+        res = os.path.join(self.root_folder, self.rel_path)
+        if self.rel_path.startswith(os.pardir):
+            # External file (`--allow-externals`)
+            res = os.path.normpath(res)
+        return res
+
+
+class FolderInfo(object):
+    """Contents of a scanned folder, used to find target folders to purge.
+
+    Media files (synced files that are not copy-only) are counted. Copy-only
+    and transient files are recorded by name, since they are deleted when the
+    folder is purged, as are other files (neither synced nor transient), so
+    they can be written to the target manifest.
+    `mtime` is the folder's mtime (if it was stat'ed), or None if the folder
+    was changed by this run.
+    """
+    __slots__ = ("media_count", "other_names", "purge_names", "folder_count", "mtime")
+
+    def __init__(self, folder_count=0, mtime=None):
+        self.media_count = 0
+        self.other_names = []
+        self.purge_names = []
+        self.folder_count = folder_count # number of sub folders
+        self.mtime = mtime
+
+    def __repr__(self):
+        return "FolderInfo(media=%r, other=%r, purge=%r, folders=%r)" % (
+            self.media_count, self.other_names, self.purge_names, self.folder_count)
+
+    def add_file(self, opts, name):
+        if opts.purge_matcher.match(name):
+            self.purge_names.append(name)
+        elif opts.sync_matcher.match(name):
+            self.media_count += 1
+        else:
+            self.other_names.append(name)
+
+    def remove_file(self, opts, name):
+        if opts.purge_matcher.match(name):
+            if name in self.purge_names:
+                self.purge_names.remove(name)
+        elif opts.sync_matcher.match(name):
+            self.media_count -= 1
+        elif name in self.other_names:
+            self.other_names.remove(name)
+
+    def can_purge(self):
+        """Return True if the folder only contains copy-only and transient files."""
+        return not (self.media_count or self.other_names or self.folder_count)
+
+
+class TransformedFileInfo(FileInfo):
+    """Record of a source file that was transformed (see `--transform`).
+
+    `rel_path` and `size` describe the transformed file, which is stored at
+    `fspec` in the transform cache.
+    """
+    __slots__ = ("cache_fspec", "source_fspec")
+
+    def __init__(self, root_folder, rel_path, size, mtime, cache_fspec, source_fspec):
+        FileInfo.__init__(self, root_folder, rel_path, size, mtime)
+        self.cache_fspec = cache_fspec
+        self.source_fspec = source_fspec
+
+    @property
+    def fspec(self):
+        return self.cache_fspec
+
+
 def create_info_dict():
     res = {"root_folder": None,
            "file_list": [], # relative paths, ordered by scan occurence
-           "file_map": {}, # key: rel_path, value: info_dict
-           "folder_map": {}, # key: re_path, value: True
+           "file_map": {}, # key: rel_path, value: FileInfo
+           "folder_map": {}, # key: rel_path of scanned or created folders ('' = root), value: FolderInfo
            "byte_count": 0,
            "ext_map": {},
 #           "unhandled_ext_map": {},
            "error_files": [],
-           "skip_count": 0,
-           "process_count": 0,
+           "skip_map": {}, # key: rel_path of skipped files, value: True if missing
+           "playlist_map": {}, # key: playlist path, value: list of rel_paths
+           "skip_count": 0, # unique files that are not synced
+           "process_count": 0, # unique files
+           "reference_count": 0, # files including duplicate references
            "error_count": 0
           }
     return res
@@ -80,6 +382,41 @@ def canonical_path(p):
     return res
 
 
+def parse_size(s):
+    """Convert a size like '16G', '700M', '1.5T', or '1000' to bytes."""
+    s = s.strip().upper().rstrip("B")
+    factor = 1
+    if s and s[-1] in "KMGT":
+        factor = 1024 ** ("KMGT".index(s[-1]) + 1)
+        s = s[:-1]
+    return int(float(s) * factor)
+
+
+def format_size(n):
+    """Return a human readable string for a byte count."""
+    for unit in ("bytes", "kB", "MB", "GB"):
+        if abs(n) < 1024:
+            break
+        n /= 1024.0
+    else:
+        unit = "TB"
+    if unit == "bytes":
+        return "%d %s" % (n, unit)
+    return "%.1f %s" % (n, unit)
+
+
+def get_disk_usage(folder):
+    """Return (free_bytes, block_size) for the file system containing folder."""
+    if hasattr(os, "statvfs"):
+        st = os.statvfs(folder)
+        return st.f_bavail * st.f_frsize, st.f_frsize or 4096
+    import ctypes
+    free_bytes = ctypes.c_ulonglong(0)
+    ctypes.windll.kernel32.GetDiskFreeSpaceExW(ctypes.c_wchar_p(folder), None, None,
+                                               ctypes.pointer(free_bytes))
+    return free_bytes.value, 4096
+
+
 def check_path_independent(p1, p2):
     """Return True if p1 and p2 don't overlap."""
     p1 = canonical_path(p1) + "/"
@@ -87,12 +424,70 @@ def check_path_independent(p1, p2):
     return not (p1.startswith(p2) or p2.startswith(p1)) 
 
 
-def match_pattern(fspec, patterns):
-    """Return True, if fspec matches at least on pattern in the list."""
-    for pat in patterns:
-        if fnmatch(fspec, pat):
-            return True
-    return False
+class PatternMatcher(object):
+    """Test file names against a list of fnmatch patterns.
+
+    Simple '*.ext' patterns are looked up in a set of extensions, all other
+    patterns are combined into a single regular expression, so the cost per
+    file does not grow with the number of patterns.
+    Like fnmatch, matching is case insensitive only on case insensitive
+    platforms.
+    """
+    def __init__(self, patterns, exclude_patterns=None):
+        self.ext_set = set()
+        regex_parts = []
+        for pat in patterns:
+            pat = os.path.normcase(pat)
+            ext = pat[1:]
+            if pat.startswith("*.") and not re.search(r"[*?\[.]", ext[1:]):
+                self.ext_set.add(ext)
+            else:
+                regex_parts.append(self._translate(pat))
+        self.regex = None
+        if regex_parts:
+            self.regex = re.compile("|".join(regex_parts), re.S)
+        self.exclude = None
+        if exclude_patterns:
+            self.exclude = PatternMatcher(exclude_patterns)
+
+    @staticmethod
+    def _translate(pat):
+        # Python 2 appends global flags '(?ms)', which must not be repeated
+        res = translate(pat)
+        if res.endswith("(?ms)"):
+            res = res[:-5]
+        return "(?:%s)" % res
+
+    def match(self, filename):
+        """Return True, if filename matches at least one pattern (and no exclude pattern)."""
+        filename = os.path.normcase(filename)
+        i = filename.rfind(".")
+        if i >= 0 and filename[i:] in self.ext_set:
+            found = True
+        else:
+            found = self.regex is not None and self.regex.match(filename) is not None
+        if found and self.exclude is not None:
+            return not self.exclude.match(filename)
+        return found
+
+
+def init_options(opts):
+    """Add derived attributes to opts, e.g. compiled pattern matchers.
+
+    Must be called once after the options have been parsed.
+    """
+    opts.transform_rules = dict(parse_transform_rule(rule) for rule in opts.transform)
+    # Sync files that are transformed (e.g. '*.flac'), even if not listed as media files
+    transform_patterns = ["*" + ext for ext in sorted(opts.transform_rules.keys())]
+    opts.sync_matcher = PatternMatcher(SYNC_FILE_PATTERNS + opts.include_patterns
+                                       + transform_patterns,
+                                       opts.exclude_patterns)
+    # Files that are synced as they are, if they are not transformed
+    opts.plain_sync_matcher = PatternMatcher(SYNC_FILE_PATTERNS + opts.include_patterns,
+                                             opts.exclude_patterns)
+    opts.purge_matcher = PatternMatcher(PURGE_FILE_PATTERNS)
+    opts.metrics = RunMetrics()
+    return opts
 
     
 def copy_file(opts, src, dest):
@@ -101,11 +496,294 @@ def copy_file(opts, src, dest):
 
 #    if opts.verbose >= 2:
 #        print 'Copy: %s' % dest
-    dir = os.path.dirname(dest)
     if not opts.dry_run:
-        if not os.path.exists(dir):
-            os.makedirs(dir)
-        shutil.copy2(src, dest)
+        # (The target folder was created by `make_target_folders()`)
+        # Copy to a temp file first, so the target never contains partial files
+        tmp = dest + TEMP_FILE_SUFFIX
+        method = copy_file_data(opts, src, tmp)
+        shutil.copystat(src, tmp)
+        _replace_file(tmp, dest)
+        return method
+    return None
+
+
+def copy_file_multi(opts, src, dests):
+    """Copy src to multiple destinations (e.g. on different devices), reading
+    it only once.
+
+    Return the copy method ('fanout' if there is more than one destination).
+    """
+    if len(dests) == 1:
+        return copy_file(opts, src, dests[0])
+    assert os.path.isfile(src)
+    for dest in dests:
+        assert not dest.startswith(opts.source_folder) # Never change the source folder
+    if opts.dry_run:
+        return None
+    tmps = []
+    files = []
+    try:
+        with open(src, "rb") as fsrc:
+            for dest in dests:
+                tmps.append(dest + TEMP_FILE_SUFFIX)
+                files.append(open(tmps[-1], "wb"))
+            while True:
+                buf = fsrc.read(COPY_BUFFER_SIZE)
+                if not buf:
+                    break
+                for f in files:
+                    f.write(buf)
+    finally:
+        for f in files:
+            f.close()
+    for tmp, dest in zip(tmps, dests):
+        shutil.copystat(src, tmp)
+        _replace_file(tmp, dest)
+    return "fanout"
+
+
+def link_file(opts, link_src, src, dest):
+    """Create dest as a hardlink of link_src, an identical file in the target.
+
+    If the target file system doesn't support hardlinks (e.g. FAT), dest is
+    created as a reflink of link_src, if possible, else copied from the
+    source file src. The file stats are always taken from src.
+    Return the method that was used ('hardlink' or a copy method).
+    """
+    assert not dest.startswith(opts.source_folder) # Never change the source folder
+    if opts.dry_run:
+        return None
+    tmp = dest + TEMP_FILE_SUFFIX
+    if os.path.lexists(tmp):
+        os.remove(tmp) # Left over by an interrupted run
+    dev = os.stat(link_src).st_dev
+    if hasattr(os, "link") and ("hardlink", dev, dev) not in _unsupported_copy_methods:
+        try:
+            os.link(link_src, tmp)
+            _replace_file(tmp, dest)
+            return "hardlink"
+        except OSError as e:
+            if e.errno not in _LINK_FALLBACK_ERRNOS:
+                raise
+            if e.errno != errno.EMLINK: # (Only this file has too many links)
+                _unsupported_copy_methods.add(("hardlink", dev, dev))
+            if os.path.lexists(tmp):
+                os.remove(tmp)
+    if "reflink" in get_copy_methods(opts) and _reflink_file(link_src, tmp):
+        method = "reflink"
+    else:
+        method = copy_file_data(opts, src, tmp)
+    shutil.copystat(src, tmp)
+    _replace_file(tmp, dest)
+    return method
+
+
+def target_supports_hardlinks(opts):
+    """Return True if `link_file()` can create hardlinks in the target folder.
+
+    This is tested once per device with a temp file (in dry-run mode,
+    hardlinks are assumed to work).
+    """
+    if not hasattr(os, "link"):
+        return False
+    dev = os.stat(opts.target_folder).st_dev
+    if ("hardlink", dev, dev) in _unsupported_copy_methods:
+        return False
+    if opts.dry_run:
+        return True
+    probe = os.path.join(opts.target_folder, ".wplsync-linktest" + TEMP_FILE_SUFFIX)
+    probe_link = probe + TEMP_FILE_SUFFIX
+    try:
+        open(probe, "wb").close()
+        os.link(probe, probe_link)
+    except OSError as e:
+        if e.errno not in _LINK_FALLBACK_ERRNOS:
+            raise
+        _unsupported_copy_methods.add(("hardlink", dev, dev))
+        return False
+    finally:
+        for fspec in (probe, probe_link):
+            if os.path.lexists(fspec):
+                os.remove(fspec)
+    return True
+
+
+def make_target_folders(opts, ops, folder_map=None):
+    """Create the target folders of all (action, rel_path, src, dest) operations.
+
+    Folders are created in one batch, parents first, so copies, links and
+    moves can assume that their target folder exists.
+    `folder_map` holds the folders that are known to exist in the target
+    (see `create_info_dict()`) and is updated. Without it, every folder is
+    checked once.
+    Return the number of created folders.
+    """
+    needed = set()
+    for op in ops:
+        if op[0] == "DELETE":
+            continue
+        # Keys must have the type of the scanned names (see `_native_path()`)
+        rel_folder = _native_path(os.path.dirname(op[1]))
+        while (rel_folder and rel_folder not in needed
+               and not (folder_map and rel_folder in folder_map)):
+            needed.add(rel_folder)
+            rel_folder = os.path.dirname(rel_folder)
+    created = 0
+    # Parents sort before their sub folders
+    for rel_folder in sorted(needed):
+        folder = os.path.join(opts.target_folder, rel_folder)
+        if folder_map is None and os.path.isdir(folder):
+            continue
+        if opts.verbose >= 3:
+            print "Create folder %s" % folder
+        if not opts.dry_run:
+            try:
+                os.mkdir(folder)
+            except OSError as e:
+                # Not scanned (e.g. outside the target for `--allow-externals`)
+                if e.errno != errno.EEXIST:
+                    raise
+        created += 1
+        if folder_map is not None:
+            folder_map[rel_folder] = FolderInfo()
+            parent = folder_map.get(os.path.dirname(rel_folder))
+            if parent:
+                parent.folder_count += 1
+                parent.mtime = None
+    return created
+
+
+def update_folder_map(opts, folder_map, ops):
+    """Record the effect of executed (action, rel_path, src, dest) operations
+    in `folder_map` (see `make_target_folders()`).
+
+    Touched folders get an unknown mtime (even updates replace the file).
+    """
+    for action, rel_path, src, _dest in ops:
+        if action in ("DELETE", "MOVE"):
+            if action == "MOVE":
+                old_rel_path = os.path.relpath(src, opts.target_folder)
+            else:
+                old_rel_path = rel_path
+            folder = folder_map.get(_native_path(os.path.dirname(old_rel_path)))
+            if folder:
+                folder.remove_file(opts, os.path.basename(old_rel_path))
+                folder.mtime = None
+        if action != "DELETE":
+            folder = folder_map.get(_native_path(os.path.dirname(rel_path)))
+            if folder:
+                if action != "UPDATE":
+                    folder.add_file(opts, os.path.basename(rel_path))
+                folder.mtime = None
+    return
+
+
+# Errors that indicate that a copy method is not supported for a file pair
+_COPY_FALLBACK_ERRNOS = set(getattr(errno, name) for name in
+                            ("EXDEV", "EINVAL", "ENOSYS", "ENOTTY", "EOPNOTSUPP",
+                             "ENOTSUP", "EBADF")
+                            if hasattr(errno, name))
+# (method, src_device, dest_device) combinations that failed in this run
+_unsupported_copy_methods = set()
+# Errors that indicate that a file system doesn't support hardlinks
+_LINK_FALLBACK_ERRNOS = _COPY_FALLBACK_ERRNOS | set([errno.EPERM, errno.EMLINK])
+
+
+def get_copy_methods(opts):
+    """Return the list of copy methods to try, in order."""
+    if opts.copy_method == "auto":
+        methods = COPY_METHODS
+    else:
+        methods = (opts.copy_method, "buffered")
+    available = []
+    for method in methods:
+        if method == "reflink" and (fcntl is None or not sys.platform.startswith("linux")):
+            continue
+        elif method in ("copy_file_range", "sendfile") and not hasattr(os, method):
+            continue # Python 3.8+ / 3.3+
+        if method not in available:
+            available.append(method)
+    return available
+
+
+def copy_file_data(opts, src, dest):
+    """Copy file content from src to dest (without file stats).
+
+    The methods of `get_copy_methods()` are tried in order: reflinks share
+    the data blocks (copy-on-write), copy_file_range and sendfile copy
+    inside the kernel, without passing the data through user space.
+    Methods that fail for a pair of devices are not tried again in this run.
+    Return the name of the method that was used.
+    """
+    with open(src, "rb") as fsrc:
+        with open(dest, "wb") as fdst:
+            src_fd, dst_fd = fsrc.fileno(), fdst.fileno()
+            size = os.fstat(src_fd).st_size
+            devices = (os.fstat(src_fd).st_dev, os.fstat(dst_fd).st_dev)
+            for method in get_copy_methods(opts):
+                if (method, ) + devices in _unsupported_copy_methods:
+                    continue
+                try:
+                    if method == "reflink":
+                        fcntl.ioctl(dst_fd, FICLONE, src_fd)
+                    elif method == "copy_file_range":
+                        offset = 0
+                        while offset < size:
+                            n = os.copy_file_range(src_fd, dst_fd, size - offset)
+                            if n == 0:
+                                break
+                            offset += n
+                    elif method == "sendfile":
+                        offset = 0
+                        while offset < size:
+                            n = os.sendfile(dst_fd, src_fd, offset, size - offset)
+                            if n == 0:
+                                break
+                            offset += n
+                    else:
+                        shutil.copyfileobj(fsrc, fdst, COPY_BUFFER_SIZE)
+                    return method
+                except (IOError, OSError) as e:
+                    if method == "buffered" or e.errno not in _COPY_FALLBACK_ERRNOS:
+                        raise
+                    _unsupported_copy_methods.add((method, ) + devices)
+                    # Start over with the next method
+                    fsrc.seek(0)
+                    fdst.seek(0)
+                    fdst.truncate()
+    return None
+
+
+def _reflink_file(src, dest):
+    """Create dest as a reflink of src (see `copy_file_data()`).
+
+    Return False if reflinks are not supported for these files.
+    """
+    with open(src, "rb") as fsrc:
+        with open(dest, "wb") as fdst:
+            src_fd, dst_fd = fsrc.fileno(), fdst.fileno()
+            devices = (os.fstat(src_fd).st_dev, os.fstat(dst_fd).st_dev)
+            if ("reflink", ) + devices in _unsupported_copy_methods:
+                return False
+            try:
+                fcntl.ioctl(dst_fd, FICLONE, src_fd)
+            except (IOError, OSError) as e:
+                if e.errno not in _COPY_FALLBACK_ERRNOS:
+                    raise
+                _unsupported_copy_methods.add(("reflink", ) + devices)
+                return False
+    return True
+
+
+def _replace_file(src, dest):
+    """Rename src to dest, replacing an existing dest."""
+    if hasattr(os, "replace"):
+        os.replace(src, dest) # Python 3.3+
+    elif os.name == "nt" and os.path.exists(dest):
+        os.remove(dest)
+        os.rename(src, dest)
+    else:
+        os.rename(src, dest)
     return
 
         
@@ -119,70 +797,495 @@ def delete_file(opts, fspec):
         os.remove(fspec)
     return
 
+
+def get_copy_jobs(opts):
+    """Return the number of parallel copy workers for this run.
+
+    An explicit `--jobs` value wins; otherwise the number is derived from the
+    source and target device classes (default: 1 = sequential).
+    """
+    if opts.jobs:
+        return max(1, opts.jobs)
+    copy_jobs = DEFAULT_OPTS["copy_jobs"]
+    jobs = [copy_jobs[dc] for dc in (opts.source_device, opts.target_device) if dc]
+    if not jobs:
+        return 1
+    return min(jobs)
+
+
+def delta_update_file(opts, src, dest, digests):
+    """Update dest in place, writing only the blocks that differ from src.
+
+    Source and target are compared in blocks of DELTA_BLOCK_SIZE at the same
+    offsets, using cached block checksums for the target. This is efficient
+    for in-place edits like retagging a file with padded ID3v2 headers, but
+    not if data was inserted or removed.
+    Return the number of bytes written, or None if more than DELTA_MAX_RATIO
+    of the file changed (the caller should do a full copy then).
+    """
+    assert not dest.startswith(opts.source_folder) # Never change the source folder
+    if opts.dry_run:
+        return None
+    block_size = DELTA_BLOCK_SIZE
+    dest_st = os.stat(dest)
+    if dest_st.st_nlink > 1:
+        return None # Writing in place would also change other links
+    dest_sums = digests.get_block_sums(dest, dest_st.st_size, dest_st.st_mtime, block_size)
+    src_size = os.path.getsize(src)
+    # Pass 1: find changed blocks
+    src_sums = []
+    changed = []
+    with open(src, "rb") as f:
+        while True:
+            block = f.read(block_size)
+            if not block:
+                break
+            i = len(src_sums)
+            src_sums.append(block_checksum(block))
+            if i >= len(dest_sums) or dest_sums[i] != src_sums[i]:
+                changed.append(i)
+    changed_bytes = sum(min(block_size, src_size - i * block_size) for i in changed)
+    if changed_bytes > DELTA_MAX_RATIO * src_size:
+        return None
+    # Pass 2: write changed blocks and adjust the length
+    with open(src, "rb") as fsrc:
+        with open(dest, "r+b") as fdest:
+            for i in changed:
+                fsrc.seek(i * block_size)
+                fdest.seek(i * block_size)
+                fdest.write(fsrc.read(block_size))
+            fdest.truncate(src_size)
+    shutil.copystat(src, dest)
+    dest_st = os.stat(dest)
+    digests.put_block_sums(dest, dest_st.st_size, dest_st.st_mtime, block_size, src_sums)
+    return changed_bytes
+
+
+def run_file_ops(opts, file_ops, journal=None, digests=None):
+    """Execute a list of ('MOVE' or 'DELETE', rel_path, src, dest) operations."""
+    with opts.metrics.phase("delete_orphans") as ph:
+        for op in file_ops:
+            action, rel_path, src, dest = op
+            if action == "MOVE":
+                if opts.verbose >= 2:
+                    print 'MOVE: %s -> %s' % (os.path.relpath(src, opts.target_folder), rel_path)
+                move_file(opts, src, dest)
+                if digests and not opts.dry_run:
+                    st = os.stat(dest)
+                    digest = digests.get_cached(src, st.st_size, st.st_mtime)
+                    if digest:
+                        digests.put_digest(dest, st.st_size, st.st_mtime, digest)
+            else:
+                if opts.verbose >= 2:
+                    print 'DELETE: %s' % dest
+                delete_file(opts, dest)
+            ph["files"] += 1
+            if journal:
+                journal.mark_done(op)
+    return
+
+
+def run_copy_ops(opts, copy_ops, journal=None, digests=None):
+    """Execute a list of (action, rel_path, src, dest) copy operations.
+
+    Operations are distributed to a bounded pool of worker threads (see
+    `get_copy_jobs()`). The first error stops dispatching of pending
+    operations and is re-raised, after the running copies have finished.
+    Completed operations are recorded in the journal, if one is passed.
+    With `--delta`, updates are written using `delta_update_file()`.
+    Return a dictionary of copy statistics (see `create_copy_stats()`).
+    """
+    return run_fanout_copy_ops(opts, [(copy_ops, journal)], digests)[0]
+
+
+def run_fanout_copy_ops(opts, target_ops, digests=None):
+    """Execute the copy operations of one or more target folders.
+
+    `target_ops` is a list of (copy_ops, journal) tuples, one per target.
+    Operations of different targets that copy the same source file are
+    executed together, so the source file is read only once (see
+    `copy_file_multi()`); delta updates are always executed separately.
+    Return a list of copy statistics per target (see `run_copy_ops()`).
+    """
+    print_lock = threading.Lock()
+    all_stats = [create_copy_stats() for _ in target_ops]
+    # Lists of (target index, op) that copy the same source file
+    groups = []
+    group_map = {}
+    for i, (copy_ops, _journal) in enumerate(target_ops):
+        for op in copy_ops:
+            if op[0] == "UPDATE" and opts.delta and digests is not None:
+                groups.append([(i, op)])
+                continue
+            group = group_map.get(op[2])
+            if group is None:
+                group = group_map[op[2]] = []
+                groups.append(group)
+            group.append((i, op))
+    jobs = min(get_copy_jobs(opts), len(groups))
+
+    def _copy(group):
+        if opts.verbose >= 2:
+            with print_lock:
+                for _i, (action, rel_path, _src, dest) in group:
+                    if len(target_ops) > 1:
+                        print '%s: %s' % (action, dest)
+                    else:
+                        print '%s: %s' % (action, rel_path)
+        i, (action, rel_path, src, dest) = group[0]
+        stats = all_stats[i]
+        written = None
+        if action == "UPDATE" and opts.delta and digests is not None:
+            written = delta_update_file(opts, src, dest, digests)
+        if written is not None:
+            size = os.path.getsize(dest)
+            with print_lock:
+                stats["delta_count"] += 1
+                stats["delta_bytes"] += written
+                stats["delta_saved_bytes"] += size - written
+        else:
+            method = copy_file_multi(opts, src, [op[3] for _i, op in group])
+            if not opts.dry_run:
+                size = os.path.getsize(dest)
+                with print_lock:
+                    for i, _op in group:
+                        stats = all_stats[i]
+                        stats["copy_count"] += 1
+                        stats["copy_bytes"] += size
+                        methods = stats["copy_methods"]
+                        methods[method] = methods.get(method, 0) + 1
+        for i, op in group:
+            journal = target_ops[i][1]
+            if journal:
+                journal.mark_done(op)
+
+    with opts.metrics.phase("copy") as ph:
+        try:
+            _run_copy_jobs(_copy, groups, jobs)
+        finally:
+            for stats in all_stats:
+                ph["files"] += stats["copy_count"] + stats["delta_count"]
+                ph["bytes"] += stats["copy_bytes"] + stats["delta_bytes"]
+                for key in ("copy_count", "copy_bytes", "delta_count", "delta_bytes",
+                            "delta_saved_bytes"):
+                    opts.metrics.count(key, stats[key])
+                for method, n in stats["copy_methods"].items():
+                    opts.metrics.count("copy_method_" + method, n)
+    return all_stats
+
+
+def run_link_ops(opts, source_map, link_ops, stats, journal=None):
+    """Execute a list of (action, rel_path, link_src, dest) link operations.
+
+    link_src is an identical file in the target (see `find_duplicate_ops()`),
+    so the link operations must run after the copy operations.
+    Statistics are added to `stats` (see `create_copy_stats()`).
+    """
+    with opts.metrics.phase("link") as ph:
+        for op in link_ops:
+            action, rel_path, link_src, dest = op
+            if opts.verbose >= 2:
+                print 'LINK: %s -> %s' % (rel_path, os.path.relpath(link_src, opts.target_folder))
+            src_info = source_map["file_map"][rel_path]
+            method = link_file(opts, link_src, src_info.fspec, dest)
+            if not opts.dry_run:
+                stats["link_count"] += 1
+                stats["link_bytes"] += src_info.size
+                methods = stats["link_methods"]
+                methods[method] = methods.get(method, 0) + 1
+            ph["files"] += 1
+            if journal:
+                journal.mark_done(op)
+        opts.metrics.count("link_count", stats["link_count"])
+        opts.metrics.count("link_bytes", stats["link_bytes"])
+    return stats
+
+
+def _run_copy_jobs(copy_func, copy_ops, jobs):
+    """Call copy_func for all copy_ops, using a pool of `jobs` worker threads."""
+    if jobs <= 1:
+        for op in copy_ops:
+            copy_func(op)
+        return
+
+    errors = []
+    queue = Queue()
+    for op in copy_ops:
+        queue.put(op)
+
+    def _worker():
+        while not errors:
+            try:
+                op = queue.get_nowait()
+            except Empty:
+                return
+            try:
+                copy_func(op)
+            except Exception:
+                errors.append(sys.exc_info())
+
+    workers = [threading.Thread(target=_worker) for _ in range(jobs)]
+    for t in workers:
+        t.daemon = True
+        t.start()
+    try:
+        for t in workers:
+            # Join with timeout, so KeyboardInterrupt is still delivered
+            while t.is_alive():
+                t.join(0.1)
+    except KeyboardInterrupt:
+        # Let running copies finish, but don't start new ones
+        errors.append(sys.exc_info())
+        for t in workers:
+            t.join()
+    if errors:
+        exc_type, exc_value, exc_tb = errors[0]
+        raise exc_type, exc_value, exc_tb
+    return
+
         
+def _journal_str(s):
+    """Return a path as a string that round-trips through JSON.
+
+    On Python 2, paths are byte strings in any encoding. They are stored as
+    Latin-1, which maps every byte to one character (see `_native_str()`).
+    """
+    if isinstance(s, bytes):
+        return s.decode("latin-1")
+    return s
+
+
+def _native_str(s):
+    """Return a path that was stored by `_journal_str()` as a native string."""
+    if s is not None and not isinstance(s, str):
+        s = s.encode("latin-1") # Python 2: JSON returns unicode
+    return s
+
+
+class TransferJournal(object):
+    """Journal of planned and completed operations, stored in the target folder.
+
+    The journal starts with a header line and all planned operations, followed
+    by a 'done' line for every completed operation (one JSON object per line).
+    It is removed when the run completes; if it is still present on the next
+    run, that run was interrupted and may be continued with `--resume`.
+    """
+    FILE_NAME = ".wplsync-journal"
+
+    def __init__(self, path, header, ops):
+        self.path = path
+        self.header = header
+        self.ops = ops
+        self.op_ids = dict((op, i) for i, op in enumerate(ops))
+        self.done = set()
+        self.lock = threading.Lock()
+        self.fp = None
+        self.started_str = time.strftime("%Y-%m-%d %H:%M:%S",
+                                         time.localtime(header["started"]))
+
+    @property
+    def pending_ops(self):
+        return [op for i, op in enumerate(self.ops) if i not in self.done]
+
+    @classmethod
+    def get_path(cls, opts):
+        return os.path.join(opts.target_folder, cls.FILE_NAME)
+
+    @classmethod
+    def create(cls, opts, ops):
+        """Write a new journal for a list of planned operations."""
+        header = {"version": 1,
+                  "source_folder": opts.source_folder,
+                  "target_folder": opts.target_folder,
+                  "delete_orphans": opts.delete_orphans,
+                  "started": time.time(),
+                  }
+        self = cls(cls.get_path(opts), header, ops)
+        self.fp = open(self.path, "w")
+        rec = dict(header)
+        rec["source_folder"] = _journal_str(header["source_folder"])
+        rec["target_folder"] = _journal_str(header["target_folder"])
+        self.fp.write(json.dumps(rec) + "\n")
+        for op in ops:
+            self.fp.write(json.dumps({"op": [_journal_str(s) for s in op]}) + "\n")
+        self.fp.flush()
+        os.fsync(self.fp.fileno())
+        return self
+
+    @classmethod
+    def load(cls, opts):
+        """Return the journal of an interrupted run, or None."""
+        path = cls.get_path(opts)
+        if not os.path.isfile(path):
+            return None
+        header = None
+        ops = []
+        done = set()
+        with open(path, "r") as fp:
+            for line in fp:
+                try:
+                    rec = json.loads(line)
+                except ValueError:
+                    break # Last line may be incomplete
+                if header is None:
+                    header = rec
+                    for key in ("source_folder", "target_folder"):
+                        if key in header:
+                            header[key] = _native_str(header[key])
+                elif "op" in rec:
+                    ops.append(tuple(_native_str(s) for s in rec["op"]))
+                elif "done" in rec:
+                    done.add(rec["done"])
+        if header is None:
+            # Interrupted while the journal was created, i.e. before any
+            # operation was started
+            os.remove(path)
+            return None
+        if header.get("version") != 1:
+            raise ValueError("Invalid journal file: %r" % path)
+        if (header["source_folder"] != opts.source_folder
+            or header["target_folder"] != opts.target_folder):
+            raise ValueError("Journal %r was created for another SOURCE_FOLDER (%s)"
+                             % (path, header["source_folder"]))
+        self = cls(path, header, ops)
+        self.done = done
+        self.fp = open(path, "a")
+        return self
+
+    def mark_done(self, op):
+        with self.lock:
+            i = self.op_ids[op]
+            self.done.add(i)
+            self.fp.write(json.dumps({"done": i}) + "\n")
+            self.fp.flush()
+
+    def finish(self):
+        """Remove the journal after all operations have been completed."""
+        self.fp.close()
+        os.remove(self.path)
+
+    def remove_temp_files(self):
+        """Remove temp files that were left by interrupted copies."""
+        for action, _rel_path, _src, dest in self.pending_ops:
+            tmp = dest + TEMP_FILE_SUFFIX
+            if os.path.isfile(tmp):
+                os.remove(tmp)
+        return
+
+
+def _is_copied(src, dest):
+    """Return True if dest exists and has the same size and mtime as src."""
+    try:
+        src_st = os.stat(src)
+        dest_st = os.stat(dest)
+    except OSError:
+        return False
+    return (src_st.st_size == dest_st.st_size
+            and abs(src_st.st_mtime - dest_st.st_mtime) < MTIME_TOLERANCE)
+
+
+def move_file(opts, src, dest):
+    """Rename a target file (e.g. because it was moved in the source folder)."""
+    assert os.path.isfile(src)
+    assert opts.delete_orphans
+    assert not src.startswith(opts.source_folder) # Never change the source folder
+    assert not dest.startswith(opts.source_folder)
+    if not opts.dry_run:
+        os.rename(src, dest)
+    return
+
+
 def purge_folders(opts, target_map):
-    """Delete all child folders that are ampty or only contan transient files."""
+    """Delete all child folders that are ampty or only contan transient files.
+
+    Uses the folder contents that were recorded by the target scan and
+    updated by the sync (see `FolderInfo`), so the target is not read again.
+    """
     root_folder = target_map["root_folder"]
     assert os.path.isdir(root_folder)
     assert opts.delete_orphans
     assert not root_folder.startswith(opts.source_folder) # Never change the source folder
     if opts.verbose >= 1:
         print "Purge folders in %s ..." % root_folder
-    # visit 
 
     if len(target_map["file_list"]) == 0:
         print("The target folder does not contain media files. "
               "This could result in removing the complete root_folder; aborted.")
         return
 
-    purge_folders = []
-    for folder, subfolders, filenames in os.walk(root_folder):
-        # Check if this folder contains non-transient files
-        can_purge = True
-        for filename in filenames:
-            if not match_pattern(filename, PURGE_FILE_PATTERNS):
-                can_purge = False
-                break
-        # If ONLY transient files are found, remove them.        
-        if can_purge:
-            for filename in filenames:
-                fspec = os.path.join(folder, filename)
-                if match_pattern(filename, PURGE_FILE_PATTERNS):
-                    if opts.verbose >= 2:
-                        print "Purge transient file %s" % fspec
-                    delete_file(opts, fspec)
-            # Add this folder to the purge list.
-            # (We don't need to do this for parents, since os.removedirs will
-            # get them anyway.)
-            if len(subfolders) == 0:
-                purge_folders.append(folder)
-    # Now remove empty leaves and all parents (if they are empty then)
-    for folder in purge_folders:
+    folder_map = target_map["folder_map"]
+    # Sub folders sort after their parents, so visit them first
+    # (Keys are compared as native str, since unicode and non-ASCII byte
+    # strings can't be compared on Python 2)
+    for rel_folder in sorted(folder_map, key=_native_path, reverse=True):
+        if not rel_folder or not folder_map[rel_folder].can_purge():
+            continue # (Never the root folder)
+        folder = os.path.join(root_folder, rel_folder)
+        assert not folder.startswith(opts.source_folder) # Never change the source folder
+        # Only transient files are left: remove them
+        for filename in folder_map[rel_folder].purge_names:
+            fspec = os.path.join(folder, filename)
+            if opts.verbose >= 2:
+                print "Purge transient file %s" % fspec
+            if not opts.dry_run:
+                delete_file(opts, fspec)
         if opts.verbose >= 1:
             print "Remove empty folder %s" % folder
-        assert os.path.isdir(folder)
-        assert not folder.startswith(opts.source_folder) # Never change the source folder
         if not opts.dry_run:
-            os.removedirs(folder)
+            try:
+                os.rmdir(folder)
+            except OSError as e:
+                # Changed since the scan
+                if e.errno not in (errno.ENOTEMPTY, errno.EEXIST):
+                    raise
+                print >>sys.stderr, "Could not remove folder %s: %s" % (folder, e)
+                continue
+        del folder_map[rel_folder]
+        parent = folder_map.get(os.path.dirname(rel_folder))
+        if parent:
+            parent.folder_count -= 1
+            parent.mtime = None
     return
 
         
-def add_file_info(opts, info_dict, fspec):
-    """Append fspec to info_dict, if it is a valid media file."""
+def add_file_info(opts, info_dict, fspec, size=None, mtime=None, rel_path=None,
+                  missing=False):
+    """Append fspec to info_dict, if it is a valid media file.
+
+    If `size` and `mtime` are passed, the file is known to exist (e.g. from a
+    folder scan) and is not stat'ed again. If `missing` is True, the file is
+    known not to exist.
+    `rel_path` may be passed, if the path relative to the root folder is
+    already known.
+    Files that were added before (e.g. referenced by multiple playlists) are
+    only counted as another reference.
+    Return True, if the file was added.
+    """
     assert os.path.isabs(fspec)
-    info_dict["process_count"] += 1
+    info_dict["reference_count"] += 1
     # Get path relative to the synced folder
+    if rel_path is None:
+        rel_path = os.path.relpath(fspec, info_dict["root_folder"])
+    if rel_path in info_dict["file_map"] or rel_path in info_dict["skip_map"]:
+        return False
+    info_dict["process_count"] += 1
     ext = os.path.splitext(fspec)[-1].lower()
 
-    if not os.path.isfile(fspec):
+    if size is None and not missing:
+        try:
+            st = os.stat(fspec)
+        except OSError:
+            st = None
+        if st is not None and stat.S_ISREG(st.st_mode):
+            size, mtime = st.st_size, st.st_mtime
+    if size is None:
         # Playlist reference cannot be resolved
+        info_dict["skip_map"][rel_path] = True
         info_dict["skip_count"] += 1
         info_dict["error_count"] += 1
         if opts.verbose >= 1:
             print "File not found: '%s'" % fspec
         return False
-
-    rel_path = os.path.relpath(fspec, info_dict["root_folder"])
 #    rel_folder_path = os.path.dirname(rel_path)
 #    folder_path = os.path.dirname(fspec)
 #    is_media_file = match_pattern(fspec, DEFAULT_OPTS["media_file_patterns"])
@@ -197,10 +1300,11 @@ def add_file_info(opts, info_dict, fspec):
 
     # Skip files with unsupported extensions
 #    if not is_media_file and not is_copy_file:
-    if match_pattern(fspec, SYNC_FILE_PATTERNS):
+    if opts.sync_matcher.match(os.path.basename(fspec)):
         info_dict["ext_map"][ext] = False
     else:
         info_dict["ext_map"][ext] = True
+        info_dict["skip_map"][rel_path] = False
         info_dict["skip_count"] += 1
         if opts.verbose >= 3:
             print "Skipping %s" % fspec
@@ -208,150 +1312,2135 @@ def add_file_info(opts, info_dict, fspec):
 
     # Copy media files (and album art, ...)
     info_dict["file_list"].append(rel_path)
-    size = os.path.getsize(fspec)
-#        modified = os.path.getmtime(fspec)
-#        created = os.path.getctime(fspec)
-    info = {"fspec": fspec,
-            "rel_path": rel_path,
-            "size": size,
-#                "modified": modified,
-#                "created": created,
-            }
+    info = FileInfo(info_dict["root_folder"], rel_path, size, mtime)
     info_dict["file_map"][rel_path] = info
     info_dict["byte_count"] += size
     return True
 
 
-def read_folder_files(opts, folder_path):
-    if opts.verbose >= 1:
-        print 'Reading folder "%s" ...' % (folder_path, )
-    res = create_info_dict()
-    res["root_folder"] = folder_path
+class ScanIndex(object):
+    """Persistent index of folder contents, stored in an SQLite database.
 
-    for dirname, dirnames, filenames in os.walk(folder_path):
-        for filename in filenames:
-            fspec = os.path.join(dirname, filename)
-            add_file_info(opts, res, fspec)
-    return res
+    For every scanned folder, the folder's mtime, its sub folders and the
+    (name, size, mtime) of its files are recorded.
+    A folder's mtime changes whenever entries are added, removed, or renamed,
+    so if it did not move since the last scan, the recorded entries can be
+    used instead of listing and stat'ing the folder again.
+    Note that files that are modified in place (without changing the folder)
+    are not detected for unchanged folders (see `--refresh-index`).
+    """
+    # Folders that were modified less than this many seconds before the scan
+    # are not trusted (mtime resolution may be as coarse as 2 sec. on FAT)
+    MTIME_GRACE = 2.0
 
+    def __init__(self, db_path):
+        self.db_path = db_path
+        self.db = sqlite3.connect(db_path, timeout=60)
+        self.db.text_factory = str
+        self.db.executescript("""
+            CREATE TABLE IF NOT EXISTS folders (
+                path TEXT PRIMARY KEY, parent TEXT, mtime REAL);
+            CREATE INDEX IF NOT EXISTS folders_parent ON folders (parent);
+            CREATE TABLE IF NOT EXISTS files (
+                folder TEXT, name TEXT, size INTEGER, mtime REAL,
+                PRIMARY KEY (folder, name));
+            """)
+        self.scan_time = time.time()
 
-def read_playlist_wpl(opts, playlist_path, info):
-    """Read a WPL playlist and add file info to dictionary."""
-    # TODO: this assert may be removed
-    assert playlist_path.startswith(opts.source_folder)
-    assert os.path.isabs(playlist_path)
-    
-    if opts.verbose >= 1:
-        print 'Parsing playlist "%s" ...' % (playlist_path, )
-    tree = ET.parse(playlist_path)
-    
-    try:
-        generator  = tree.find("head/meta[@name='Generator']").attrib["content"]
-    except SyntaxError:
-        generator  = None # requires ElementTree 1.3+
-    title = tree.find('head/title').text
-    if opts.verbose >= 1:
-        print 'Scanning playlist "%s" (%s)...' % (title, generator)
-    playlist_folder = os.path.dirname(playlist_path)
-    for media in tree.find("body/seq"):
-        fspec = media.attrib["src"]
-        # If the fspec was given relative, it is relative to the playlist
-        if not os.path.isabs(fspec):
-            fspec = os.path.join(playlist_folder, fspec)
-            fspec = canonical_path(fspec)
-        add_file_info(opts, info, fspec)
-    # TODO: faster sequential approach:
-    # iparse = ET.iterparse(playlist_path, ["end", ])
-    # for event, elem in iparse:
-    #     if event == "end" and elem.tag == "media":
-    #         print elem.attrib["src"]
-    return
+    def close(self):
+        self.db.commit()
+        self.db.close()
 
+    def get_folder(self, path, mtime):
+        """Return (files, subfolders) if path is unchanged since last scan, else None."""
+        row = self.db.execute("SELECT mtime FROM folders WHERE path=?", (path, )).fetchone()
+        if row is None or row[0] is None or row[0] != mtime:
+            return None
+        files = self.db.execute("SELECT name, size, mtime FROM files WHERE folder=?",
+                                (path, )).fetchall()
+        subfolders = [r[0] for r in self.db.execute("SELECT path FROM folders WHERE parent=?",
+                                                    (path, ))]
+        return files, subfolders
 
-def read_source_files(opts):
-    """Read source files (either complete folder or using given playlists)."""
-    if len(opts.playlist_paths) == 0:
-        return read_folder_files(opts, opts.source_folder)
-    res = create_info_dict()
-    res["root_folder"] = opts.source_folder
-    for pl in opts.playlist_paths:
-        ext = os.path.splitext(pl).lowercase()
-        if ext == "wpl":
-            read_playlist_wpl(opts, pl, res)
-        else:
-            raise NotImplementedError("Unsupported playlist extension: %r" % ext)
-    return res
+    def put_folder(self, path, parent, mtime, files, subfolders):
+        """Store current contents of a folder, replacing the previous entries."""
+        if self.scan_time - mtime < self.MTIME_GRACE:
+            mtime = None
+        db = self.db
+        db.execute("INSERT OR REPLACE INTO folders (path, parent, mtime) VALUES (?, ?, ?)",
+                   (path, parent, mtime))
+        db.execute("DELETE FROM files WHERE folder=?", (path, ))
+        db.executemany("INSERT INTO files (folder, name, size, mtime) VALUES (?, ?, ?, ?)",
+                       [(path, name, size, fmtime) for name, size, fmtime in files])
+        # Forget sub folders that have been removed (including their descendants)
+        stale = [r[0] for r in db.execute("SELECT path FROM folders WHERE parent=?", (path, ))
+                 if r[0] not in subfolders]
+        while stale:
+            p = stale.pop()
+            stale.extend(r[0] for r in db.execute("SELECT path FROM folders WHERE parent=?", (p, )))
+            db.execute("DELETE FROM folders WHERE path=?", (p, ))
+            db.execute("DELETE FROM files WHERE folder=?", (p, ))
+        for sub in subfolders:
+            db.execute("INSERT OR IGNORE INTO folders (path, parent, mtime) VALUES (?, ?, NULL)",
+                       (sub, path))
 
+    def invalidate_folders(self, paths):
+        """Force a re-scan of the given folders on the next run."""
+        self.db.executemany("UPDATE folders SET mtime=NULL WHERE path=?",
+                            [(p, ) for p in paths])
 
-def sync_file_lists(opts, source_map, target_map):
-    """Unify leading spaces and tabs and strip trailing whitespace.
-    
+
+def open_scan_index(opts, root_folder):
+    """Return a ScanIndex instance if `--index` was passed, else None.
+
+    Every root folder gets its own database, so source and target can be
+    scanned concurrently without locking each other.
     """
-    # Pass 1: find and delete orphans
-    # (before copying, so target space will be freed up)
-#    target_folders = {}
-    orphans = []
-    for rel_path, target_info in target_map["file_map"].iteritems():
-        src_info = source_map["file_map"].get(rel_path)
-        if not src_info:
-            orphans.append(target_info)
+    if not opts.use_index:
+        return None
+    if not os.path.isdir(opts.state_dir):
+        os.makedirs(opts.state_dir)
+    key = hashlib.md5(_fs_bytes(root_folder)).hexdigest()[:16]
+    return ScanIndex(os.path.join(opts.state_dir, "scan-index-%s.db" % key))
 
-    if opts.delete_orphans:
-        for o in orphans:
-            fspec = o["fspec"]
-            if opts.verbose >= 2:
-                print 'DELETE: %s' % fspec
-            delete_file(opts, fspec)
 
-    # Pass 2: copy files
-    identical_count = 0
-    modified_count = 0
-    new_count = 0
-#    for rel_path, src_info in source_map["file_map"].iteritems():
-    for rel_path in source_map["file_list"]:
-        src_info = source_map["file_map"][rel_path]
-        target_info = target_map["file_map"].get(rel_path)
-        if target_info:
-            if filecmp.cmp(src_info["fspec"], target_info["fspec"], shallow=True):
-                # Identical
-                identical_count += 1
-                if opts.verbose >= 3:
-                    print 'UNCHANGED: %s' % rel_path
-            else:
-                # Modified
-                modified_count += 1
-                if opts.verbose >= 2:
-                    print 'UPDATE: %s' % rel_path
-                # Copy with file dates
-                shutil.copy2(src_info["fspec"], target_info["fspec"])
-        else:
-            # New
-            new_count += 1
-            if opts.verbose >= 2:
-                print 'CREATE: %s' % rel_path
-            target_fspec = os.path.join(opts.target_folder, rel_path)
-            copy_file(opts, src_info["fspec"], target_fspec)
+# Length of a block checksum (MD5 is good enough to detect changed blocks)
+BLOCK_SUM_SIZE = 16
+
+
+def block_checksum(block):
+    return hashlib.md5(block).digest()
+
+
+class DigestCache(object):
+    """Persistent cache of file content digests, stored in an SQLite database.
+
+    Digests are keyed by path, size and mtime, so a file is only read again
+    after it has been modified.
+    Uses BLAKE2b if available (Python 3.6+), SHA-1 otherwise; the algorithm
+    name is stored with the digest.
+    """
+    def __init__(self, db_path):
+        self.db_path = db_path
+        self.db = sqlite3.connect(db_path, timeout=60, check_same_thread=False)
+        self.db.text_factory = str
+        self.db.executescript("""
+            CREATE TABLE IF NOT EXISTS digests (
+                path TEXT PRIMARY KEY, size INTEGER, mtime REAL, digest TEXT);
+            CREATE TABLE IF NOT EXISTS blocks (
+                path TEXT PRIMARY KEY, size INTEGER, mtime REAL, block_size INTEGER,
+                sums BLOB);
+            """)
+        self.lock = threading.Lock()
+        if hasattr(hashlib, "blake2b"):
+            self.algorithm = "blake2b"
+        else:
+            self.algorithm = "sha1"
+        self.read_count = 0
+        self.read_bytes = 0
+
+    def close(self):
+        with self.lock:
+            self.db.commit()
+            self.db.close()
+
+    def compute_digest(self, fspec):
+        """Read a file and return its digest string ('<algorithm>:<hexdigest>')."""
+        h = hashlib.new(self.algorithm)
+        with open(fspec, "rb") as f:
+            while True:
+                chunk = f.read(DIGEST_READ_CHUNK)
+                if not chunk:
+                    break
+                h.update(chunk)
+                self.read_bytes += len(chunk)
+        self.read_count += 1
+        return "%s:%s" % (self.algorithm, h.hexdigest())
+
+    def get_cached(self, fspec, size, mtime):
+        """Return the cached digest for a file or None."""
+        with self.lock:
+            row = self.db.execute("SELECT size, mtime, digest FROM digests WHERE path=?",
+                                  (fspec, )).fetchone()
+        if (row and row[0] == size and row[1] == mtime
+                and row[2].startswith(self.algorithm + ":")):
+            return row[2]
+        return None
+
+    def get_digest(self, info):
+        """Return the digest for a FileInfo (computed, if not cached)."""
+        fspec, size, mtime = info.fspec, info.size, info.mtime
+        digest = self.get_cached(fspec, size, mtime)
+        if digest:
+            return digest
+        digest = self.compute_digest(fspec)
+        self.put_digest(fspec, size, mtime, digest)
+        return digest
+
+    def put_digest(self, fspec, size, mtime, digest):
+        """Store a known digest, e.g. for a file that was just copied."""
+        with self.lock:
+            self.db.execute("INSERT OR REPLACE INTO digests (path, size, mtime, digest) "
+                            "VALUES (?, ?, ?, ?)", (fspec, size, mtime, digest))
+
+    def put_digests(self, rows):
+        """Store a list of known (fspec, size, mtime, digest) tuples."""
+        with self.lock:
+            self.db.executemany("INSERT OR REPLACE INTO digests (path, size, mtime, digest) "
+                                "VALUES (?, ?, ?, ?)", rows)
+
+    def get_block_sums(self, fspec, size, mtime, block_size):
+        """Return the list of block checksums of a file (computed, if not cached)."""
+        with self.lock:
+            row = self.db.execute("SELECT size, mtime, block_size, sums FROM blocks WHERE path=?",
+                                  (fspec, )).fetchone()
+        if row and row[0] == size and row[1] == mtime and row[2] == block_size:
+            sums = bytes(row[3])
+            return [sums[i:i+BLOCK_SUM_SIZE] for i in range(0, len(sums), BLOCK_SUM_SIZE)]
+        sums = []
+        with open(fspec, "rb") as f:
+            while True:
+                block = f.read(block_size)
+                if not block:
+                    break
+                sums.append(block_checksum(block))
+                self.read_bytes += len(block)
+        self.put_block_sums(fspec, size, mtime, block_size, sums)
+        return sums
+
+    def put_block_sums(self, fspec, size, mtime, block_size, sums):
+        with self.lock:
+            self.db.execute("INSERT OR REPLACE INTO blocks (path, size, mtime, block_size, sums) "
+                            "VALUES (?, ?, ?, ?, ?)",
+                            (fspec, size, mtime, block_size, sqlite3.Binary(b"".join(sums))))
+
+
+def open_digest_cache(opts):
+    """Return a DigestCache instance for the current state folder."""
+    if not os.path.isdir(opts.state_dir):
+        os.makedirs(opts.state_dir)
+    return DigestCache(os.path.join(opts.state_dir, "digests.db"))
+
+
+def _list_folder(dirname):
+    """Return ([(name, size, mtime), ...], [subfolder_path, ...]) for a folder.
+
+    Every entry is stat'ed at most once. If scandir is available, the entry
+    type is taken from the directory listing, so sub folders and other
+    non-regular files don't need a stat call at all.
+    Like os.walk(), symbolic links to folders are not followed (they could
+    form loops), while symbolic links to files are reported as files.
+    """
+    files = []
+    subfolders = []
+    if scandir is not None:
+        for entry in scandir(dirname):
+            try:
+                if entry.is_dir(follow_symlinks=False):
+                    subfolders.append(entry.path)
+                elif entry.is_file():
+                    st = entry.stat()
+                    files.append((entry.name, st.st_size, st.st_mtime))
+            except OSError:
+                continue # Broken link or removed meanwhile
+        return files, subfolders
+
+    for name in os.listdir(dirname):
+        fspec = os.path.join(dirname, name)
+        try:
+            st = os.lstat(fspec)
+            if stat.S_ISLNK(st.st_mode):
+                st = os.stat(fspec)
+                if stat.S_ISDIR(st.st_mode):
+                    continue # Don't follow folder links
+        except OSError:
+            continue # Broken link or removed meanwhile
+        if stat.S_ISDIR(st.st_mode):
+            subfolders.append(fspec)
+        elif stat.S_ISREG(st.st_mode):
+            files.append((name, st.st_size, st.st_mtime))
+    return files, subfolders
+
+
+def _scan_folder_files(opts, res, index=None):
+    """Scan folder into `res`, optionally using and updating the persistent scan index."""
+    folder_path = res["root_folder"]
+    reused_count = 0
+    listed_count = 0
+    stat_count = 0
+    # The target manifest needs folder mtimes
+    stat_folders = index or (opts.manifest and folder_path == opts.target_folder)
+    stack = [(folder_path, None)]
+    while stack:
+        dirname, parent = stack.pop()
+        entry = None
+        mtime = None
+        if stat_folders:
+            stat_count += 1
+            try:
+                mtime = os.stat(dirname).st_mtime
+            except OSError:
+                continue
+        if index and not opts.refresh_index:
+            entry = index.get_folder(dirname, mtime)
+        if entry is None:
+            try:
+                files, subfolders = _list_folder(dirname)
+                listed_count += 1
+                # _list_folder() stats files only (and folders without scandir)
+                stat_count += len(files) if scandir else len(files) + len(subfolders)
+            except OSError as e:
+                res["error_count"] += 1
+                res["error_files"].append(dirname)
+                if opts.verbose >= 1:
+                    print "Could not read folder '%s': %s" % (dirname, e)
+                continue
+            if index:
+                index.put_folder(dirname, parent, mtime, files, subfolders)
+        else:
+            files, subfolders = entry
+            reused_count += 1
+        rel_folder = os.path.relpath(dirname, folder_path)
+        if rel_folder == os.curdir:
+            files = [f for f in files if f[0] != MANIFEST_FILE_NAME]
+        folder = FolderInfo(len(subfolders), mtime)
+        res["folder_map"]["" if rel_folder == os.curdir else rel_folder] = folder
+        for name, _size, _mtime in files:
+            folder.add_file(opts, name)
+        for name, size, fmtime in files:
+            rel_path = name if rel_folder == os.curdir else os.path.join(rel_folder, name)
+            add_file_info(opts, res, os.path.join(dirname, name), size, fmtime, rel_path)
+        # Reverse, so folders are processed top-down, in order
+        stack.extend((sub, dirname) for sub in reversed(sorted(subfolders)))
+    opts.metrics.count("folders_listed", listed_count)
+    opts.metrics.count("folders_reused", reused_count)
+    opts.metrics.count("stat_calls", stat_count)
+    if index:
+        res["index_reused_count"] = reused_count
+        if opts.verbose >= 2:
+            print "    Reused %s unchanged folders from scan index." % reused_count
+    return
+
+
+def read_folder_files(opts, folder_path):
+    if opts.verbose >= 1:
+        print 'Reading folder "%s" ...' % (folder_path, )
+    res = create_info_dict()
+    res["root_folder"] = folder_path
+
+    index = open_scan_index(opts, folder_path)
+    try:
+        _scan_folder_files(opts, res, index)
+    finally:
+        if index:
+            index.close()
+    return res
+
+
+def _manifest_str(s):
+    """Return a name that was read from a manifest with the type of scanned names."""
+    if not isinstance(s, str):
+        s = s.encode("utf-8") # Python 2: JSON returns unicode
+    return s
+
+
+def read_target_manifest(opts, folder_path):
+    """Return the info dict of a target folder from its manifest, or None.
+
+    The manifest is written by `write_target_manifest()`. It is only trusted,
+    if the root folder did not change since then (the manifest file gets the
+    mtime of the root folder) and a random sample of folders and files still
+    have the recorded mtimes and sizes.
+    """
+    path = os.path.join(folder_path, MANIFEST_FILE_NAME)
+    try:
+        root_mtime = os.stat(folder_path).st_mtime
+        manifest_mtime = os.stat(path).st_mtime
+    except OSError:
+        return None
+    if opts.verbose >= 1:
+        print 'Reading manifest "%s" ...' % path
+    if abs(root_mtime - manifest_mtime) >= MANIFEST_MTIME_TOLERANCE:
+        if opts.verbose >= 1:
+            print "Target folder was modified after the manifest was written."
+        return None
+    try:
+        with gzip.open(path, "rb") as f:
+            header = json.loads(f.readline())
+            records = [json.loads(line) for line in f]
+    except (IOError, EOFError, ValueError, zlib.error) as e:
+        if opts.verbose >= 1:
+            print "Could not read manifest: %s" % e
+        return None
+    if header.get("version") != 1 or len(records) != header.get("folder_count"):
+        return None
+
+    def _folder(rec):
+        return os.path.join(folder_path, _manifest_str(rec["folder"]))
+
+    rnd = random.Random()
+    stat_count = 0
+    try:
+        # (The root folder was checked above)
+        sub_records = [rec for rec in records if rec["folder"]]
+        for rec in rnd.sample(sub_records, min(MANIFEST_SAMPLE_SIZE, len(sub_records))):
+            stat_count += 1
+            if os.stat(_folder(rec)).st_mtime != rec["mtime"]:
+                raise OSError(errno.ENOENT, "Folder was modified", _folder(rec))
+        records_with_files = [rec for rec in records if rec["files"]]
+        for rec in rnd.sample(records_with_files,
+                              min(MANIFEST_SAMPLE_SIZE, len(records_with_files))):
+            name, size, mtime = rnd.choice(rec["files"])[:3]
+            fspec = os.path.join(_folder(rec), _manifest_str(name))
+            stat_count += 1
+            st = os.stat(fspec)
+            if st.st_size != size or st.st_mtime != mtime:
+                raise OSError(errno.ENOENT, "File was modified", fspec)
+    except OSError as e:
+        if opts.verbose >= 1:
+            print "Manifest is outdated: %s" % e
+        return None
+    finally:
+        opts.metrics.count("stat_calls", stat_count)
+
+    res = create_info_dict()
+    res["root_folder"] = folder_path
+    digest_rows = []
+    for rec in records:
+        rel_folder = _manifest_str(rec["folder"])
+        dirname = os.path.join(folder_path, rel_folder)
+        folder = res["folder_map"][rel_folder] = FolderInfo(rec["folder_count"], rec["mtime"])
+        for entry in rec["files"]:
+            name = _manifest_str(entry[0])
+            rel_path = os.path.join(rel_folder, name)
+            folder.add_file(opts, name)
+            add_file_info(opts, res, os.path.join(dirname, name), entry[1], entry[2], rel_path)
+            if len(entry) > 3:
+                digest_rows.append((os.path.join(dirname, name), entry[1], entry[2], entry[3]))
+        for name in rec["other"]:
+            name = _manifest_str(name)
+            if opts.sync_matcher.match(name):
+                # Synced now (e.g. `--include` was added), but no size recorded
+                if opts.verbose >= 1:
+                    print "Manifest is outdated: file patterns have changed."
+                return None
+            folder.add_file(opts, name)
+            add_file_info(opts, res, os.path.join(dirname, name), 0, 0,
+                          os.path.join(rel_folder, name))
+    if digest_rows and opts.checksum:
+        digests = open_digest_cache(opts)
+        digests.put_digests(digest_rows)
+        digests.close()
+    res["manifest_written"] = header["written"]
+    if opts.verbose >= 2:
+        print "    Using manifest of %s folders (checked %s entries)." % (len(records), stat_count)
+    return res
+
+
+def write_target_manifest(opts, target_map, digests=None):
+    """Write the manifest of the target folder after a sync.
+
+    Folders that were changed by this run are listed again; all other folders
+    are taken from `target_map` (see `FolderInfo`), so the target is not
+    scanned again. Digests are added for files that have a cached digest.
+    The manifest file gets the mtime of the root folder, so later changes of
+    the root folder make it invalid (see `read_target_manifest()`).
+    """
+    root_folder = target_map["root_folder"]
+    folder_map = target_map["folder_map"]
+    if target_map["error_count"]:
+        return False # Incomplete
+    if target_map.get("manifest_written") and not any(
+            folder.mtime is None for folder in folder_map.itervalues()):
+        return False # Unchanged
+    path = os.path.join(root_folder, MANIFEST_FILE_NAME)
+    files_by_folder = {}
+    for info in target_map["file_map"].itervalues():
+        files_by_folder.setdefault(os.path.dirname(info.rel_path), []).append(info)
+    records = []
+    for rel_folder in sorted(folder_map):
+        folder = folder_map[rel_folder]
+        dirname = os.path.join(root_folder, rel_folder)
+        # The root folder is changed by the journal and the manifest itself
+        if folder.mtime is None or not rel_folder:
+            try:
+                mtime = os.stat(dirname).st_mtime
+                files, subfolders = _list_folder(dirname)
+            except OSError as e:
+                print >>sys.stderr, "Could not write manifest: %s" % e
+                return False
+            folder_count = len(subfolders)
+            entries = [[name, size, fmtime] for name, size, fmtime in files
+                       if opts.sync_matcher.match(name)]
+            other = [name for name, _size, _mtime in files
+                     if not opts.sync_matcher.match(name)]
+        else:
+            mtime = folder.mtime
+            folder_count = folder.folder_count
+            entries = [[os.path.basename(info.rel_path), info.size, info.mtime]
+                       for info in files_by_folder.get(rel_folder, [])]
+            other = [name for name in folder.purge_names + folder.other_names
+                     if not opts.sync_matcher.match(name)]
+        if digests:
+            for entry in entries:
+                digest = digests.get_cached(os.path.join(dirname, entry[0]), entry[1], entry[2])
+                if digest:
+                    entry.append(digest)
+        other = [name for name in other if not name.startswith(MANIFEST_FILE_NAME)]
+        records.append({"folder": rel_folder, "mtime": mtime, "folder_count": folder_count,
+                        "files": entries, "other": other})
+    header = {"version": 1,
+              "written": time.time(),
+              "folder_count": len(records),
+              }
+    tmp = path + TEMP_FILE_SUFFIX
+    try:
+        with gzip.open(tmp, "wb") as f:
+            for rec in [header] + records:
+                f.write((json.dumps(rec) + "\n").encode("utf-8"))
+    except UnicodeError as e:
+        # Python 2: names that are not UTF-8
+        print >>sys.stderr, "Could not write manifest: %s" % e
+        os.remove(tmp)
+        return False
+    _replace_file(tmp, path)
+    root_mtime = os.stat(root_folder).st_mtime
+    os.utime(path, (root_mtime, root_mtime))
+    if opts.verbose >= 2:
+        print "    Wrote manifest of %s folders." % len(records)
+    return True
+
+
+def remove_target_manifest(opts):
+    """Remove the target manifest before the target is modified."""
+    try:
+        os.remove(os.path.join(opts.target_folder, MANIFEST_FILE_NAME))
+    except OSError as e:
+        if e.errno != errno.ENOENT:
+            raise
+    return
+
+
+def iter_playlist_wpl(opts, playlist_path):
+    """Yield the 'src' attribute of all media entries of a WPL playlist.
+
+    The playlist is parsed incrementally and media elements are released as
+    soon as they have been processed, so memory usage does not grow with the
+    playlist size and the caller can start processing the first entries
+    before the whole file has been read.
+    """
+    generator = None
+    title = None
+    seq = None
+    for event, elem in ET.iterparse(playlist_path, ("start", "end")):
+        if event == "start":
+            if elem.tag == "seq":
+                seq = elem
+            continue
+        tag = elem.tag
+        if tag == "media":
+            yield elem.attrib["src"]
+            # Drop processed entries from the tree
+            if seq is not None:
+                seq.clear()
+        elif tag == "meta" and elem.get("name") == "Generator":
+            generator = elem.get("content")
+        elif tag == "title":
+            title = elem.text
+        elif tag == "head":
+            if opts.verbose >= 1:
+                print 'Scanning playlist "%s" (%s)...' % (title, generator)
+    return
+
+
+def _iter_playlist_lines(playlist_path, encoding=None):
+    """Yield non-empty, stripped and decoded lines of a text playlist.
+
+    The file is read in large chunks, which is much faster than line-by-line
+    reading for playlists with hundreds of thousands of entries.
+    If `encoding` is None, lines are decoded as UTF-8 with a Latin-1 fallback.
+    """
+    with open(playlist_path, "rb") as f:
+        rest = b""
+        first = True
+        while True:
+            chunk = f.read(PLAYLIST_READ_CHUNK)
+            if first:
+                first = False
+                if chunk.startswith(b"\xef\xbb\xbf"): # UTF-8 BOM
+                    chunk = chunk[3:]
+            if not chunk:
+                lines = [rest]
+            else:
+                lines = (rest + chunk).split(b"\n")
+                rest = lines.pop()
+            for line in lines:
+                line = line.strip()
+                if not line:
+                    continue
+                if encoding:
+                    line = line.decode(encoding)
+                else:
+                    try:
+                        line = line.decode("utf-8")
+                    except UnicodeDecodeError:
+                        line = line.decode("latin-1")
+                try:
+                    # Keep ASCII entries as native str, like ElementTree does
+                    yield str(line)
+                except UnicodeEncodeError:
+                    yield line
+            if not chunk:
+                break
+    return
+
+
+def _uri_to_path(uri):
+    """Convert a 'file://' URI or relative URI reference to a path.
+
+    Return None for URIs of other schemes (e.g. 'http://' streams).
+    """
+    if uri.startswith("file://"):
+        uri = uri[7:]
+        if uri.startswith("localhost/"):
+            uri = uri[9:]
+        # 'file:///C:/Music' -> 'C:/Music' on Windows
+        res = url2pathname(uri)
+        if len(res) > 2 and res[0] in "\\/" and res[2] == ":":
+            res = res[1:]
+        return res
+    elif "://" in uri:
+        return None
+    return url2pathname(uri)
+
+
+def iter_playlist_m3u(opts, playlist_path, encoding=None):
+    """Yield the file entries of an M3U playlist (comments are skipped)."""
+    for line in _iter_playlist_lines(playlist_path, encoding):
+        if line.startswith("#"):
+            continue
+        if "://" in line:
+            line = _uri_to_path(line)
+            if line is None:
+                continue
+        yield line
+    return
+
+
+def iter_playlist_m3u8(opts, playlist_path):
+    """Yield the file entries of an UTF-8 encoded M3U playlist."""
+    return iter_playlist_m3u(opts, playlist_path, "utf-8")
+
+
+def iter_playlist_pls(opts, playlist_path):
+    """Yield the 'FileN=' entries of a PLS playlist."""
+    for line in _iter_playlist_lines(playlist_path):
+        if not line[:4].lower() == "file":
+            continue
+        key, sep, value = line.partition("=")
+        if not sep or not key[4:].strip().isdigit():
+            continue
+        value = value.strip()
+        if "://" in value:
+            value = _uri_to_path(value)
+            if value is None:
+                continue
+        yield value
+    return
+
+
+def iter_playlist_xspf(opts, playlist_path):
+    """Yield the first 'location' of every track of a XSPF playlist.
+
+    Like the WPL reader, the file is parsed incrementally.
+    """
+    ns = "{http://xspf.org/ns/0/}"
+    track_tag = ns + "track"
+    location_tag = ns + "location"
+    track_list = None
+    location = None
+    for event, elem in ET.iterparse(playlist_path, ("start", "end")):
+        if event == "start":
+            if elem.tag == ns + "trackList":
+                track_list = elem
+            elif elem.tag == track_tag:
+                location = None
+            continue
+        if elem.tag == location_tag and location is None:
+            location = _uri_to_path((elem.text or "").strip())
+        elif elem.tag == track_tag:
+            if location:
+                yield location
+            if track_list is not None:
+                track_list.clear()
+    return
+
+
+# Map playlist extensions to functions that yield the playlist entries.
+# Entries may be absolute or relative to the playlist's folder.
+PLAYLIST_READERS = {".m3u": iter_playlist_m3u,
+                    ".m3u8": iter_playlist_m3u8,
+                    ".pls": iter_playlist_pls,
+                    ".wpl": iter_playlist_wpl,
+                    ".xspf": iter_playlist_xspf,
+                    }
+
+
+def get_playlist_reader(playlist_path):
+    """Return the entry reader for a playlist or None, if the format is not supported."""
+    ext = os.path.splitext(playlist_path)[1].lower()
+    return PLAYLIST_READERS.get(ext)
+
+
+def _native_path(path):
+    """Return a path as native str, so it compares equal to scanned paths.
+
+    Playlist readers return unicode for non-ASCII entries on Python 2, while
+    folder scans return byte strings (encoded with FS_ENCODING).
+    """
+    if not isinstance(path, str):
+        # (Names that can't be encoded can't exist, so they are reported missing)
+        path = path.encode(FS_ENCODING, "replace")
+    return path
+
+
+class PathResolver(object):
+    """Resolve playlist entries to files, memoizing all steps.
+
+    Playlists often reference the same files and all files of a folder share
+    the same relative folder path, so every entry is resolved, every file
+    stat'ed and every folder checked (and made relative) only once per run,
+    even if the resolver is shared by all playlists.
+    Instances may be used by concurrent threads (a race only means that an
+    entry is resolved twice).
+    """
+    def __init__(self, root_folder):
+        self.root_folder = root_folder
+        # key: (playlist folder, entry), value: (fspec, rel_path, size, mtime)
+        self.entry_cache = {}
+        # key: fspec, value: (fspec, rel_path, size, mtime)
+        self.file_cache = {}
+        # key: folder, value: folder relative to root_folder (None if missing)
+        self.folder_cache = {}
+        self.stat_count = 0
+
+    def resolve(self, playlist_folder, entry):
+        """Return (fspec, rel_path, size, mtime) for a playlist entry.
+
+        Entries may be absolute or relative to the playlist folder. If the
+        file does not exist, size and mtime are None.
+        """
+        key = (playlist_folder, entry)
+        res = self.entry_cache.get(key)
+        if res is None:
+            fspec = _native_path(entry)
+            # Playlists created on Windows use backslashes
+            if os.sep != "\\":
+                fspec = fspec.replace("\\", os.sep)
+            # If the fspec was given relative, it is relative to the playlist
+            if not os.path.isabs(fspec):
+                fspec = canonical_path(os.path.join(playlist_folder, fspec))
+            res = self.file_cache.get(fspec)
+            if res is None:
+                res = self._stat_file(fspec)
+                self.file_cache[fspec] = res
+            self.entry_cache[key] = res
+        return res
+
+    def _stat_file(self, fspec):
+        folder, name = os.path.split(fspec)
+        if folder in self.folder_cache:
+            rel_folder = self.folder_cache[folder]
+        else:
+            self.stat_count += 1
+            rel_folder = None
+            if os.path.isdir(folder):
+                rel_folder = os.path.relpath(folder, self.root_folder)
+            self.folder_cache[folder] = rel_folder
+        if rel_folder is None:
+            return (fspec, os.path.relpath(fspec, self.root_folder), None, None)
+        rel_path = name if rel_folder == os.curdir else os.path.join(rel_folder, name)
+        self.stat_count += 1
+        try:
+            st = os.stat(fspec)
+        except OSError:
+            return (fspec, rel_path, None, None)
+        if not stat.S_ISREG(st.st_mode):
+            return (fspec, rel_path, None, None)
+        return (fspec, rel_path, st.st_size, st.st_mtime)
+
+
+def read_playlist(opts, playlist_path, info, resolver=None):
+    """Read a playlist and add file info to dictionary.
+
+    A PathResolver may be passed to share resolved entries between playlists.
+    """
+    # TODO: this assert may be removed
+    assert playlist_path.startswith(opts.source_folder)
+    assert os.path.isabs(playlist_path)
+    shared_resolver = resolver is not None
+    if not shared_resolver:
+        resolver = PathResolver(info["root_folder"])
+    assert resolver.root_folder == info["root_folder"]
+
+    reader = get_playlist_reader(playlist_path)
+    if reader is None:
+        raise NotImplementedError("Unsupported playlist extension: %r" % playlist_path)
+    if opts.verbose >= 1:
+        print 'Parsing playlist "%s" ...' % (playlist_path, )
+    playlist_folder = os.path.dirname(playlist_path)
+    file_map = info["file_map"]
+    # Synced files of this playlist, in playlist order
+    members = info["playlist_map"].setdefault(playlist_path, [])
+    member_set = set(members)
+    entry_count = 0
+    for entry in reader(opts, playlist_path):
+        fspec, rel_path, size, mtime = resolver.resolve(playlist_folder, entry)
+        add_file_info(opts, info, fspec, size, mtime, rel_path, missing=size is None)
+        if rel_path in file_map and rel_path not in member_set:
+            member_set.add(rel_path)
+            members.append(rel_path)
+        entry_count += 1
+    opts.metrics.count("playlist_entries", entry_count)
+    if not shared_resolver:
+        opts.metrics.count("stat_calls", resolver.stat_count)
+    return
+
+
+class OrderedOutput(object):
+    """Replacement for sys.stdout while `run_parallel()` calls are running.
+
+    Output of the first call is written through; output of the other calls
+    is buffered until all previous calls have finished. So messages (e.g. of
+    concurrently read playlists) appear as if the calls were made one after
+    the other. Output of other threads is written through.
+    """
+    def __init__(self, stream, call_count):
+        self.stream = stream
+        self.lock = threading.Lock()
+        self.local = threading.local()
+        self.buffers = [[] for _ in range(call_count)]
+        self.done = [False] * call_count
+        self.current = 0 # Index of the call that writes through
+        self.softspace = 0 # (Used by the print statement)
+        self.parent_index = None
+        if isinstance(stream, OrderedOutput):
+            # Nested run_parallel(): write as the calling thread
+            self.parent_index = getattr(stream.local, "index", None)
+
+    def enter(self, i):
+        """Register the current thread as the thread of call i."""
+        self.local.index = i
+        if isinstance(self.stream, OrderedOutput):
+            self.stream.enter(self.parent_index)
+
+    def finish(self, i):
+        """Mark call i as finished and write buffered output that is due."""
+        with self.lock:
+            self.done[i] = True
+            while self.current < len(self.done) and self.done[self.current]:
+                self.current += 1
+                if self.current < len(self.done):
+                    self._write_buffer(self.current)
+
+    def close(self):
+        """Write all remaining output (e.g. after KeyboardInterrupt)."""
+        with self.lock:
+            for i in range(len(self.buffers)):
+                self._write_buffer(i)
+            self.current = len(self.done)
+
+    def _write_buffer(self, i):
+        if self.buffers[i]:
+            self.stream.write("".join(self.buffers[i]))
+            self.buffers[i] = []
+
+    def write(self, s):
+        i = getattr(self.local, "index", None)
+        with self.lock:
+            if i is None or i == self.current:
+                self.stream.write(s)
+            else:
+                self.buffers[i].append(s)
+
+    def flush(self):
+        self.stream.flush()
+
+    def __getattr__(self, name):
+        return getattr(self.stream, name)
+
+
+def run_parallel(calls):
+    """Call every (func, args) tuple in its own thread and return the results.
+
+    The first exception raised by a call is re-raised after all threads
+    have finished.
+    Printed messages are kept in the order of the calls (see `OrderedOutput`).
+    """
+    results = [None] * len(calls)
+    errors = []
+    output = OrderedOutput(sys.stdout, len(calls))
+
+    def _call(i, func, args):
+        output.enter(i)
+        try:
+            results[i] = func(*args)
+        except Exception:
+            errors.append(sys.exc_info())
+        finally:
+            output.finish(i)
+
+    threads = [threading.Thread(target=_call, args=(i, func, args))
+               for i, (func, args) in enumerate(calls)]
+    saved_stdout = sys.stdout
+    sys.stdout = output
+    try:
+        for t in threads:
+            t.daemon = True
+            t.start()
+        for t in threads:
+            # Join with timeout, so KeyboardInterrupt is still delivered
+            while t.is_alive():
+                t.join(0.1)
+    finally:
+        sys.stdout = saved_stdout
+        output.close()
+    if errors:
+        exc_type, exc_value, exc_tb = errors[0]
+        raise exc_type, exc_value, exc_tb
+    return results
+
+
+def merge_info_dicts(info_dict, other):
+    """Add files and counters of `other` to info_dict (keeping the order).
+
+    Files that are already contained in info_dict are only counted as
+    additional references.
+    """
+    assert info_dict["root_folder"] == other["root_folder"]
+    file_map = info_dict["file_map"]
+    skip_map = info_dict["skip_map"]
+    for rel_path in other["file_list"]:
+        if rel_path in file_map:
+            continue
+        info = other["file_map"][rel_path]
+        info_dict["file_list"].append(rel_path)
+        file_map[rel_path] = info
+        info_dict["byte_count"] += info.size
+        info_dict["process_count"] += 1
+    for rel_path, missing in other["skip_map"].iteritems():
+        if rel_path in file_map or rel_path in skip_map:
+            continue
+        skip_map[rel_path] = missing
+        info_dict["process_count"] += 1
+        info_dict["skip_count"] += 1
+        if missing:
+            info_dict["error_count"] += 1
+    info_dict["reference_count"] += other["reference_count"]
+    info_dict["ext_map"].update(other["ext_map"])
+    info_dict["error_files"].extend(other["error_files"])
+    info_dict["playlist_map"].update(other["playlist_map"])
+    return info_dict
+
+
+def parse_transform_rule(rule):
+    """Parse a `--transform` rule 'EXT:TARGET_EXT:COMMAND' into
+    (ext, (target_ext, command_args)).
+
+    COMMAND is split like a shell command line; the placeholders '{src}' and
+    '{dest}' are replaced by the file paths.
+    """
+    parts = rule.split(":", 2)
+    if len(parts) != 3 or not parts[0] or not parts[1]:
+        raise ValueError("expected EXT:TARGET_EXT:COMMAND: %r" % rule)
+    ext, target_ext, command = parts
+    ext = "." + ext.lstrip(".").lower()
+    target_ext = "." + target_ext.lstrip(".").lower()
+    args = shlex.split(command)
+    if not args or not [a for a in args if "{dest}" in a]:
+        raise ValueError("COMMAND must contain '{dest}': %r" % rule)
+    return ext, (target_ext, args)
+
+
+def _transform_file(task):
+    """Run a converter command (in a pool process) and return (task, error).
+
+    The output is written to a temp file first, so the cache never contains
+    partial files; it gets the mtime of the source file.
+    """
+    args, src, dest, mtime = task
+    root, ext = os.path.splitext(dest)
+    # Keep the extension, converters may use it to select the output format
+    tmp = root + TEMP_FILE_SUFFIX + ext
+    try:
+        with open(os.devnull, "wb") as devnull:
+            res = subprocess.call([a.replace("{src}", src).replace("{dest}", tmp) for a in args],
+                                  stdin=devnull, stdout=devnull)
+        if res != 0:
+            return task, "converter returned exit code %s" % res
+        if not os.path.isfile(tmp):
+            return task, "converter did not create an output file"
+        os.utime(tmp, (time.time(), mtime))
+        _replace_file(tmp, dest)
+    except (IOError, OSError) as e:
+        return task, str(e)
+    finally:
+        if os.path.exists(tmp):
+            os.remove(tmp)
+    return task, None
+
+
+def get_transform_cache_path(opts, fspec, size, mtime, target_ext, args):
+    """Return the path of the cached transform output for a source file.
+
+    The file name is derived from the source path, size and mtime and the
+    converter command, so changing any of them creates a new entry.
+    """
+    key = hashlib.sha1(repr((fspec, size, mtime, target_ext, args)).encode("utf-8")).hexdigest()
+    return os.path.join(opts.state_dir, TRANSFORM_CACHE_FOLDER, key[:2], key + target_ext)
+
+
+def transform_source_files(opts, info_dict):
+    """Replace source files that match a `--transform` rule with their
+    transformed version (e.g. 'a.flac' -> 'a.mp3').
+
+    Outputs are cached in STATE_DIR, so every file is only converted once,
+    even if it is synced to multiple targets or in later runs. Missing
+    outputs are created in a process pool of `--transform-jobs` processes.
+    In dry-run mode nothing is converted; uncached files are reported with
+    their source size.
+    Files are not transformed if the output file already exists in the source;
+    they are also not synced then, unless they match the sync patterns.
+    """
+    rules = opts.transform_rules
+    if not rules:
+        return
+    root_folder = info_dict["root_folder"]
+    file_map = info_dict["file_map"]
+    pending = [] # (rel_path, target_rel_path, cache_fspec)
+    skipped = []
+    tasks = []
+    cached_count = 0
+    for rel_path in info_dict["file_list"]:
+        base, ext = os.path.splitext(rel_path)
+        rule = rules.get(ext.lower())
+        if rule is None:
+            continue
+        target_ext, args = rule
+        target_rel_path = base + target_ext
+        if target_rel_path in file_map:
+            if opts.verbose >= 2:
+                print "Not transforming %s: %s exists" % (rel_path, target_rel_path)
+            if not opts.plain_sync_matcher.match(os.path.basename(rel_path)):
+                skipped.append(rel_path)
+            continue
+        info = file_map[rel_path]
+        cache_fspec = get_transform_cache_path(opts, info.fspec, info.size, info.mtime,
+                                               target_ext, args)
+        pending.append((rel_path, target_rel_path, cache_fspec))
+        if os.path.isfile(cache_fspec):
+            cached_count += 1
+        elif not opts.dry_run:
+            tasks.append((args, info.fspec, cache_fspec, info.mtime))
+    if not pending and not skipped:
+        return
+
+    errors = {}
+    with opts.metrics.phase("transform") as ph:
+        for task in tasks:
+            folder = os.path.dirname(task[2])
+            if not os.path.isdir(folder):
+                os.makedirs(folder)
+        jobs = min(opts.transform_jobs or multiprocessing.cpu_count(), len(tasks))
+        if jobs <= 1:
+            results = (_transform_file(task) for task in tasks)
+        else:
+            pool = multiprocessing.Pool(jobs)
+            it = pool.imap_unordered(_transform_file, tasks)
+            # (Use a timeout, so KeyboardInterrupt is still delivered)
+            results = (it.next(TRANSFORM_TIMEOUT) for _task in tasks)
+        try:
+            for task, error in results:
+                if opts.verbose >= 2:
+                    print "TRANSFORM: %s" % os.path.relpath(task[1], root_folder)
+                if error:
+                    errors[task[2]] = error
+                    print >>sys.stderr, "Could not transform %s: %s" % (task[1], error)
+                ph["files"] += 1
+        finally:
+            if jobs > 1:
+                pool.terminate()
+                pool.join()
+
+    for rel_path in skipped:
+        info_dict["byte_count"] -= file_map.pop(rel_path).size
+    file_list = []
+    transformed = {}
+    for rel_path, target_rel_path, cache_fspec in pending:
+        info = file_map.pop(rel_path)
+        info_dict["byte_count"] -= info.size
+        if cache_fspec in errors:
+            info_dict["error_count"] += 1
+            info_dict["error_files"].append(info.fspec)
+            continue
+        if os.path.isfile(cache_fspec):
+            size = os.path.getsize(cache_fspec)
+        else:
+            # Dry-run: not converted, so use the source file as an estimate
+            size = info.size
+            cache_fspec = info.fspec
+        file_map[target_rel_path] = TransformedFileInfo(root_folder, target_rel_path, size,
+                                                        info.mtime, cache_fspec, info.fspec)
+        info_dict["byte_count"] += size
+        transformed[rel_path] = target_rel_path
+    for rel_path in info_dict["file_list"]:
+        rel_path = transformed.get(rel_path, rel_path)
+        if rel_path in file_map:
+            file_list.append(rel_path)
+    info_dict["file_list"] = file_list
+    for members in info_dict["playlist_map"].itervalues():
+        members[:] = [transformed.get(rel_path, rel_path) for rel_path in members
+                      if transformed.get(rel_path, rel_path) in file_map]
+    opts.metrics.count("transform_count", len(tasks) - len(errors))
+    opts.metrics.count("transform_cached_count", cached_count)
+    if opts.verbose >= 1:
+        print "Transformed %s files (%s converted, %s from cache, %s failed)." % (
+            len(transformed), len(tasks) - len(errors), cached_count, len(errors))
+    return
+
+
+def read_source_files(opts):
+    """Read source files (either complete folder or using given playlists).
+
+    Multiple playlists are read concurrently and merged in the given order.
+    """
+    if len(opts.playlist_paths) == 0:
+        with opts.metrics.phase("scan_source") as ph:
+            res = read_folder_files(opts, opts.source_folder)
+            ph["files"] = res["process_count"]
+        transform_source_files(opts, res)
+        return res
+
+    # Entries are resolved only once, even if referenced by multiple playlists
+    resolver = PathResolver(opts.source_folder)
+
+    def _read(pl):
+        res = create_info_dict()
+        res["root_folder"] = opts.source_folder
+        read_playlist(opts, pl, res, resolver)
+        return res
+
+    with opts.metrics.phase("parse_playlists") as ph:
+        if len(opts.playlist_paths) == 1:
+            res = _read(opts.playlist_paths[0])
+        else:
+            results = run_parallel([(_read, (pl, )) for pl in opts.playlist_paths])
+            res = results[0]
+            for other in results[1:]:
+                merge_info_dicts(res, other)
+        ph["files"] = res["process_count"]
+    opts.metrics.count("stat_calls", resolver.stat_count)
+    transform_source_files(opts, res)
+    return res
+
+
+def print_playlist_summary(opts, info_dict):
+    """Print the number of synced files per playlist and how many of them
+    are also contained in other playlists."""
+    playlist_map = info_dict["playlist_map"]
+    ref_counts = {}
+    for members in playlist_map.itervalues():
+        for rel_path in members:
+            ref_counts[rel_path] = ref_counts.get(rel_path, 0) + 1
+    for pl in opts.playlist_paths:
+        members = playlist_map.get(pl, [])
+        shared = len([rel_path for rel_path in members if ref_counts[rel_path] > 1])
+        print "    %s: %s files, %s also in other playlists." % (os.path.basename(pl),
+                                                                   len(members), shared)
+    return
+
+
+def print_source_target_summary(opts, source_info, target_infos):
+    if isinstance(target_infos, dict):
+        target_infos = [target_infos]
+    if opts.verbose >= 1:
+        print "Source: %s files (%s references), %s valid in %s folders." % (
+            source_info["process_count"], source_info["reference_count"],
+            len(source_info["file_map"]), len(source_info["folder_map"]))
+        if opts.verbose >= 2:
+            ext_list = sorted(source_info["ext_map"].keys())
+            print "    Extensions: %s" % ext_list
+            print_playlist_summary(opts, source_info)
+        for target_info in target_infos:
+            label = "Target"
+            if len(target_infos) > 1:
+                label = 'Target "%s"' % target_info["root_folder"]
+            print "%s: %s files, %s valid in %s folders." % (label,
+                                                  target_info["process_count"],
+                                                  len(target_info["file_map"]),
+                                                  len(target_info["folder_map"])
+                                                  )
+    return
+
+
+def read_target_files(opts):
+    """Read all files of the target folder."""
+    with opts.metrics.phase("scan_target") as ph:
+        res = None
+        if opts.manifest:
+            res = read_target_manifest(opts, opts.target_folder)
+        if res is None:
+            res = read_folder_files(opts, opts.target_folder)
+        ph["files"] = res["process_count"]
+    return res
 
-    if opts.verbose >= 1:
-        # print('Compared %s files. Identical: %s, modified: %s, new: %s, orphans: %s.' 
-        #       % (len(source_map["file_map"]), identical_count, modified_count, new_count, len(orphans)))
-        print('Synchronized %s files. Created: %s, updated: %s, deleted: %s, unchanged: %s.' 
-              % (len(source_map["file_map"]), new_count, modified_count, len(orphans), identical_count))
 
-    # Pass 3: purge empty folders
+def read_source_and_target(opts):
+    """Return (source_info, target_info).
+
+    Source and target are scanned concurrently, unless they are located on
+    the same device (where parallel access would only cause seeks).
+    """
+    source_info, target_infos = read_source_and_targets(opts, [opts])
+    return source_info, target_infos[0]
+
+
+def read_source_and_targets(opts, target_opts_list):
+    """Return (source_info, [target_info, ...]) for a list of target opts.
+
+    Folders on different devices are scanned concurrently; folders on the
+    same device are scanned one after the other.
+    """
+    # Group the scans by device, keeping the order
+    device_calls = {}
+    devices = []
+    calls = [(0, read_source_files, opts)]
+    calls.extend((i + 1, read_target_files, target_opts)
+                 for i, target_opts in enumerate(target_opts_list))
+    for i, func, call_opts in calls:
+        folder = call_opts.source_folder if i == 0 else call_opts.target_folder
+        dev = os.stat(folder).st_dev
+        if dev not in device_calls:
+            device_calls[dev] = []
+            devices.append(dev)
+        device_calls[dev].append((i, func, call_opts))
+    results = [None] * len(calls)
+
+    def _read_device(dev_calls):
+        for i, func, call_opts in dev_calls:
+            results[i] = func(call_opts)
+
+    if len(devices) == 1:
+        _read_device(device_calls[devices[0]])
+    else:
+        run_parallel([(_read_device, (device_calls[dev], )) for dev in devices])
+    return results[0], results[1:]
+
+
+def compare_file_info(src_info, target_info, digests=None):
+    """Return True if both files are identical.
+
+    This is similar to `filecmp.cmp(..., shallow=True)`, but uses the size
+    and mtime that were recorded during the scan, so only files with equal
+    size but different mtime need to be stat'ed and compared byte-by-byte.
+    If a DigestCache is passed, files of equal size are compared by their
+    (cached) content digests instead.
+    """
+    if src_info.size != target_info.size:
+        return False
+    if digests is not None:
+        return digests.get_digest(src_info) == digests.get_digest(target_info)
+    if abs(src_info.mtime - target_info.mtime) < MTIME_TOLERANCE:
+        return True
+    return filecmp.cmp(src_info.fspec, target_info.fspec, shallow=False)
+
+
+def _store_copied_digests(digests, source_map, copy_ops):
+    """Record digests of copied target files, so they never need to be read."""
+    for _action, rel_path, _src, dest in copy_ops:
+        src_info = source_map["file_map"][rel_path]
+        try:
+            st = os.stat(dest)
+        except OSError:
+            continue # Not copied (e.g. interrupted)
+        if st.st_size != src_info.size:
+            continue
+        digest = digests.get_cached(src_info.fspec, src_info.size, src_info.mtime)
+        if digest:
+            digests.put_digest(dest, st.st_size, st.st_mtime, digest)
+    return
+
+
+def plan_capacity(opts, copy_ops, source_map, target_map, orphans, free_bytes, block_size):
+    """Select copy operations that fit into the target.
+
+    Two budgets are checked: the free space of the target plus the space of
+    `orphans` that are deleted by this run, counted in whole blocks (clusters
+    on FAT), and `--max-size`, counted in logical bytes like its help text.
+    Operations are accepted in order (i.e. playlist order) until a budget is
+    exhausted; after that, only updates that don't need additional space are
+    accepted.
+    Return (accepted_ops, skipped_ops, required_bytes, available_bytes), with
+    the bytes of the budget with the least headroom.
+    """
+    def _allocated(size):
+        return -(-size // block_size) * block_size
+
+    def _needs(op):
+        # Return the (allocated, logical) bytes that an operation adds
+        action, rel_path = op[:2]
+        size = source_map["file_map"][rel_path].size
+        if action == "UPDATE":
+            old_size = target_map["file_map"][rel_path].size
+            return _allocated(size) - _allocated(old_size), size - old_size
+        return _allocated(size), size
+
+    available_space = free_bytes + sum(_allocated(o.size) for o in orphans)
+    available_size = None
+    if opts.max_size:
+        content = target_map["byte_count"] - sum(o.size for o in orphans)
+        available_size = opts.max_size - content
+    needs = [_needs(op) for op in copy_ops]
+    required_space = sum(space for space, _size in needs)
+    required_size = sum(size for _space, size in needs)
+    # Report the budget with the least headroom
+    required, available = required_space, available_space
+    if (available_size is not None
+            and available_size - required_size < available_space - required_space):
+        required, available = required_size, available_size
+    if required <= available:
+        return copy_ops, [], required, available
+    accepted = []
+    skipped = []
+    used_space = used_size = 0
+    budget_hit = False
+    for op, (space, size) in zip(copy_ops, needs):
+        fits = ((space <= 0 or used_space + space <= available_space)
+                and (size <= 0 or available_size is None
+                     or used_size + size <= available_size))
+        if (space > 0 or size > 0) and (budget_hit or not fits):
+            budget_hit = True
+            skipped.append(op)
+            continue
+        used_space += space
+        used_size += size
+        accepted.append(op)
+    return accepted, skipped, required, available
+
+
+def find_duplicate_ops(opts, source_map, target_map, copy_ops, digests):
+    """Split copy operations into copies and links of identical files.
+
+    Source files with equal size and content digest are copied only once;
+    the other occurrences are linked to that copy, or to an unchanged target
+    file with the same content (e.g. 'Folder.jpg' of a compilation).
+    Return (copy_ops, link_ops), with link operations of the form
+    (action, rel_path, link_src, dest), where link_src is a target file.
+    """
+    file_map = source_map["file_map"]
+    size_count = {}
+    for op in copy_ops:
+        size = file_map[op[1]].size
+        size_count[size] = size_count.get(size, 0) + 1
+    # key: (size, digest), value: target fspec that has this content
+    originals = {}
+    copied = set(op[1] for op in copy_ops)
+    for rel_path, target_info in target_map["file_map"].iteritems():
+        if (target_info.size in size_count and rel_path in file_map
+                and rel_path not in copied):
+            key = (target_info.size, digests.get_digest(target_info))
+            originals.setdefault(key, target_info.fspec)
+    existing_sizes = set(size for size, _digest in originals)
+    res_copy_ops = []
+    link_ops = []
+    for op in copy_ops:
+        action, rel_path, _src, dest = op
+        src_info = file_map[rel_path]
+        if src_info.size == 0 or (size_count[src_info.size] < 2
+                                  and src_info.size not in existing_sizes):
+            res_copy_ops.append(op)
+            continue
+        key = (src_info.size, digests.get_digest(src_info))
+        link_src = originals.get(key)
+        if link_src is None:
+            originals[key] = dest
+            res_copy_ops.append(op)
+        else:
+            link_ops.append((action, rel_path, link_src, dest))
+    return res_copy_ops, link_ops
+
+
+def find_moved_files(opts, source_map, target_map, orphans, digests):
+    """Return a list of (target_info, rel_path) for orphans that were moved in the source.
+
+    An orphan is considered moved, if a new source file has the same size and
+    content digest.
+    """
+    orphans_by_size = {}
+    for o in orphans:
+        orphans_by_size.setdefault(o.size, []).append(o)
+    moves = []
+    for rel_path in source_map["file_list"]:
+        if rel_path in target_map["file_map"]:
+            continue
+        src_info = source_map["file_map"][rel_path]
+        candidates = orphans_by_size.get(src_info.size)
+        if not candidates:
+            continue
+        src_digest = digests.get_digest(src_info)
+        for i, o in enumerate(candidates):
+            if digests.get_digest(o) == src_digest:
+                moves.append((o, rel_path))
+                del candidates[i]
+                break
+    return moves
+
+
+def sync_file_lists(opts, source_map, target_map):
+    """Make the target folder reflect the source files.
+    
+    """
+    sync_targets(opts, source_map, [(opts, target_map)])
+    return
+
+
+def get_target_opts(opts):
+    """Return a copy of opts for every folder in `opts.target_folders`."""
+    res = []
+    for target_folder in opts.target_folders:
+        target_opts = copy.copy(opts)
+        target_opts.target_folder = target_folder
+        res.append(target_opts)
+    return res
+
+
+def sync_targets(opts, source_map, targets):
+    """Make one or more target folders reflect the source files.
+
+    `targets` is a list of (target_opts, target_map) tuples, where
+    target_opts is a copy of opts for the target folder (see
+    `get_target_opts()`). Source files that are needed by multiple targets
+    are read only once.
+    """
+    digests = None
+    if (opts.checksum or opts.delta or opts.link_duplicates
+            or (opts.delete_orphans and opts.detect_moves)):
+        digests = open_digest_cache(opts)
+    try:
+        _sync_targets(opts, source_map, targets, digests)
+    finally:
+        if digests:
+            opts.metrics.count("digest_reads", digests.read_count)
+            opts.metrics.count("digest_read_bytes", digests.read_bytes)
+            if opts.verbose >= 2:
+                print "    Computed %s digests (%s bytes read)." % (digests.read_count,
+                                                                     digests.read_bytes)
+            digests.close()
+    return
+
+
+def _invalidate_touched_folders(opts, ops):
+    """Make sure the scan index re-reads all target folders touched by ops.
+
+    (Files that were updated in place don't change the folder's mtime.)
+    """
+    if opts.use_index and not opts.dry_run and ops:
+        index = open_scan_index(opts, opts.target_folder)
+        touched = set(os.path.dirname(op[3]) for op in ops)
+        touched.update(os.path.dirname(op[2]) for op in ops if op[0] == "MOVE")
+        index.invalidate_folders(touched)
+        index.close()
+    return
+
+
+def _plan_sync_ops(opts, source_map, target_map, digests):
+    """Compare source and target and return the operations that sync them.
+
+    Return (move_ops, delete_ops, copy_ops, link_ops, moves, orphans, skipped_ops,
+    identical_count).
+    """
+    # Measure before orphans are deleted, so freed space can be added exactly
+    free_bytes, block_size = get_disk_usage(opts.target_folder)
+
+    # Pass 1: find orphans
+    # (they are deleted before copying, so target space will be freed up)
+#    target_folders = {}
+    orphans = []
+    for rel_path, target_info in target_map["file_map"].iteritems():
+        src_info = source_map["file_map"].get(rel_path)
+        if not src_info:
+            orphans.append(target_info)
+
+    # Orphans that only have been moved in the source are renamed in the
+    # target, instead of deleting and copying them again
+    moves = []
+    move_ops = []
+    if opts.delete_orphans and opts.detect_moves and orphans:
+        moves = find_moved_files(opts, source_map, target_map, orphans, digests)
+        moved_orphans = set(id(o) for o, _rel_path in moves)
+        orphans = [o for o in orphans if id(o) not in moved_orphans]
+        for o, rel_path in moves:
+            target_fspec = os.path.join(opts.target_folder, rel_path)
+            move_ops.append(("MOVE", rel_path, o.fspec, target_fspec))
+            # Update the target map, so pass 2 treats this file as existing
+            del target_map["file_map"][o.rel_path]
+            o.rel_path = rel_path
+            target_map["file_map"][rel_path] = o
+
+    delete_ops = []
     if opts.delete_orphans:
-        purge_folders(opts, target_map)
-#        for folder, has_data in target_map["folder_map"].iteritems():
-#            print folder, has_data
+        delete_ops = [("DELETE", o.rel_path, None, o.fspec) for o in orphans]
+
+    # Pass 2: find files to copy
+    identical_count = 0
+    copy_ops = []
+    moved_paths = set(rel_path for _o, rel_path in moves)
+    compare_digests = digests if opts.checksum else None
+#    for rel_path, src_info in source_map["file_map"].iteritems():
+    for rel_path in source_map["file_list"]:
+        src_info = source_map["file_map"][rel_path]
+        target_info = target_map["file_map"].get(rel_path)
+        if rel_path in moved_paths:
+            # Content was already verified by find_moved_files()
+            continue
+        elif target_info:
+            if compare_file_info(src_info, target_info, compare_digests):
+                # Identical
+                identical_count += 1
+                if opts.verbose >= 3:
+                    print 'UNCHANGED: %s' % rel_path
+            else:
+                # Modified
+                copy_ops.append(("UPDATE", rel_path, src_info.fspec, target_info.fspec))
+        else:
+            # New
+            target_fspec = os.path.join(opts.target_folder, rel_path)
+            copy_ops.append(("CREATE", rel_path, src_info.fspec, target_fspec))
+
+    # Duplicate files are copied once and linked to that copy
+    link_ops = []
+    if opts.link_duplicates and copy_ops:
+        copy_ops, link_ops = find_duplicate_ops(opts, source_map, target_map, copy_ops, digests)
+
+    # Never start copies that would not fit into the target
+    deleted = orphans if opts.delete_orphans else []
+    if link_ops and not target_supports_hardlinks(opts):
+        # Links are copied (e.g. on FAT), so they need space, too
+        link_set = set(link_ops)
+        planned_ops, skipped_ops, required, available = plan_capacity(
+            opts, copy_ops + link_ops, source_map, target_map, deleted, free_bytes,
+            block_size)
+        copy_ops = [op for op in planned_ops if op not in link_set]
+        link_ops = [op for op in planned_ops if op in link_set]
+    else:
+        copy_ops, skipped_ops, required, available = plan_capacity(
+            opts, copy_ops, source_map, target_map, deleted, free_bytes, block_size)
+    if skipped_ops and link_ops:
+        skipped_dests = set(op[3] for op in skipped_ops)
+        skipped_ops.extend(op for op in link_ops if op[2] in skipped_dests)
+        link_ops = [op for op in link_ops if op[2] not in skipped_dests]
+    if opts.verbose >= 1:
+        print "Space required: %s, available: %s." % (format_size(required),
+                                                      format_size(available))
+    if skipped_ops:
+        print >>sys.stderr, ("Target capacity exceeded: skipping %s files (%s)."
+                             % (len(skipped_ops), format_size(
+                                 sum(source_map["file_map"][op[1]].size for op in skipped_ops))))
+        if opts.verbose >= 2:
+            for action, rel_path, _src, _dest in skipped_ops:
+                print 'SKIP %s: %s' % (action, rel_path)
+    return move_ops, delete_ops, copy_ops, link_ops, moves, orphans, skipped_ops, identical_count
+
+
+def _sync_targets(opts, source_map, targets, digests):
+    # Pass 1 and 2: compare source with every target
+    plans = []
+    for target_opts, target_map in targets:
+        if len(targets) > 1 and opts.verbose >= 1:
+            print 'Target "%s":' % target_opts.target_folder
+        with opts.metrics.phase("compare") as ph:
+            plans.append(_plan_sync_ops(target_opts, source_map, target_map, digests))
+            ph["files"] += len(source_map["file_map"])
+
+    # Pass 3: execute moves, deletes and copies (in this order), recording
+    # progress in a journal per target, so an interrupted run can be resumed
+    journals = []
+    try:
+        for (target_opts, target_map), plan in zip(targets, plans):
+            move_ops, delete_ops, copy_ops, link_ops = plan[:4]
+            journal = None
+            if not opts.dry_run and (move_ops or delete_ops or copy_ops or link_ops):
+                remove_target_manifest(target_opts)
+                journal = TransferJournal.create(target_opts,
+                                                 move_ops + delete_ops + copy_ops + link_ops)
+            journals.append(journal)
+            with opts.metrics.phase("make_folders"):
+                opts.metrics.count("folders_created", make_target_folders(
+                    target_opts, move_ops + copy_ops + link_ops, target_map["folder_map"]))
+            run_file_ops(target_opts, move_ops + delete_ops, journal, digests)
+        # Orphans are gone now, so copies may run in parallel.
+        # Files that are copied to multiple targets are read only once.
+        all_copy_stats = run_fanout_copy_ops(
+            opts, [(plan[2], journal) for plan, journal in zip(plans, journals)], digests)
+        # Link sources were copied now
+        for (target_opts, _target_map), plan, journal, copy_stats in zip(
+                targets, plans, journals, all_copy_stats):
+            run_link_ops(target_opts, source_map, plan[3], copy_stats, journal)
+        for journal in journals:
+            if journal:
+                journal.finish()
+    finally:
+        for (target_opts, _target_map), plan in zip(targets, plans):
+            move_ops, delete_ops, copy_ops, link_ops = plan[:4]
+            _invalidate_touched_folders(target_opts, move_ops + delete_ops + copy_ops + link_ops)
+            if digests and not opts.dry_run:
+                _store_copied_digests(digests, source_map, copy_ops + link_ops)
+
+    for (target_opts, target_map), plan, copy_stats in zip(targets, plans, all_copy_stats):
+        if len(targets) > 1 and opts.verbose >= 1:
+            print 'Target "%s":' % target_opts.target_folder
+        _print_sync_summary(target_opts, source_map, plan, copy_stats)
+        # Pass 4: purge empty folders
+        move_ops, delete_ops, copy_ops, link_ops = plan[:4]
+        update_folder_map(target_opts, target_map["folder_map"],
+                          move_ops + delete_ops + copy_ops + link_ops)
+        if target_opts.delete_orphans:
+            with opts.metrics.phase("purge"):
+                purge_folders(target_opts, target_map)
+        if target_opts.manifest and not opts.dry_run:
+            with opts.metrics.phase("manifest"):
+                write_target_manifest(target_opts, target_map, digests)
+#            for folder, has_data in target_map["folder_map"].iteritems():
+#                print folder, has_data
     return
 
 
-def run():
-    # Create option parser for common and custom options
+def _print_sync_summary(opts, source_map, plan, copy_stats):
+    _move_ops, _delete_ops, copy_ops, link_ops, moves, orphans, skipped_ops, identical_count = plan
+    new_count = len([op for op in copy_ops + link_ops if op[0] == "CREATE"])
+    modified_count = len(copy_ops) + len(link_ops) - new_count
+    if opts.verbose >= 1 and copy_stats["copy_count"]:
+        print("Copied %s files (%s) using %s."
+              % (copy_stats["copy_count"], format_size(copy_stats["copy_bytes"]),
+                 ", ".join("%s: %s" % (m, n) for m, n in sorted(copy_stats["copy_methods"].items()))))
+    if opts.verbose >= 1 and copy_stats["delta_count"]:
+        print("Delta updates: %s files, wrote %s, saved %s."
+              % (copy_stats["delta_count"], format_size(copy_stats["delta_bytes"]),
+                 format_size(copy_stats["delta_saved_bytes"])))
+    if opts.verbose >= 1 and copy_stats["link_count"]:
+        print("Linked %s duplicate files (%s) using %s."
+              % (copy_stats["link_count"], format_size(copy_stats["link_bytes"]),
+                 ", ".join("%s: %s" % (m, n) for m, n in sorted(copy_stats["link_methods"].items()))))
+    if opts.verbose >= 1:
+        # print('Compared %s files. Identical: %s, modified: %s, new: %s, orphans: %s.' 
+        #       % (len(source_map["file_map"]), identical_count, modified_count, new_count, len(orphans)))
+        print('Synchronized %s files. Created: %s, updated: %s, moved: %s, deleted: %s, unchanged: %s, skipped: %s.' 
+              % (len(source_map["file_map"]), new_count, modified_count, len(moves),
+                 len(orphans), identical_count, len(skipped_ops)))
+    return
+
+
+def resume_sync(opts):
+    """Continue an interrupted run from the journal in the target folder.
+
+    Source and target are not scanned again; only the pending operations
+    of the journal are executed.
+    Return False, if there is no journal to resume.
+    """
+    journal = TransferJournal.load(opts)
+    if journal is None:
+        return False
+    # Use the settings of the interrupted run
+    opts.delete_orphans = journal.header["delete_orphans"]
+    file_ops = []
+    copy_ops = []
+    for op in journal.pending_ops:
+        action, rel_path, src, dest = op
+        if action in ("CREATE", "UPDATE"):
+            if _is_copied(src, dest):
+                # Copied, but interrupted before the journal was updated
+                journal.mark_done(op)
+            else:
+                copy_ops.append(op)
+        elif action == "MOVE" and not os.path.isfile(src):
+            journal.mark_done(op)
+        elif action == "DELETE" and not os.path.isfile(dest):
+            journal.mark_done(op)
+        else:
+            file_ops.append(op)
+    if opts.verbose >= 1:
+        print "Resuming interrupted run from %s: %s of %s operations pending." % (
+            journal.started_str, len(file_ops) + len(copy_ops), len(journal.ops))
+    remove_target_manifest(opts)
+    make_target_folders(opts, file_ops + copy_ops)
+    run_file_ops(opts, file_ops, journal)
+    # Duplicates of `--link-duplicates` are copied from another target file,
+    # which must be complete first
+    target_prefix = os.path.join(opts.target_folder, "")
+    link_ops = [op for op in copy_ops if op[2].startswith(target_prefix)]
+    copy_ops = [op for op in copy_ops if not op[2].startswith(target_prefix)]
+    digests = open_digest_cache(opts) if opts.delta else None
+    try:
+        run_copy_ops(opts, copy_ops, journal, digests)
+        run_copy_ops(opts, link_ops, journal, digests)
+    finally:
+        if digests:
+            digests.close()
+    journal.finish()
+    if opts.verbose >= 1:
+        print "Resumed %s operations." % (len(file_ops) + len(copy_ops) + len(link_ops))
+    return True
+
+
+def _fs_bytes(path):
+    """Return path as bytes, as expected by C functions."""
+    if isinstance(path, bytes):
+        return path
+    if hasattr(os, "fsencode"):
+        return os.fsencode(path) # Python 3.2+
+    return path.encode(FS_ENCODING)
+
+
+class InotifyWatcher(object):
+    """Report changed paths below a set of folders using Linux' inotify.
+
+    If `recursive` is true, sub folders (also ones that are created later)
+    are watched too.
+    """
+    method = "inotify"
+
+    def __init__(self, folders, recursive):
+        self.recursive = recursive
+        self.libc = ctypes.CDLL(ctypes.util.find_library("c"), use_errno=True)
+        self.fd = self.libc.inotify_init()
+        if self.fd < 0:
+            err = ctypes.get_errno()
+            raise OSError(err, os.strerror(err))
+        self.wd_map = {} # key: watch descriptor, value: folder
+        self.folders = {} # key: folder, value: watch descriptor
+        try:
+            for folder in folders:
+                self.add_folder(folder)
+        except Exception:
+            self.close()
+            raise
+
+    def close(self):
+        if self.fd >= 0:
+            os.close(self.fd)
+            self.fd = -1
+
+    def add_folder(self, folder, follow=True):
+        """Watch `folder` and (if recursive) its sub folders.
+
+        Only the root folders may be symbolic links; links found below are
+        not followed, so link loops can't make this recurse forever.
+        """
+        if folder in self.folders:
+            return
+        mask = INOTIFY_MASK
+        if not follow:
+            mask |= IN_ONLYDIR | IN_DONT_FOLLOW
+        wd = self.libc.inotify_add_watch(self.fd, _fs_bytes(folder), mask)
+        if wd < 0:
+            err = ctypes.get_errno()
+            if err in (errno.ENOENT, errno.ENOTDIR):
+                return # Removed meanwhile
+            raise OSError(err, os.strerror(err), folder)
+        self.wd_map[wd] = folder
+        self.folders[folder] = wd
+        if self.recursive:
+            try:
+                _files, subfolders = _list_folder(folder)
+            except OSError:
+                return
+            for sub in subfolders:
+                self.add_folder(sub, follow=False)
+        return
+
+    def _remove_folder(self, folder):
+        prefix = folder + os.sep
+        for f in [f for f in self.folders if f == folder or f.startswith(prefix)]:
+            wd = self.folders.pop(f)
+            self.wd_map.pop(wd, None)
+            self.libc.inotify_rm_watch(self.fd, wd)
+        return
+
+    def read_changes(self, timeout=None):
+        """Wait up to `timeout` seconds (None: forever) and return a set of changed paths."""
+        changes = set()
+        if not select.select([self.fd], [], [], timeout)[0]:
+            return changes
+        buf = os.read(self.fd, INOTIFY_BUFFER_SIZE)
+        pos = 0
+        while pos < len(buf):
+            wd, mask, _cookie, length = struct.unpack_from("iIII", buf, pos)
+            pos += 16
+            name = buf[pos:pos + length].rstrip(b"\0")
+            pos += length
+            if mask & IN_Q_OVERFLOW:
+                # Events were lost: report all folders as changed
+                changes.update(self.folders)
+                continue
+            folder = self.wd_map.get(wd)
+            if folder is None:
+                continue
+            if mask & IN_IGNORED:
+                # Watched folder was removed
+                self.wd_map.pop(wd, None)
+                self.folders.pop(folder, None)
+                continue
+            if not isinstance(name, str):
+                name = name.decode(sys.getfilesystemencoding(), "surrogateescape")
+            path = os.path.join(folder, name) if name else folder
+            if mask & IN_ISDIR and self.recursive:
+                if mask & (IN_CREATE | IN_MOVED_TO):
+                    self.add_folder(path, follow=False)
+                elif mask & IN_MOVED_FROM:
+                    self._remove_folder(path)
+            changes.add(path)
+        return changes
+
+
+class PollingWatcher(object):
+    """Report changed paths below a set of folders by comparing folder listings.
+
+    This has the same interface as InotifyWatcher.
+    """
+    method = "polling"
+
+    def __init__(self, folders, recursive):
+        self.recursive = recursive
+        self.folders = {} # key: folder, value: ({name: (size, mtime)}, set(subfolders))
+        for folder in folders:
+            self.add_folder(folder)
+
+    def close(self):
+        pass
+
+    def add_folder(self, folder, follow=True):
+        """Watch `folder` and (if recursive) its sub folders, see InotifyWatcher."""
+        if folder in self.folders:
+            return
+        if not follow and os.path.islink(folder):
+            return
+        try:
+            files, subfolders = _list_folder(folder)
+        except OSError:
+            return
+        self.folders[folder] = (dict((name, (size, mtime)) for name, size, mtime in files),
+                                set(subfolders))
+        if self.recursive:
+            for sub in subfolders:
+                self.add_folder(sub, follow=False)
+        return
+
+    def _remove_folder(self, folder):
+        prefix = folder + os.sep
+        for f in [f for f in self.folders if f == folder or f.startswith(prefix)]:
+            del self.folders[f]
+        return
+
+    def poll(self):
+        """Return a set of paths that changed since the last call."""
+        changes = set()
+        for folder, (files, subfolders) in list(self.folders.items()):
+            if folder not in self.folders:
+                continue # Removed as part of a parent folder
+            try:
+                new_files, new_subfolders = _list_folder(folder)
+            except OSError:
+                self._remove_folder(folder)
+                changes.add(folder)
+                continue
+            new_files = dict((name, (size, mtime)) for name, size, mtime in new_files)
+            new_subfolders = set(new_subfolders)
+            for name in set(files).union(new_files):
+                if files.get(name) != new_files.get(name):
+                    changes.add(os.path.join(folder, name))
+            self.folders[folder] = (new_files, new_subfolders)
+            if self.recursive:
+                for sub in new_subfolders - subfolders:
+                    self.add_folder(sub, follow=False)
+                    changes.add(sub)
+                for sub in subfolders - new_subfolders:
+                    self._remove_folder(sub)
+                    changes.add(sub)
+        return changes
+
+    def read_changes(self, timeout=None):
+        """Wait up to `timeout` seconds (None: forever) and return a set of changed paths."""
+        while True:
+            time.sleep(WATCH_POLL_INTERVAL if timeout is None else timeout)
+            changes = self.poll()
+            if changes or timeout is not None:
+                return changes
+
+
+def create_watcher(opts, folders, recursive):
+    """Return an InotifyWatcher if possible, else a PollingWatcher."""
+    if not opts.watch_poll and sys.platform.startswith("linux"):
+        try:
+            return InotifyWatcher(folders, recursive)
+        except (OSError, AttributeError) as e:
+            # AttributeError: libc without inotify functions
+            if opts.verbose >= 1:
+                print "Cannot use inotify (%s); polling for changes instead." % e
+    return PollingWatcher(folders, recursive)
+
+
+def _iter_rel_files(folder, root_folder):
+    """Yield the paths of all files below folder, relative to root_folder.
+
+    Like the scanner, this doesn't follow symbolic links to folders.
+    """
+    if os.path.islink(folder):
+        return
+    for dirname, _subfolders, filenames in os.walk(folder):
+        for filename in filenames:
+            yield os.path.relpath(os.path.join(dirname, filename), root_folder)
+
+
+def _stat_regular_file(fspec):
+    """Return os.stat(fspec), or None if fspec is not an existing file."""
+    try:
+        st = os.stat(fspec)
+    except OSError:
+        return None
+    if not stat.S_ISREG(st.st_mode):
+        return None
+    return st
+
+
+def reread_playlist(opts, source_info, playlist_path, watcher):
+    """Read a changed playlist again and return the set of rel_paths that
+    were added or removed."""
+    old_members = source_info["playlist_map"].get(playlist_path, [])
+    new_members = []
+    if os.path.isfile(playlist_path):
+        info = create_info_dict()
+        info["root_folder"] = opts.source_folder
+        read_playlist(opts, playlist_path, info)
+        new_members = info["playlist_map"][playlist_path]
+        for rel_path in new_members:
+            src_info = info["file_map"][rel_path]
+            if rel_path not in source_info["file_map"]:
+                source_info["file_list"].append(rel_path)
+            source_info["file_map"][rel_path] = src_info
+            watcher.add_folder(os.path.dirname(src_info.fspec))
+    elif opts.verbose >= 1:
+        print "Playlist was removed: %s" % playlist_path
+    source_info["playlist_map"][playlist_path] = new_members
+    return set(old_members).symmetric_difference(new_members)
+
+
+def purge_parent_folders(opts, folders):
+    """Remove target folders (and their parents) that are empty or only
+    contain transient files."""
+    root_folder = opts.target_folder
+    purge_match = opts.purge_matcher.match
+    for folder in sorted(folders, reverse=True):
+        while folder.startswith(root_folder + os.sep) and os.path.isdir(folder):
+            names = os.listdir(folder)
+            if [name for name in names
+                if not purge_match(name) or not os.path.isfile(os.path.join(folder, name))]:
+                break
+            for name in names:
+                fspec = os.path.join(folder, name)
+                if opts.verbose >= 2:
+                    print "Purge transient file %s" % fspec
+                delete_file(opts, fspec)
+            if opts.verbose >= 1:
+                print "Remove empty folder %s" % folder
+            if opts.dry_run:
+                break
+            os.rmdir(folder)
+            folder = os.path.dirname(folder)
+    return
+
+
+def sync_changed_paths(opts, source_info, changes, watcher):
+    """Sync the target for a set of changed source paths (see `watch_sync()`).
+
+    Changed playlists are read again and only files that were added to or
+    removed from them are checked. Changed folders are checked completely.
+    Moved files are deleted and copied (there is no move detection) and copies
+    that don't fit into the free space of the target are skipped.
+    """
+    source_folder = opts.source_folder
+    target_folder = opts.target_folder
+    rel_paths = set()
+    for pl in opts.playlist_paths:
+        if pl in changes or os.path.dirname(pl) in changes:
+            rel_paths.update(reread_playlist(opts, source_info, pl, watcher))
+    playlist_paths = set(opts.playlist_paths)
+    for path in changes:
+        if path in playlist_paths:
+            continue
+        rel_path = os.path.relpath(path, source_folder)
+        target_path = os.path.join(target_folder, rel_path)
+        if os.path.isdir(path) or os.path.isdir(target_path):
+            # A folder was created, removed or moved: check all its files
+            rel_paths.update(_iter_rel_files(path, source_folder))
+            rel_paths.update(_iter_rel_files(target_path, target_folder))
+        else:
+            rel_paths.add(rel_path)
+
+    members = None
+    if opts.playlist_paths:
+        members = set()
+        for pl_members in source_info["playlist_map"].itervalues():
+            members.update(pl_members)
+
+    digests = None
+    if opts.checksum or opts.delta:
+        digests = open_digest_cache(opts)
+    compare_digests = digests if opts.checksum else None
+    try:
+        delete_ops = []
+        copy_ops = []
+        # FileInfos of the changed files, for `plan_capacity()`
+        source_files = {}
+        target_files = {}
+        for rel_path in sorted(rel_paths):
+            name = os.path.basename(rel_path)
+            if members is not None:
+                wanted = rel_path in members
+            else:
+                wanted = (opts.sync_matcher.match(name)
+                          and not rel_path.startswith(os.pardir + os.sep))
+            src = os.path.join(source_folder, rel_path)
+            dest = os.path.join(target_folder, rel_path)
+            src_st = _stat_regular_file(src) if wanted else None
+            dest_st = _stat_regular_file(dest)
+            if src_st is not None:
+                source_files[rel_path] = FileInfo(source_folder, rel_path,
+                                                  src_st.st_size, src_st.st_mtime)
+            if dest_st is not None:
+                target_files[rel_path] = FileInfo(target_folder, rel_path,
+                                                  dest_st.st_size, dest_st.st_mtime)
+            if src_st is not None:
+                if dest_st is None:
+                    copy_ops.append(("CREATE", rel_path, src, dest))
+                elif not compare_file_info(source_files[rel_path], target_files[rel_path],
+                                           compare_digests):
+                    copy_ops.append(("UPDATE", rel_path, src, dest))
+            elif dest_st is not None and opts.delete_orphans and opts.sync_matcher.match(name):
+                delete_ops.append(("DELETE", rel_path, None, dest))
+        if not delete_ops and not copy_ops:
+            return
+
+        # Never start copies that would not fit into the target
+        # (`--max-size` is rejected with `--watch`, since it needs a full scan)
+        if copy_ops:
+            free_bytes, block_size = get_disk_usage(target_folder)
+            copy_ops, skipped_ops, _required, _available = plan_capacity(
+                opts, copy_ops, {"file_map": source_files}, {"file_map": target_files},
+                [target_files[op[1]] for op in delete_ops], free_bytes, block_size)
+            if skipped_ops:
+                print >>sys.stderr, ("Target capacity exceeded: skipping %s files (%s)."
+                                     % (len(skipped_ops), format_size(
+                                         sum(source_files[op[1]].size for op in skipped_ops))))
+                if opts.verbose >= 2:
+                    for action, rel_path, _src, _dest in skipped_ops:
+                        print 'SKIP %s: %s' % (action, rel_path)
+            if not delete_ops and not copy_ops:
+                return
+
+        journal = None
+        if not opts.dry_run:
+            remove_target_manifest(opts)
+            journal = TransferJournal.create(opts, delete_ops + copy_ops)
+        try:
+            make_target_folders(opts, copy_ops)
+            run_file_ops(opts, delete_ops, journal)
+            run_copy_ops(opts, copy_ops, journal, digests)
+            if journal:
+                journal.finish()
+        finally:
+            _invalidate_touched_folders(opts, delete_ops + copy_ops)
+        if delete_ops:
+            with opts.metrics.phase("purge"):
+                purge_parent_folders(opts, set(os.path.dirname(op[3]) for op in delete_ops))
+    finally:
+        if digests:
+            digests.close()
+
+    if opts.verbose >= 1:
+        new_count = len([op for op in copy_ops if op[0] == "CREATE"])
+        print "%s Synchronized changes. Created: %s, updated: %s, deleted: %s." % (
+            time.strftime("%H:%M:%S"), new_count, len(copy_ops) - new_count, len(delete_ops))
+    return
+
+
+def watch_sync(opts):
+    """Synchronize, then watch the source and sync changes until interrupted.
+
+    With playlists, the playlist folders and the folders of all referenced
+    files are watched, else the complete source folder. Events are collected
+    until the source was quiet for WATCH_DEBOUNCE seconds and then passed to
+    `sync_changed_paths()`. Errors of a sync are printed, but don't stop
+    watching; the failed paths are synced again with the next changes.
+    Return (source_info, target_info) of the initial scan.
+    """
+    if opts.playlist_paths:
+        watcher = create_watcher(opts, set(os.path.dirname(pl) for pl in opts.playlist_paths),
+                                 False)
+    else:
+        watcher = create_watcher(opts, [opts.source_folder], True)
+    try:
+        # The watcher was started before the scan, so no change is missed
+        source_info, target_info = read_source_and_target(opts)
+        print_source_target_summary(opts, source_info, target_info)
+        sync_file_lists(opts, source_info, target_info)
+        if opts.playlist_paths:
+            for folder in set(os.path.dirname(info.fspec)
+                              for info in source_info["file_map"].itervalues()):
+                watcher.add_folder(folder)
+        if opts.verbose >= 1:
+            print "Watching %s folders for changes (%s). Press Ctrl+C to stop." % (
+                len(watcher.folders), watcher.method)
+        failed_changes = set()
+        while True:
+            try:
+                changes = watcher.read_changes()
+                # Wait until the source is quiet (e.g. a copy has finished)
+                while True:
+                    more = watcher.read_changes(WATCH_DEBOUNCE)
+                    if not more:
+                        break
+                    changes.update(more)
+            except KeyboardInterrupt:
+                if opts.verbose >= 1:
+                    print "Stopped watching."
+                return source_info, target_info
+            if opts.verbose >= 2:
+                print "Detected %s changed paths." % len(changes)
+            changes.update(failed_changes)
+            failed_changes = set()
+            try:
+                sync_changed_paths(opts, source_info, changes, watcher)
+            except (IOError, OSError, AssertionError) as e:
+                # E.g. a source file was removed while it was copied: report
+                # it, keep watching and retry with the next changes
+                print >>sys.stderr, "Could not sync changes: %s" % (
+                    str(e) or e.__class__.__name__)
+                failed_changes = changes
+    finally:
+        watcher.close()
+
+
+def create_option_parser():
+    """Return an OptionParser for common and custom options.
+
+    `init_options(create_option_parser().get_default_values())` may be used
+    to create an `opts` object for calling the processing functions directly.
+    """
     parser = OptionParser(#prog="wplsync", # Otherwise 'wplsync-script.py' gets displayed on windows
                           version=__version__,
-                          usage="usage: %prog [options] SOURCE_FOLDER TARGET_FOLDER [PLAYLIST [, PLAYLIST...]]",
-                          description="Synchronize two media folders, optionally filtered by playlists.",
+                          usage="usage: %prog [options] SOURCE_FOLDER TARGET_FOLDER [TARGET_FOLDER...] [PLAYLIST [, PLAYLIST...]]",
+                          description="Synchronize a media folder with one or more target folders, "
+                          "optionally filtered by playlists.",
                           epilog="See also http://wplsync.googlecode.com")
 
     parser.add_option("-x", "--execute",
@@ -378,7 +3467,111 @@ def run():
                       action="store_true", dest="include_externals", default=False,
                       help="allow source files outside SOURCE_FOLDER and copy them to TAGRGET_FOLDER/external. "
                       "Note that the target playlists may not work as axpected in this case.")
-    
+    parser.add_option("-j", "--jobs",
+                      type="int", dest="jobs", default=None,
+                      help="number of files that are copied in parallel "
+                      "(default: derived from --source-device and --target-device, else 1)")
+    parser.add_option("", "--include",
+                      action="append", dest="include_patterns", default=[], metavar="PATTERN",
+                      help="also sync files whose name matches this fnmatch pattern "
+                      "(e.g. '*.flac'; may be repeated)")
+    parser.add_option("", "--exclude",
+                      action="append", dest="exclude_patterns", default=[], metavar="PATTERN",
+                      help="don't sync files whose name matches this fnmatch pattern "
+                      "(may be repeated)")
+    parser.add_option("", "--resume",
+                      action="store_true", dest="resume", default=False,
+                      help="continue an interrupted run from the journal in TARGET_FOLDER, "
+                      "without scanning source and target again (requires -x)")
+    parser.add_option("", "--max-size",
+                      dest="max_size", default=None, metavar="SIZE",
+                      help="maximum total size of synchronized files in TARGET_FOLDER "
+                      "(e.g. '16G', '700M'); files that don't fit are skipped in "
+                      "playlist order. The free space of the target is always checked")
+    parser.add_option("", "--no-detect-moves",
+                      action="store_false", dest="detect_moves", default=True,
+                      help="with --delete, don't try to rename target files that have "
+                      "been moved in the source; delete and copy them instead")
+    parser.add_option("", "--checksum",
+                      action="store_true", dest="checksum", default=False,
+                      help="compare files of equal size by content digest instead of "
+                      "modification time (digests are cached in STATE_DIR)")
+    parser.add_option("", "--copy-method",
+                      type="choice", choices=("auto", ) + COPY_METHODS, dest="copy_method",
+                      default="auto",
+                      help="how file data is copied: %s (default: %%default = best "
+                      "method supported by the OS and file systems)" % ", ".join(COPY_METHODS))
+    parser.add_option("", "--delta",
+                      action="store_true", dest="delta", default=False,
+                      help="update modified files in place, writing only changed blocks "
+                      "(block checksums of the target are cached in STATE_DIR)")
+    parser.add_option("", "--link-duplicates",
+                      action="store_true", dest="link_duplicates", default=False,
+                      help="copy files with identical content (e.g. album art) only once "
+                      "and create hardlinks for the other occurrences in TARGET_FOLDER "
+                      "(copies, if the file system has no hardlinks; digests are cached "
+                      "in STATE_DIR)")
+    parser.add_option("", "--transform",
+                      action="append", dest="transform", default=[],
+                      metavar="EXT:TARGET_EXT:COMMAND",
+                      help="convert source files with extension EXT using COMMAND, e.g. "
+                      "'flac:mp3:ffmpeg -v error -i {src} -q:a 2 {dest}'; the target gets "
+                      "the converted file. Converted files are cached in STATE_DIR "
+                      "(may be repeated)")
+    parser.add_option("", "--transform-jobs",
+                      type="int", dest="transform_jobs", default=None,
+                      help="number of parallel --transform processes (default: number of CPUs)")
+    parser.add_option("", "--manifest",
+                      action="store_true", dest="manifest", default=False,
+                      help="store a list of all files in TARGET_FOLDER ('%s'), so "
+                      "the next run can read it instead of scanning the target "
+                      "(useful for slow devices like SD cards)" % MANIFEST_FILE_NAME)
+    parser.add_option("", "--index",
+                      action="store_true", dest="use_index", default=False,
+                      help="keep a persistent scan index in STATE_DIR, so unchanged "
+                      "folders are not re-read on the next run. Files that are modified "
+                      "in place (e.g. retagged) are only detected if their folder changed, "
+                      "see --refresh-index")
+    parser.add_option("", "--refresh-index",
+                      action="store_true", dest="refresh_index", default=False,
+                      help="re-read all folders and rebuild the scan index, e.g. after "
+                      "files were modified in place (implies --index)")
+    parser.add_option("", "--state-dir",
+                      dest="state_dir", default=os.path.expanduser("~/.wplsync"),
+                      help="folder for persistent data like the scan index "
+                      "(default: %default)")
+    parser.add_option("-w", "--watch",
+                      action="store_true", dest="watch", default=False,
+                      help="keep running after the sync and sync changes of the source "
+                      "folder and playlists as they happen (stop with Ctrl+C)")
+    parser.add_option("", "--watch-poll",
+                      action="store_true", dest="watch_poll", default=False,
+                      help="with --watch, poll the source for changes instead of using "
+                      "inotify (e.g. for network shares)")
+    parser.add_option("", "--stats-json",
+                      dest="stats_json", default=None, metavar="FILE",
+                      help="write timings of the processing phases and counters "
+                      "(files, bytes, stat calls, ...) to FILE as JSON")
+    parser.add_option("", "--profile",
+                      action="store_true", dest="profile", default=False,
+                      help="run with cProfile and print the %s most expensive "
+                      "functions (only the main thread is profiled)" % PROFILE_TOP_COUNT)
+    device_classes = sorted(DEFAULT_OPTS["copy_jobs"].keys())
+    parser.add_option("", "--source-device",
+                      type="choice", choices=device_classes, dest="source_device", default=None,
+                      help="device class of SOURCE_FOLDER (%s), used to choose the "
+                      "number of copy jobs" % ", ".join(device_classes))
+    parser.add_option("", "--target-device",
+                      type="choice", choices=device_classes, dest="target_device", default=None,
+                      help="device class of TARGET_FOLDER (%s), used to choose the "
+                      "number of copy jobs" % ", ".join(device_classes))
+    return parser
+
+
+def run():
+    # Create option parser for common and custom options
+    parser = create_option_parser()
+
     # Parse command line
     (options, args) = parser.parse_args()
 
@@ -395,43 +3588,128 @@ def run():
     elif not os.path.isdir(args[1]):
         parser.error("TARGET_FOLDER must be a folder")
 
+    if options.refresh_index:
+        options.use_index = True
+
+    if options.max_size is not None:
+        try:
+            options.max_size = parse_size(options.max_size)
+        except ValueError:
+            parser.error("invalid --max-size: %r" % options.max_size)
+
+    for rule in options.transform:
+        try:
+            parse_transform_rule(rule)
+        except ValueError as e:
+            parser.error("invalid --transform: %s" % e)
+    if options.watch and options.transform:
+        parser.error("--watch cannot be combined with --transform")
+    # Changes are synced without scanning the complete target again
+    if options.watch and options.max_size:
+        parser.error("--watch cannot be combined with --max-size")
+    if options.watch and options.link_duplicates:
+        parser.error("--watch cannot be combined with --link-duplicates")
+
+    init_options(options)
     options.source_folder = canonical_path(args[0])
-    options.target_folder = canonical_path(args[1])
+    # All folder arguments are targets, the rest are playlists
+    options.target_folders = []
+    playlist_args = []
+    for arg in args[1:]:
+        if os.path.isdir(arg) and not playlist_args:
+            options.target_folders.append(canonical_path(arg))
+        else:
+            playlist_args.append(arg)
+    options.target_folder = options.target_folders[0]
 
-    if not check_path_independent(options.source_folder, options.target_folder):
-        parser.error("SOURCE_FOLDER and TARGET_FOLDER must not overlap")
+    for i, target_folder in enumerate(options.target_folders):
+        if not check_path_independent(options.source_folder, target_folder):
+            parser.error("SOURCE_FOLDER and TARGET_FOLDER must not overlap")
+        for other in options.target_folders[i + 1:]:
+            if not check_path_independent(target_folder, other):
+                parser.error("TARGET_FOLDERs must not overlap")
+    if options.watch and len(options.target_folders) > 1:
+        parser.error("--watch supports only one TARGET_FOLDER")
 
     options.playlist_paths = []
-    for pl in args[2:]:
+    for pl in playlist_args:
         pl = canonical_path(pl)
         if not os.path.isfile(pl):
             parser.error("'%s' must be a playlist file" % pl)
+        elif get_playlist_reader(pl) is None:
+            parser.error("'%s' is not a supported playlist format (%s)"
+                         % (pl, ", ".join(sorted(PLAYLIST_READERS.keys()))))
         options.playlist_paths.append(pl)
 
-    start_time = time.time()
+    if options.profile:
+        profiler = cProfile.Profile()
+        profiler.enable()
+    source_info = None
+    target_infos = []
+    target_opts_list = get_target_opts(options)
     try:
-        # Call processor
-        source_info = read_source_files(options)
-        target_info = read_folder_files(options, options.target_folder)
-
-        if options.verbose >= 1:
-            print "Source: %s files, %s valid in %s folders." % (source_info["process_count"],
-                                                  len(source_info["file_map"]),
-                                                  len(source_info["folder_map"])
-                                                  )
-            if options.verbose >= 2:
-                ext_list = sorted(source_info["ext_map"].keys())
-                print "    Extensions: %s" % ext_list
-            print "Target: %s files, %s valid in %s folders." % (target_info["process_count"],
-                                                  len(target_info["file_map"]),
-                                                  len(target_info["folder_map"])
-                                                  )
-        sync_file_lists(options, source_info, target_info)
+        resumed = False
+        for target_opts in target_opts_list:
+            if options.resume and not options.dry_run:
+                try:
+                    resumed_target = resume_sync(target_opts)
+                except ValueError as e:
+                    parser.error("cannot resume: %s" % e)
+                if resumed_target:
+                    resumed = True
+                else:
+                    print "No interrupted run found in %s." % target_opts.target_folder
+            elif not options.dry_run:
+                try:
+                    journal = TransferJournal.load(target_opts)
+                except ValueError as e:
+                    # Unusable for this run (e.g. another SOURCE_FOLDER): only
+                    # --resume depends on it, so discard it
+                    print >>sys.stderr, "%s; removing it." % e
+                    os.remove(TransferJournal.get_path(target_opts))
+                    journal = None
+                if journal:
+                    print ("Found journal of an interrupted run (started %s); "
+                           "doing a full sync instead of --resume." % journal.started_str)
+                    journal.remove_temp_files()
+                    journal.finish()
+        if options.watch:
+            source_info, target_info = watch_sync(options)
+            target_infos = [target_info]
+        elif not resumed:
+            # Call processor
+            source_info, target_infos = read_source_and_targets(options, target_opts_list)
+            print_source_target_summary(options, source_info, target_infos)
+            sync_targets(options, source_info, zip(target_opts_list, target_infos))
     except KeyboardInterrupt as e:
-        print >>sys.stderr, "Interrupted!"
+        print >>sys.stderr, "Interrupted! (Use --resume to continue.)"
 
+    if options.profile:
+        profiler.disable()
+        pstats.Stats(profiler, stream=sys.stdout).sort_stats("cumulative").print_stats(PROFILE_TOP_COUNT)
+    metrics = options.metrics
+    if options.stats_json:
+        extra = {"dry_run": options.dry_run,
+                 "source_folder": options.source_folder,
+                 "target_folders": options.target_folders,
+                 "playlists": options.playlist_paths,
+                 }
+        def _info_stats(info):
+            return {"folder": info["root_folder"],
+                    "files": len(info["file_map"]),
+                    "bytes": info["byte_count"],
+                    "unique": info["process_count"],
+                    "references": info["reference_count"],
+                    "errors": info["error_count"],
+                    }
+        if source_info is not None:
+            extra["source"] = _info_stats(source_info)
+        extra["targets"] = [_info_stats(info) for info in target_infos if info is not None]
+        metrics.write_json(options.stats_json, **extra)
+    if options.verbose >= 2:
+        metrics.print_summary()
     if options.verbose >= 1:
-        print "Elapsed: %.2f seconds." % (time.time() - start_time)
+        print "Elapsed: %.2f seconds." % metrics.to_dict()["wall"]
     if options.dry_run and options.verbose >= 1:
         print("\n*** Dry-run mode: no files have been modified!\n"
               "*** Use -x or --execute to process files.")